@@ -1,14 +1,31 @@
 from openerp.osv import osv, fields
 from openerp.tools.translate import _
-from os import listdir, path, makedirs
+from openerp import tools
+from os import listdir, path, makedirs, link
 from os.path import isfile, join, split
-from shutil import move
 import re, netsvc, json, csv, StringIO
+import cProfile
 import datetime
+import errno
+import gzip
+import hashlib
 import logging
+import marshal
+import pstats
+import random
+import time
+import zlib
+import psycopg2
 from os import getcwd
 from pytz import timezone
 from openerp import SUPERUSER_ID
+from openerp.workflow import instance as wkf_instance
+from edi_storage import ensure_directories, forget_directory, shard_folders, compress_file, content_hash, remove_file, move_file, is_staged, staged_file, write_file, unique_name, StagedBatch
+from edi_connection import send_files
+from edi_locking import try_lock
+from edi_metrics import timed, saves_metrics, collect, render, BUCKETS
+from edi_validation import parse_schema, validate_csv
+from edi_partition import partition_supported, is_partitioned, convert_to_partitioned, ensure_partitions, list_partitions, drop_partition, restore_foreign_keys
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
@@ -63,10 +80,57 @@ class clubit_tools_edi_flow(osv.Model):
         'validator': fields.char('Validator Name', size=64, required=False, readonly=True),
         'partner_resolver': fields.char('Partner Resolver Name', size=64, required=False, readonly=True),
         'process_after_create': fields.boolean('Automatically process after create'),
+        'native_workflow': fields.boolean('Native state machine', help="Move new documents of this flow through their states with set-wise updates instead of the workflow engine. The states and transitions stay the same."),
         'allow_duplicates': fields.boolean('Allow duplicate references'),
+        'ignore_identical_content': fields.boolean('Ignore identical content', help="Skip incoming files whose content was already received for the same partner. Skipped files are moved to the skipped folder."),
         'ignore_partner_ids': fields.many2many('res.partner', 'clubit_tools_ignore_partner_rel', 'flow_id', 'partner_id', help="A list of partners that need to be ignored. The content is retrieved from the edi document."),
+        'directory_layout': fields.selection([('flat', 'Flat'), ('date', 'By date (YYYY/MM/DD)'), ('hash', 'By hash prefix')], 'Directory Layout', required=True, help="How files are spread over sub folders of the imported and archived directories."),
+        'retention_db_days': fields.integer('Keep in database (days)', help="Processed and archived documents are deleted this many days after their last change, 0 keeps them forever."),
+        'retention_disk_days': fields.integer('Keep on disk (days)', help="Files of processed and archived documents are deleted this many days after their last change, 0 keeps them forever."),
+        'profile_enabled': fields.boolean('Profile', help="Profile the validator and processor of this flow for a sample of the documents."),
+        'profile_sample_rate': fields.float('Sample rate', digits=(3, 2), help="Fraction of the documents to profile, between 0 and 1."),
+        'csv_schema': fields.text('CSV Schema', help="JSON description of the columns of CSV files, see edi_validation.py. Leave empty to only check the CSV syntax."),
+        'csv_max_errors': fields.integer('Maximum CSV errors', help="Validation of a CSV file stops after this many errors."),
+        'validation_cache': fields.boolean('Cache validation results', help="Skip the validation of documents whose content passed the same validation for the same partner before. Only use this if the validator looks at nothing but the content."),
+        'chatter_policy': fields.selection([('all', 'All events'), ('errors', 'Errors only'), ('none', 'Nothing')], 'Post in chatter', required=True,
+                                           help="Which automated events are posted as chatter messages. Every event is recorded in the document history either way."),
     }
 
+    _defaults = {
+        'directory_layout': 'flat',
+        'native_workflow': False,
+        'retention_db_days': 0,
+        'retention_disk_days': 0,
+        'profile_enabled': False,
+        'profile_sample_rate': 0.1,
+        'chatter_policy': 'errors',
+        'csv_max_errors': 10,
+        'validation_cache': False,
+    }
+
+    def _check_csv_schema(self, cr, uid, ids, context=None):
+        for flow in self.browse(cr, uid, ids, context=context):
+            try:
+                parse_schema(flow.csv_schema)
+            except ValueError:
+                return False
+        return True
+
+    _constraints = [
+        (_check_csv_schema, 'The CSV schema is not valid.', ['csv_schema']),
+    ]
+
+    def action_migrate_directory_layout(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.flow:action_migrate_directory_layout()
+        -----------------------------------------------------------
+        This method moves the files of all existing documents of
+        the given flows to the location their current directory
+        layout prescribes.
+        ----------------------------------------------------------- '''
+        document_db = self.pool.get('clubit.tools.edi.document.incoming')
+        document_db.migrate_directory_layout(cr, uid, ids, context=context)
+        return True
+
 ##############################################################################
 #
 #    clubit.tools.edi.partnerflow
@@ -83,6 +147,91 @@ class clubit_tools_edi_partnerflow(osv.Model):
         'partnerflow_active' : fields.boolean('Active'),
     }
 
+    _sql_constraints = [
+        ('partner_flow_unique', 'unique(partnerflow_id, flow_id)', 'A partner can only subscribe to a flow once.'),
+    ]
+
+    def create(self, cr, uid, vals, context=None):
+        ''' clubit.tools.edi.partnerflow:create()
+        -----------------------------------------
+        This method overwrites the standard OpenERP create() method to make
+        sure the EDI directories for the new subscription are created.
+        ------------------------------------------------------------------- '''
+        new_id = super(clubit_tools_edi_partnerflow, self).create(cr, uid, vals, context=context)
+        self.subscriptions_changed(cr)
+        self._maintain_partners(cr, uid, [new_id], context)
+        return new_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        ''' clubit.tools.edi.partnerflow:write()
+        ----------------------------------------
+        This method overwrites the standard OpenERP write() method to make
+        sure the EDI directories are maintained when a subscription changes.
+        -------------------------------------------------------------------- '''
+        result = super(clubit_tools_edi_partnerflow, self).write(cr, uid, ids, vals, context=context)
+        self.subscriptions_changed(cr)
+        if 'partnerflow_id' in vals or 'flow_id' in vals:
+            if isinstance(ids, (int, long)): ids = [ids]
+            self._maintain_partners(cr, uid, ids, context)
+        return result
+
+    def _maintain_partners(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.partnerflow:_maintain_partners()
+        -----------------------------------------------------
+        This method maintains the EDI directories of the partners
+        linked to the given subscriptions. Writes coming from the
+        partner itself are skipped, the partner handles those.
+        --------------------------------------------------------- '''
+        if context and context.get('edi_partner_write'):
+            return True
+        partner_db = self.pool.get('res.partner')
+        partner_ids = list(set([x['partnerflow_id'][0] for x in self.read(cr, uid, ids, ['partnerflow_id'], context=context) if x['partnerflow_id']]))
+        partner_db.maintain_edi_directories(cr, uid, partner_ids, context)
+        partner_db.update_partner_overview_file(cr, uid, context)
+        return True
+
+    def unlink(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.partnerflow:unlink()
+        -----------------------------------------
+        This method overwrites the standard OpenERP unlink() method
+        to make sure the cached subscriptions are invalidated.
+        ----------------------------------------------------------- '''
+        result = super(clubit_tools_edi_partnerflow, self).unlink(cr, uid, ids, context=context)
+        self.subscriptions_changed(cr)
+        return result
+
+    def subscriptions_changed(self, cr):
+        ''' clubit.tools.edi.partnerflow:subscriptions_changed()
+        --------------------------------------------------------
+        This method invalidates the cached subscriptions. The cache
+        isn't transactional, so the cursor that made the change stops
+        using it: what it reads might still be rolled back.
+        ------------------------------------------------------------- '''
+        cr.edi_subscriptions_changed = True
+        self.clear_caches()
+        return True
+
+    def get_subscriptions(self, cr, uid, partner_id):
+        ''' clubit.tools.edi.partnerflow:get_subscriptions()
+        ----------------------------------------------------
+        This method returns the subscriptions of a partner as a
+        dictionary of flow_id: (subscription id, active). The result
+        is cached until a subscription is created, changed or removed,
+        except for cursors that changed subscriptions themselves.
+        Don't modify the dictionary, it is shared between callers.
+        -------------------------------------------------------------- '''
+        if getattr(cr, 'edi_subscriptions_changed', False):
+            return self._read_subscriptions(cr, uid, partner_id)
+        return self._cached_subscriptions(cr, uid, partner_id)
+
+    @tools.ormcache(skiparg=3)
+    def _cached_subscriptions(self, cr, uid, partner_id):
+        return self._read_subscriptions(cr, uid, partner_id)
+
+    def _read_subscriptions(self, cr, uid, partner_id):
+        cr.execute('SELECT flow_id, id, partnerflow_active FROM ' + self._table + ' WHERE partnerflow_id = %s', (partner_id,))
+        return dict((flow_id, (id, bool(active))) for flow_id, id, active in cr.fetchall())
+
 ##############################################################################
 #
 #    clubit.tools.edi.partner
@@ -102,26 +251,48 @@ class res_partner(osv.Model):
         'edi_flows': fields.one2many('clubit.tools.edi.partnerflow', 'partnerflow_id', 'EDI Flows', readonly=False),
     }
 
+    # Only changes to these fields can require new EDI directories
+    _edi_directory_fields = ['edi_relevant', 'edi_flows']
+
     def create(self, cr, uid, vals, context=None):
         ''' res.partner:create()
         ------------------------
         This method overwrites the standard OpenERP create() method to make
         sure all required EDI directories are created.
         ------------------------------------------------------------------- '''
-        new_id = super(res_partner, self).create(cr, uid, vals, context=context)
-        self.maintain_edi_directories(cr, uid, [new_id], context)
-        self.update_partner_overview_file(cr, uid, context)
+        ctx = dict(context or {}, edi_partner_write=True)
+        new_id = super(res_partner, self).create(cr, uid, vals, context=ctx)
+        if vals.get('edi_relevant'):
+            self.maintain_edi_directories(cr, uid, [new_id], context)
+            self.update_partner_overview_file(cr, uid, context)
         return new_id
 
     def write(self, cr, uid, ids, vals, context=None):
         ''' res.partner:write()
         -----------------------
         This method overwrites the standard OpenERP write() method to make
-        sure all required EDI directories are created.
+        sure all required EDI directories are created. This only happens
+        when the write actually touches the EDI configuration.
         ------------------------------------------------------------------ '''
-        result = super(res_partner, self).write(cr, uid, ids, vals, context=context)
-        self.maintain_edi_directories(cr, uid, ids, context)
-        self.update_partner_overview_file(cr, uid, context)
+        ctx = dict(context or {}, edi_partner_write=True)
+        result = super(res_partner, self).write(cr, uid, ids, vals, context=ctx)
+        edi_change = [x for x in self._edi_directory_fields if x in vals]
+        if edi_change:
+            if isinstance(ids, (int, long)): ids = [ids]
+            self.maintain_edi_directories(cr, uid, ids, context)
+        if edi_change or 'name' in vals:
+            self.update_partner_overview_file(cr, uid, context)
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        ''' res.partner:unlink()
+        ------------------------
+        This method overwrites the standard OpenERP unlink() method.
+        The subscriptions of the partners are removed by the database
+        cascade, so the cached subscriptions are invalidated here.
+        ------------------------------------------------------------- '''
+        result = super(res_partner, self).unlink(cr, uid, ids, context=context)
+        self.pool.get('clubit.tools.edi.partnerflow').subscriptions_changed(cr)
         return result
 
     def maintain_edi_directories(self, cr, uid, ids, context=None):
@@ -135,38 +306,36 @@ class res_partner(osv.Model):
         _logger.debug('Maintaining the EDI directories')
         _logger.debug('The present working directory is: {!s}'.format(getcwd()))
 
-        # Only process partners that are EDI relevant
-        # -------------------------------------------
+        # Only process partners that are EDI relevant, and collect
+        # the deepest directories required, makedirs() takes care
+        # of all the parent directories.
+        # ---------------------------------------------------------
+        directories = []
         for partner in self.browse(cr, uid, ids, context=context):
             if not partner.edi_relevant:
                 continue
             _logger.debug("Processing partner %d (%s)", partner.id, partner.name)
 
-            # Find and/or create the root directory for this partner
-            # ------------------------------------------------------
             root_path = join(_directory_edi_base, cr.dbname, str(partner.id))
-            if not path.exists(root_path):
-                _logger.debug('Required directory missing, attempting to create: {!s}'.format(root_path))
-                makedirs(root_path)
-
-
+            if not partner.edi_flows:
+                directories.append(root_path)
 
             # Loop over all the EDI Flows this partner is subscribed to
-            # and make sure all the necessary sub folders exist.
-            # ---------------------------------------------------------
+            # and make sure all the necessary sub folders exist. Incoming
+            # flows get extra folders to help the system keep track.
+            # -----------------------------------------------------------
             for flow in partner.edi_flows:
                 sub_path = join(root_path, str(flow.flow_id.id))
-                if not path.exists(sub_path):
-                    _logger.debug('Required directory missing, attempting to create: {!s}'.format(sub_path))
-                    makedirs(sub_path)
-
-
-                # Create folders to help the system keep track
-                # --------------------------------------------
                 if flow.flow_id.direction == 'in':
-                    _logger.debug("Creating directories imported and archived for incoming edi documents")
-                    if not path.exists(join(sub_path, 'imported')):   makedirs(join(sub_path, 'imported'))
-                    if not path.exists(join(sub_path, 'archived')):   makedirs(join(sub_path, 'archived'))
+                    directories.append(join(sub_path, 'imported'))
+                    directories.append(join(sub_path, 'archived'))
+                else:
+                    directories.append(sub_path)
+
+        # Create everything that's missing in one go
+        # ------------------------------------------
+        ensure_directories(cr.dbname, directories)
+        return True
 
     def update_partner_overview_file(self, cr, uid, context):
         ''' res.partner:update_partner_overview_file()
@@ -202,25 +371,31 @@ class res_partner(osv.Model):
         if not path.exists(join(_directory_edi_base, cr.dbname)): makedirs(join(_directory_edi_base, cr.dbname))
         file_path = join(_directory_edi_base, cr.dbname, "partners.edi")
         _logger.debug('Attempting to look up the partner file at: {!s}'.format(file_path))
-        f = open(file_path ,"w")
-        f.write(content)
-        f.close()
+        write_file(file_path, content, sync=False)
 
     def listen_to_edi_flow(self, cr, uid, partner_id, flow_id):
         ''' res.partner:listen_to_edi_flow()
         ------------------------------------
-        This method adds an EDI flow to a partner.
-        ------------------------------------------ '''
+        This method adds an EDI flow to a partner. Nothing is
+        written if the partner is already listening to the flow.
+        ------------------------------------------------------- '''
         if not partner_id or not flow_id: return False
 
-        partner = self.browse(cr, uid, partner_id)
-        exists = [flow for flow in partner.edi_flows if flow.flow_id.id == flow_id]
-        if exists:
-            vals = {'edi_flows': [[1, exists[0].id, {'partnerflow_active': True, 'flow_id': flow_id}]]}
-            return self.write(cr, uid, [partner_id], vals)
-        else:
-            vals = {'edi_flows': [[0, False, {'partnerflow_active': True, 'flow_id': flow_id}]]}
-            return self.write(cr, uid, [partner_id], vals)
+        partnerflow_db = self.pool.get('clubit.tools.edi.partnerflow')
+        subscription = partnerflow_db.get_subscriptions(cr, uid, partner_id).get(flow_id)
+        if subscription and subscription[1]:
+            return True
+
+        # Only change anything based on what's actually in the database,
+        # the cache might not have caught up with another transaction yet
+        # ----------------------------------------------------------------
+        subscription = partnerflow_db._read_subscriptions(cr, uid, partner_id).get(flow_id)
+        if subscription and subscription[1]:
+            return True
+        if subscription:
+            return partnerflow_db.write(cr, uid, [subscription[0]], {'partnerflow_active': True})
+        partnerflow_db.create(cr, uid, {'partnerflow_id': partner_id, 'flow_id': flow_id, 'partnerflow_active': True})
+        return True
 
 
     def is_listening_to_flow(self, cr, uid, partner_id, flow_id):
@@ -231,12 +406,124 @@ class res_partner(osv.Model):
         ------------------------------------------ '''
         if not partner_id or not flow_id: return False
 
-        partner = self.browse(cr, uid, partner_id)
-        if not partner.edi_relevant: return False
-        exists = next(flow for flow in partner.edi_flows if flow.flow_id.id == flow_id)
-        if exists and exists.partnerflow_active:
+        partner = self.read(cr, uid, partner_id, ['edi_relevant'])
+        if not partner['edi_relevant']: return False
+        subscription = self.pool.get('clubit.tools.edi.partnerflow').get_subscriptions(cr, uid, partner_id).get(flow_id)
+        return bool(subscription and subscription[1])
+
+##############################################################################
+#
+#    clubit.tools.edi.blob
+#
+#    The Blob class stores the actual payload of EDI documents, addressed
+#    by the hash of its content. Documents with identical content share
+#    a single blob, which keeps track of how many documents refer to it.
+#    Blobs are maintained directly through SQL given their volume.
+#
+##############################################################################
+class clubit_tools_edi_blob(osv.Model):
+    _name = "clubit.tools.edi.blob"
+    _description = "EDI Payload"
+    _rec_name = "hash"
+    _log_access = False
+    _columns = {
+        'hash' : fields.char('Hash', size=64, required=True, readonly=True),
+        'content' : fields.text('Content', readonly=True),
+        'content_compressed' : fields.binary('Compressed Content', readonly=True),
+        'refcount' : fields.integer('References', readonly=True),
+    }
+
+    _sql_constraints = [
+        ('hash_uniq', 'unique(hash)', 'Every payload can only be stored once.'),
+    ]
+
+    def acquire(self, cr, uid, content, count=1):
+        ''' clubit.tools.edi.blob:acquire()
+        -----------------------------------
+        This method returns the blob holding the given content,
+        creating it if needed, and adds the given number of
+        references to it. It returns the id and the hash.
+
+        Blobs are shared between transactions. When another
+        transaction inserted or changed the same blob after our
+        snapshot was taken, a TransactionRollbackError is raised.
+        The RPC layer retries those, scheduled callers have to
+        roll back to a savepoint and try again in a later run.
+        ------------------------------------------------------- '''
+
+        key = content_hash(content)
+        cr.execute('UPDATE clubit_tools_edi_blob SET refcount = refcount + %s WHERE hash = %s RETURNING id', (count, key))
+        row = cr.fetchone()
+        if row:
+            return row[0], key
+
+        # A concurrent transaction can insert the same payload,
+        # in which case we simply reference that one instead.
+        # -----------------------------------------------------
+        cr.execute('INSERT INTO clubit_tools_edi_blob (hash, content, refcount) VALUES (%s, %s, %s) '
+                   'ON CONFLICT (hash) DO UPDATE SET refcount = clubit_tools_edi_blob.refcount + EXCLUDED.refcount RETURNING id',
+                   (key, content, count))
+        return cr.fetchone()[0], key
+
+    def release(self, cr, uid, ids):
+        ''' clubit.tools.edi.blob:release()
+        -----------------------------------
+        This method drops one reference for every occurrence of a
+        blob id in the given list. Blobs that are no longer
+        referenced are deleted.
+        --------------------------------------------------------- '''
+
+        counts = {}
+        for blob_id in ids:
+            if blob_id: counts[blob_id] = counts.get(blob_id, 0) + 1
+        return self.release_counts(cr, uid, counts)
+
+    def release_counts(self, cr, uid, counts):
+        ''' clubit.tools.edi.blob:release_counts()
+        ------------------------------------------
+        This method drops the given number of references for
+        each blob in a {blob_id: count} dictionary. Blobs that
+        are no longer referenced are deleted.
+        ------------------------------------------------------ '''
+
+        if not counts:
             return True
-        return False
+        for blob_id, count in counts.items():
+            cr.execute('UPDATE clubit_tools_edi_blob SET refcount = refcount - %s WHERE id = %s', (count, blob_id))
+        cr.execute('DELETE FROM clubit_tools_edi_blob WHERE id IN %s AND refcount <= 0', (tuple(counts.keys()),))
+        return True
+
+    def compress(self, cr, uid, ids):
+        ''' clubit.tools.edi.blob:compress()
+        ------------------------------------
+        This method moves the content of the given blobs to their
+        zlib compressed column.
+        --------------------------------------------------------- '''
+
+        if not ids:
+            return True
+        cr.execute('SELECT id, content FROM clubit_tools_edi_blob WHERE id IN %s AND content IS NOT NULL', (tuple(ids),))
+        for blob_id, content in cr.fetchall():
+            packed = zlib.compress(content.encode('utf8'), 9)
+            cr.execute('UPDATE clubit_tools_edi_blob SET content = NULL, content_compressed = %s WHERE id = %s', (psycopg2.Binary(packed), blob_id))
+        return True
+
+    def get_contents(self, cr, uid, ids):
+        ''' clubit.tools.edi.blob:get_contents()
+        ----------------------------------------
+        This method returns a dictionary with the (decompressed)
+        content of each of the given blobs.
+        -------------------------------------------------------- '''
+
+        if not ids:
+            return {}
+        cr.execute('SELECT id, content, content_compressed FROM clubit_tools_edi_blob WHERE id IN %s', (tuple(ids),))
+        result = {}
+        for blob_id, content, packed in cr.fetchall():
+            if content is None and packed is not None:
+                content = zlib.decompress(str(packed)).decode('utf8')
+            result[blob_id] = content
+        return result
 
 ##############################################################################
 #
@@ -258,12 +545,27 @@ class clubit_tools_edi_document(osv.Model):
     def _function_message_get(self, cr, uid, ids, field, arg, context=None):
         ''' clubit.tools.edi.document:_function_message_get()
         -----------------------------------------------------
-        This method helps to dynamically calculate the
-        message field to always show the latest OpenChatter message body.
-        ----------------------------------------------------------------- '''
+        This method helps to dynamically calculate the message field to
+        always show the latest event, either from the document history
+        or the latest OpenChatter message body.
+        ------------------------------------------------------------------ '''
         res = dict.fromkeys(ids, False)
-        for document in self.browse(cr, uid, ids, context=context):
-            res[document.id] = re.sub('<[^<]+?>', '',document.message_ids[0].body)
+        if not ids: return res
+
+        # Fetch the latest event and message of all documents at
+        # once, the list view asks for this field on every row
+        # -------------------------------------------------------
+        latest = {}
+        cr.execute('SELECT DISTINCT ON (document_id) document_id, date, text FROM clubit_tools_edi_document_history '
+                   'WHERE document_model = %s AND document_id IN %s AND text IS NOT NULL ORDER BY document_id, id DESC', (self._name, tuple(ids)))
+        for doc_id, date, text in cr.fetchall():
+            latest[doc_id] = (date, text)
+        cr.execute('SELECT DISTINCT ON (res_id) res_id, date, body FROM mail_message WHERE model = %s AND res_id IN %s ORDER BY res_id, id DESC', (self._name, tuple(ids)))
+        for res_id, date, body in cr.fetchall():
+            if res_id not in latest or str(date) >= str(latest[res_id][0]):
+                latest[res_id] = (date, re.sub('<[^<]+?>', '', body or ''))
+        for doc_id, (date, text) in latest.items():
+            res[doc_id] = text
         return res
 
     _columns = {
@@ -280,9 +582,346 @@ class clubit_tools_edi_document(osv.Model):
                                    ('processed', 'Processed'),
                                    ('archived', 'Archived')], 'State', required=True, readonly=True),
         'content' : fields.text('Content',readonly=True, states={'new': [('readonly', False)], 'in_error': [('readonly', False)]}),
+        'content_hash' : fields.char('Content Hash', size=64, readonly=True, select=True),
+        'file_hash' : fields.char('File Hash', size=64, readonly=True, help="Hash of the content as it was written to disk."),
+        'blob_id' : fields.many2one('clubit.tools.edi.blob', 'Payload', readonly=True, ondelete='set null'),
+        'file_compressed' : fields.boolean('File Compressed', readonly=True),
+        'file_purged' : fields.boolean('File Purged', readonly=True),
         'create_date':fields.datetime('Creation date'),
     }
 
+    # Browsing a document shouldn't drag its content along, large
+    # payloads are only loaded when the content is actually used
+    _columns['content']._prefetch = False
+
+    def _table_exist(self, cr):
+        ''' clubit.tools.edi.document:_table_exist()
+        --------------------------------------------
+        This method overwrites the standard OpenERP _table_exist()
+        method, which doesn't recognize partitioned tables. Without
+        this a module update would try to create the table again.
+        ----------------------------------------------------------- '''
+        cr.execute("SELECT relname FROM pg_class WHERE relkind IN ('r', 'v', 'p') AND relname = %s", (self._table,))
+        return cr.rowcount
+
+    def _auto_init(self, cr, context=None):
+        result = super(clubit_tools_edi_document, self)._auto_init(cr, context=context)
+        index = self._table + '_partner_flow_name_index'
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", (index,))
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX "%s" ON "%s" (partner_id, flow_id, name)' % (index, self._table))
+        self._migrate_compressed_content(cr)
+        return result
+
+    def _migrate_compressed_content(self, cr):
+        ''' clubit.tools.edi.document:_migrate_compressed_content()
+        -----------------------------------------------------------
+        Before payloads were stored in blobs, archived documents kept
+        their compressed content in a column of their own. This method
+        moves that content into blobs and drops the old column.
+        --------------------------------------------------------------- '''
+        cr.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'content_compressed'", (self._table,))
+        if not cr.fetchone():
+            return True
+
+        blob_db = self.pool.get('clubit.tools.edi.blob')
+        cr.execute('SELECT id, content_compressed FROM "' + self._table + '" WHERE content_compressed IS NOT NULL AND blob_id IS NULL')
+        rows = cr.fetchall()
+        blob_ids = set()
+        for doc_id, packed in rows:
+            content = zlib.decompress(str(packed)).decode('utf8')
+            blob_id, key = blob_db.acquire(cr, SUPERUSER_ID, content)
+            cr.execute('UPDATE "' + self._table + '" SET content = NULL, blob_id = %s, content_hash = %s WHERE id = %s', (blob_id, key, doc_id))
+            blob_ids.add(blob_id)
+        blob_db.compress(cr, SUPERUSER_ID, list(blob_ids))
+        cr.execute('ALTER TABLE "' + self._table + '" DROP COLUMN content_compressed')
+        _logger.info("Moved %d compressed documents of %s into blobs", len(rows), self._table)
+        return True
+
+    def read(self, cr, uid, ids, fields=None, context=None, load='_classic_read'):
+        ''' clubit.tools.edi.document:read()
+        ------------------------------------
+        This method overwrites the standard OpenERP read() method so
+        the content stored in (compressed) blobs is transparently
+        returned as the content of the document.
+        ------------------------------------------------------------ '''
+        result = super(clubit_tools_edi_document, self).read(cr, uid, ids, fields, context=context, load=load)
+        if fields and 'content' not in fields:
+            return result
+
+        records = isinstance(result, list) and result or [result]
+        stored = [x['id'] for x in records if x and not x.get('content')]
+        if not stored:
+            return result
+
+        cr.execute('SELECT id, blob_id FROM ' + self._table + ' WHERE id IN %s AND blob_id IS NOT NULL', (tuple(stored),))
+        blobs = dict(cr.fetchall())
+        contents = self.pool.get('clubit.tools.edi.blob').get_contents(cr, uid, list(set(blobs.values())))
+        for record in records:
+            if record and record['id'] in blobs:
+                record['content'] = contents.get(blobs[record['id']])
+        return result
+
+    def create(self, cr, uid, vals, context=None):
+        ''' clubit.tools.edi.document:create()
+        --------------------------------------
+        This method overwrites the standard OpenERP create() method to
+        store the content in a blob shared by all identical payloads.
+        -------------------------------------------------------------- '''
+        if vals.get('content'):
+            blob_id, key = self.pool.get('clubit.tools.edi.blob').acquire(cr, uid, vals['content'])
+            vals = dict(vals, content=False, blob_id=blob_id, content_hash=key)
+            vals.setdefault('file_hash', key)
+        return super(clubit_tools_edi_document, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        ''' clubit.tools.edi.document:write()
+        -------------------------------------
+        This method overwrites the standard OpenERP write() method to
+        move new content into a blob and release the previous one.
+        ------------------------------------------------------------- '''
+        if 'content' in vals:
+            if isinstance(ids, (int, long)): ids = [ids]
+            blob_db = self.pool.get('clubit.tools.edi.blob')
+            cr.execute('SELECT blob_id FROM ' + self._table + ' WHERE id IN %s', (tuple(ids),))
+            previous = [x[0] for x in cr.fetchall()]
+            if vals['content']:
+                blob_id, key = blob_db.acquire(cr, uid, vals['content'], len(ids))
+                vals = dict(vals, content=False, blob_id=blob_id, content_hash=key)
+            else:
+                vals = dict(vals, blob_id=False, content_hash=False)
+            blob_db.release(cr, uid, previous)
+        return super(clubit_tools_edi_document, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.document:unlink()
+        --------------------------------------
+        This method overwrites the standard OpenERP unlink() method
+        to release the blobs of the deleted documents.
+        ----------------------------------------------------------- '''
+        if isinstance(ids, (int, long)): ids = [ids]
+        if ids:
+            cr.execute('SELECT blob_id FROM ' + self._table + ' WHERE id IN %s', (tuple(ids),))
+            previous = [x[0] for x in cr.fetchall()]
+            self.pool.get('clubit.tools.edi.blob').release(cr, uid, previous)
+            self.pool.get('clubit.tools.edi.document.history').forget(cr, uid, self._name, ids)
+            self.pool.get('clubit.tools.edi.profile').forget(cr, uid, self._name, ids)
+        return super(clubit_tools_edi_document, self).unlink(cr, uid, ids, context=context)
+
+    def _log_event(self, cr, uid, ids, code, text=None, to_state=None, error=False, from_states=None):
+        ''' clubit.tools.edi.document:_log_event()
+        ------------------------------------------
+        This method records an automated event for the given documents
+        in the document history, all of them with a single insert. Call
+        it before writing the new state, the current state is recorded
+        as the state the documents came from unless from_states maps
+        them otherwise. The text is posted in the chatter as well if
+        the chatter policy of the flow asks for it.
+        --------------------------------------------------------------- '''
+        if isinstance(ids, (int, long)): ids = [ids]
+        if not ids: return True
+
+        cr.execute('SELECT d.id, d.flow_id, d.state, f.chatter_policy FROM ' + self._table + ' d '
+                   'LEFT JOIN clubit_tools_edi_flow f ON f.id = d.flow_id WHERE d.id IN %s', (tuple(ids),))
+        events = []
+        chatter = []
+        for doc_id, flow_id, state, policy in cr.fetchall():
+            if from_states: state = from_states.get(doc_id, state)
+            events.append((self._name, doc_id, flow_id, state, to_state or state, code, text, error))
+            if text and (policy == 'all' or (policy != 'none' and error)):
+                chatter.append(doc_id)
+        self.pool.get('clubit.tools.edi.document.history').log(cr, uid, events)
+        for doc_id in chatter:
+            self.message_post(cr, uid, doc_id, body=text)
+        return True
+
+    def _lock_documents(self, cr, uid, ids, states):
+        ''' clubit.tools.edi.document:_lock_documents()
+        -----------------------------------------------
+        This method locks the given documents that are still in one
+        of the given states and returns their ids. Our snapshot can't
+        see what other nodes committed after it was taken, so rather
+        than trusting the state we read, documents another node is
+        working on or has changed in the meantime are skipped.
+        ------------------------------------------------------------- '''
+        if not ids: return []
+
+        cr.execute('SAVEPOINT edi_lock_documents')
+        try:
+            cr.execute('SELECT id FROM ' + self._table + ' WHERE id IN %s AND state IN %s ORDER BY id FOR UPDATE SKIP LOCKED',
+                       (tuple(ids), tuple(states)))
+            locked = [x[0] for x in cr.fetchall()]
+            cr.execute('RELEASE SAVEPOINT edi_lock_documents')
+            return locked
+        except psycopg2.extensions.TransactionRollbackError:
+            cr.execute('ROLLBACK TO SAVEPOINT edi_lock_documents')
+
+        # Some of them were changed by another node since our
+        # snapshot, lock them one by one to find out which ones
+        # -----------------------------------------------------
+        if len(ids) == 1: return []
+        locked = []
+        for doc_id in ids:
+            locked.extend(self._lock_documents(cr, uid, [doc_id], states))
+        return locked
+
+    def find_identical(self, cr, uid, partner_id, flow_id, content, context=None):
+        ''' clubit.tools.edi.document:find_identical()
+        ----------------------------------------------
+        This method returns the documents of a partner/flow that
+        have exactly the given content, using the content hash
+        index rather than comparing the payloads themselves.
+        -------------------------------------------------------- '''
+        return self.search(cr, uid, [('content_hash', '=', content_hash(content)),
+                                     ('partner_id', '=', partner_id),
+                                     ('flow_id', '=', flow_id)], context=context)
+
+    def find_imported(self, cr, uid, partner_id, flow_id, names, context=None):
+        ''' clubit.tools.edi.document:find_imported()
+        ---------------------------------------------
+        This method returns the subset of the given file names
+        that already exist as documents for a partner/flow. The
+        names are looked up in chunks rather than one by one.
+        ------------------------------------------------------- '''
+        found = set()
+        for i in xrange(0, len(names), 1000):
+            cr.execute('SELECT name FROM ' + self._table + ' WHERE partner_id = %s AND flow_id = %s AND name IN %s',
+                       (partner_id, flow_id, tuple(names[i:i + 1000])))
+            for name, in cr.fetchall():
+                found.add(isinstance(name, unicode) and name.encode('utf8') or name)
+        return found
+
+    def compress_documents(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.document:compress_documents()
+        --------------------------------------------------
+        This method moves documents to cold storage. The content is
+        compressed in the database and the file on disk is replaced
+        by a gzip compressed copy. Reading the content keeps working
+        as before.
+        ------------------------------------------------------------ '''
+
+        blob_db = self.pool.get('clubit.tools.edi.blob')
+        blob_ids = []
+        for document in self.browse(cr, uid, ids, context=context):
+
+            # Documents from before blobs existed still carry their
+            # content inline, these are moved into a blob first.
+            # -----------------------------------------------------
+            if document.blob_id:
+                blob_ids.append(document.blob_id.id)
+            elif document.content:
+                blob_id, key = blob_db.acquire(cr, uid, document.content)
+                cr.execute('UPDATE ' + self._table + ' SET content = NULL, blob_id = %s, content_hash = %s WHERE id = %s', (blob_id, key, document.id))
+                blob_ids.append(blob_id)
+
+            if not document.file_compressed and isfile(join(document.location, document.name)):
+                try:
+                    compress_file(join(document.location, document.name))
+                    cr.execute('UPDATE ' + self._table + ' SET file_compressed = True WHERE id = %s', (document.id,))
+                except Exception as e:
+                    _logger.warning("Compressing the file of edi document %d failed: %s", document.id, str(e))
+
+        blob_db.compress(cr, uid, list(set(blob_ids)))
+        return True
+
+    # Only documents in these states are subject to the retention policy
+    _retention_states = ('processed', 'archived')
+
+    def purge_documents(self, cr, uid, context=None):
+        ''' clubit.tools.edi.document:purge_documents()
+        -----------------------------------------------
+        This method enforces the retention policy of every flow
+        for this type of documents. Files and database records
+        are purged separately, according to their own policy.
+        ------------------------------------------------------- '''
+
+        flow_db = self.pool.get('clubit.tools.edi.flow')
+        flow_ids = flow_db.search(cr, uid, ['|', ('retention_db_days', '>', 0), ('retention_disk_days', '>', 0)], context=context)
+        for flow in flow_db.browse(cr, uid, flow_ids, context=context):
+            if flow.retention_disk_days:
+                self._purge_files(cr, uid, flow.id, flow.retention_disk_days)
+            if flow.retention_db_days:
+                self._purge_records(cr, uid, flow.id, flow.retention_db_days)
+        return True
+
+    def _purge_files(self, cr, uid, flow_id, days, batch_size=500):
+        ''' clubit.tools.edi.document:_purge_files()
+        --------------------------------------------
+        This method deletes the files of documents that passed
+        the disk retention of their flow. Documents are handled
+        in batches, each of them committed separately. A file
+        that can't be removed is tried again on the next run.
+        ------------------------------------------------------- '''
+
+        limit = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        last_id = 0
+        while True:
+            cr.execute('SELECT id, location, name, file_compressed FROM ' + self._table + ' '
+                       'WHERE flow_id = %s AND state IN %s AND write_date < %s AND file_purged IS NOT TRUE AND id > %s ORDER BY id LIMIT %s',
+                       (flow_id, self._retention_states, limit, last_id, batch_size))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            _logger.debug('RETENTION: Purging %d files for flow %d', len(rows), flow_id)
+            purged = []
+            for doc_id, location, name, compressed in rows:
+                try:
+                    remove_file(join(location, compressed and name + '.gz' or name))
+                except OSError as e:
+                    _logger.warning("Purging the file of edi document %d failed: %s", doc_id, str(e))
+                    continue
+                purged.append(doc_id)
+            if purged:
+                cr.execute('UPDATE ' + self._table + ' SET file_purged = True WHERE id IN %s', (tuple(purged),))
+            cr.commit()
+        return True
+
+    def _purge_records(self, cr, uid, flow_id, days, batch_size=500):
+        ''' clubit.tools.edi.document:_purge_records()
+        ----------------------------------------------
+        This method deletes documents that passed the database
+        retention of their flow, together with their chatter
+        messages and their files. Every batch is committed before
+        its files are removed, so a rollback never leaves a
+        document without its file.
+        --------------------------------------------------------- '''
+
+        limit = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        while True:
+            cr.execute('SELECT id, location, name, file_compressed FROM ' + self._table + ' '
+                       'WHERE flow_id = %s AND state IN %s AND write_date < %s ORDER BY id LIMIT %s',
+                       (flow_id, self._retention_states, limit, batch_size))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            ids = [x[0] for x in rows]
+            _logger.debug('RETENTION: Purging %d documents for flow %d', len(ids), flow_id)
+
+            # Chatter messages are removed in bulk, going through the
+            # ORM for each of them is way too slow at this volume.
+            # -------------------------------------------------------
+            cr.execute('DELETE FROM mail_message WHERE model = %s AND res_id IN %s', (self._name, tuple(ids)))
+            self.unlink(cr, uid, ids)
+            cr.commit()
+
+            for doc_id, location, name, compressed in rows:
+                try:
+                    remove_file(join(location, compressed and name + '.gz' or name))
+                except OSError as e:
+                    _logger.warning("Purging the file of edi document %d failed: %s", doc_id, str(e))
+        return True
+
+    def _file_name(self, document):
+        ''' clubit.tools.edi.document:_file_name()
+        ------------------------------------------
+        This method returns the name of the document's file
+        on disk, which differs from its name when compressed.
+        ----------------------------------------------------- '''
+        if document.file_compressed:
+            return document.name + '.gz'
+        return document.name
+
     #def unlink(self, cr, uid, ids, context=None):
     #    ''' clubit.tools.edi.document:unlink()
     #    --------------------------------------
@@ -304,7 +943,7 @@ class clubit_tools_edi_document(osv.Model):
         ------------------------------------------------------------ '''
 
         document = self.browse(cr, uid, doc_id, context=context)
-        return isfile(join(document.location, document.name))
+        return isfile(join(document.location, self._file_name(document)))
 
     def move(self, cr, uid, doc_id, to_folder, context):
         ''' clubit.tools.edi.document:move()
@@ -313,138 +952,260 @@ class clubit_tools_edi_document(osv.Model):
         given state to another.
         ---------------------------------------- '''
 
-        # Before we try to move the file, check if
-        # its still there and everything is ok
-        # ----------------------------------------
-        if not self.check_location(cr, uid, doc_id, context ):
-            _logger.debug("File for edi document %d is not at the location we expect it to be. Aborting", doc_id)
-            return False
-
-        # The moving of files should be allowed so let's carry on!
-        # --------------------------------------------------------
+        # The destination depends on the directory layout of the flow
+        # ------------------------------------------------------------
         document = self.browse(cr, uid, doc_id, context=context)
-        from_path = join(document.location, document.name)
-        to_path   = False
-
-
-        # Specialized path determination for state:new, given
-        # that the file isn't part of the directory structure yet
-        # -------------------------------------------------------
-        if document.state == 'new':
-            to_path = join(document.location, to_folder, document.name)
-
-        # Path determination for archiving
-        # --------------------------------
-        else:
-            path, dummy = split(document.location)
-            to_path = join(path, to_folder, document.name)
+        from_path = join(document.location, self._file_name(document))
+        to_path   = join(self._document_directory(cr, uid, document, to_folder), self._file_name(document))
 
         _logger.debug("Moving document with id %d (%s)from folder %s to folder %s", document.id, document.name, from_path, to_path)
 
-        # Make sure the file doesn't exist already
-        # at the to_path location
-        # ----------------------------------------
-        #if isfile(to_path):
-        #    self.message_post(cr, uid, document.id, body='Could not move file, it already exists at the destination folder.')
-        #    return {'error' : self._error_file_already_exists_at_destination}
-
-
-        # Actually try to move the file using shutil.move()
-        # This step also includes serious error handling to validate
-        # the file was actually moved so we can catch a corrupted document
-        # ----------------------------------------------------------------
+        # Actually try to move the file. A rename either fully happens
+        # or not at all, so its outcome is all the validation we need.
+        # If the file isn't where we expect it to be, we abort.
+        # ------------------------------------------------------------
         try:
-            move(from_path, to_path)
-            _logger.debug("Move file successful")
+            with timed(cr.dbname, 'move', document.flow_id.id, document.partner_id.id):
+                moved = move_file(from_path, to_path)
         except Exception:
-            self.message_post(cr, uid, document.id, body='An unknown error occurred during the moving of the file.')
-            return {'error' : self._error_file_move_failed}
-
-        # Check if the move actually took place
-        # -------------------------------------
-        if isfile(join(document.location, document.name)):
-            self.message_post(cr, uid, document.id, body='File moving failed, it is still present at the starting location.')
-            return {'error' : self._error_file_move_failed}
-        elif isfile(to_path) == False:
-            self.message_post(cr, uid, document.id, body='File moving failed, it is not present at the target location.')
+            self._log_event(cr, uid, [document.id], 'move_failed', 'An unknown error occurred during the moving of the file.', error=True)
             return {'error' : self._error_file_move_failed}
+        if not moved:
+            _logger.debug("File for edi document %d is not at the location we expect it to be. Aborting", doc_id)
+            return False
 
+        _logger.debug("Move file successful")
         path, dummy = split(to_path)
         self.write(cr, uid, document.id, {'location' : path}, context)
         return True
 
-    def position_document(self, cr, uid, partner_id, flow_id, content, content_type='json'):
+    def move_bulk(self, cr, uid, ids, to_folder, context=None):
+        ''' clubit.tools.edi.document:move_bulk()
+        -----------------------------------------
+        This method moves the files of many documents at once. The
+        documents are read in one go and their new locations are
+        written with one write per destination directory. It returns
+        the ids of the documents that were actually moved.
+        ------------------------------------------------------------ '''
+
+        destinations = {}
+        for document in self.browse(cr, uid, ids, context=context):
+            from_path = join(document.location, self._file_name(document))
+            directory = self._document_directory(cr, uid, document, to_folder)
+            try:
+                moved = move_file(from_path, join(directory, self._file_name(document)))
+            except Exception:
+                self._log_event(cr, uid, [document.id], 'move_failed', 'An unknown error occurred during the moving of the file.', error=True)
+                continue
+            if not moved:
+                _logger.debug("File for edi document %d is not at the location we expect it to be. Skipping", document.id)
+                continue
+            destinations.setdefault(directory, []).append(document.id)
+
+        for directory, doc_ids in destinations.items():
+            self.write(cr, uid, doc_ids, {'location' : directory}, context)
+        return [x for doc_ids in destinations.values() for x in doc_ids]
+
+    def _storage_directory(self, cr, uid, partner_id, flow, name, folder, date=None):
+        ''' clubit.tools.edi.document:_storage_directory()
+        --------------------------------------------------
+        This method determines the directory a file belongs in for
+        a given folder (imported, archived), taking the directory
+        layout of the flow into account. The directory is created
+        if it doesn't exist yet.
+        ---------------------------------------------------------- '''
+
+        folders = [_directory_edi_base, cr.dbname, str(partner_id), str(flow.id), folder]
+        folders += shard_folders(flow.directory_layout, name, date or datetime.datetime.utcnow())
+        directory = join(*folders)
+        ensure_directories(cr.dbname, [directory])
+        return directory
+
+    def _document_directory(self, cr, uid, document, folder):
+        ''' clubit.tools.edi.document:_document_directory()
+        ---------------------------------------------------
+        This method determines the directory an existing document
+        belongs in. Date based layouts use the creation date so a
+        document always ends up in the same sub folders.
+        --------------------------------------------------------- '''
+
+        date = document.create_date and datetime.datetime.strptime(document.create_date[:10], '%Y-%m-%d') or None
+        return self._storage_directory(cr, uid, document.partner_id.id, document.flow_id, document.name, folder, date)
+
+    def _staged_file(self, file_path, context=None, exclusive=False):
+        ''' clubit.tools.edi.document:_staged_file()
+        --------------------------------------------
+        This method returns the staged file to write a file produced
+        by the framework through. Files only show up under their
+        final name once complete. If a batch is provided in the
+        context, the file is published when that batch commits.
+        An exclusive file never replaces an existing one. Within a
+        batch it only finds out its name is taken at commit, so
+        writers that retry on EEXIST must not use a batch.
+        ------------------------------------------------------------ '''
+        batch = context and context.get('edi_staged_batch')
+        if batch:
+            return batch.staged_file(file_path, exclusive)
+        return staged_file(file_path, exclusive=exclusive)
+
+    def _write_file(self, file_path, content, context=None, exclusive=False):
+        ''' clubit.tools.edi.document:_write_file()
+        -------------------------------------------
+        This method writes content to a file produced by the
+        framework, see _staged_file(). Unicode is written as UTF-8.
+        ----------------------------------------------------------- '''
+        if isinstance(content, unicode): content = content.encode('utf8')
+        with self._staged_file(file_path, context, exclusive) as f:
+            f.write(content)
+        return True
+
+    def position_document(self, cr, uid, partner_id, flow_id, content, content_type='json', context=None):
         ''' clubit.tools.edi.document:position_document()
         -------------------------------------------------
         This method will position the given content as an EDI
         document ready to be picked up for a given partner/flow
         combination. It will make sure the partner is actually
-        listening to this flow.
+        listening to this flow. The content can be any iterable,
+        such as a generator: rows for csv, chunks of text for
+        json. It is written as it is consumed, never held in
+        memory as a whole. The name of the file is returned.
         ------------------------------------------------------- '''
 
-        # Make the partner listen
-        # -----------------------
+        # Make the partner listen, nothing is
+        # written if it's listening already
+        # -----------------------------------
         partner_db = self.pool.get('res.partner')
         partner_db.listen_to_edi_flow(cr, uid, partner_id, flow_id)
 
-        # Create a file from the given content
-        # ------------------------------------
-        now = datetime.datetime.now()
-        name = now.strftime("%d_%m_%Y_%H_%M_%S") + ".csv"
-
+        # Create a file from the given content, named
+        # after its type so it's validated accordingly
+        # --------------------------------------------
+        name = unique_name(content_type)
         path = join(_directory_edi_base, cr.dbname, str(partner_id), str(flow_id), name)
-        with open(path, 'wb') as temp_file:
+        with self._staged_file(path, context, exclusive=True) as temp_file:
 
             if content_type == 'csv':
                 writer = csv.writer(temp_file, delimiter=',', quotechar='"')
-                for line in content:
-                    writer.writerow(line)
+                writer.writerows([isinstance(x, unicode) and x.encode('utf8') or x for x in row] for row in content)
 
             elif content_type == 'json':
                 for line in content:
-                    temp_file.write(line)
+                    temp_file.write(isinstance(line, unicode) and line.encode('utf8') or line)
+
+        return name
+
+    def position_documents(self, cr, uid, partner_id, flow_id, contents, content_type='json', context=None):
+        ''' clubit.tools.edi.document:position_documents()
+        --------------------------------------------------
+        This method positions a number of documents for a single
+        partner/flow combination, see position_document(). The
+        files are synced to disk together when all of them are
+        written, rather than one by one. The file names are
+        returned in the order of the contents.
+        -------------------------------------------------------- '''
 
-        return True
+        context = dict(context or {})
+        batch = context.get('edi_staged_batch')
+        owned = batch is None
+        if owned:
+            batch = context['edi_staged_batch'] = StagedBatch()
+        try:
+            names = [self.position_document(cr, uid, partner_id, flow_id, content, content_type, context) for content in contents]
+            if owned: batch.commit()
+        except Exception:
+            if owned: batch.discard()
+            raise
+        return names
 
     def copy(self, cr, uid, id, default=None, context=None):
         if default is None:
             default = {}
         document = self.browse(cr, uid, id, context=context)
 
-        name = self.create_unique_name_from_existing_name(cr, uid, document.name)
-        # write document to disk
-        location = join(_directory_edi_base, cr.dbname, str(document.partner_id.id), str(document.flow_id.id), 'imported')
-        with open (join(location, name), "w") as f:
-            f.write(document.content.encode('utf8'))
+        # Write the document to disk. A concurrent copy can't be seen
+        # in the database yet but can claim the same name, its file
+        # is never replaced: the next number is tried instead.
+        # ------------------------------------------------------------
+        minimum = 0
+        for attempt in xrange(10):
+            name = self.create_unique_name_from_existing_name(cr, uid, document.name, document.partner_id.id, document.flow_id.id, minimum)
+            location = self._storage_directory(cr, uid, document.partner_id.id, document.flow_id, name, 'imported')
+            try:
+                self._copy_file(document, join(location, name), context)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+                _logger.debug("File %s of a copy of edi document %d exists already, trying the next name", name, document.id)
+                minimum = int(path.splitext(name)[0].rsplit('-', 1)[1]) + 1
+        else:
+            raise osv.except_osv(_('Error!'), _('No free name found to copy EDI document {!s}.'.format(document.name)))
 
         default.update({
           'name': name,
           'location': location,
           'state': 'new',
           'reference': None,
-          'processed': False
+          'processed': False,
+          'file_compressed': False,
+          'file_purged': False,
+          'file_hash': document.content_hash,
         })
         res = super(clubit_tools_edi_document, self).copy(cr, uid, id, default, context)
         return res
 
-    def create_unique_name_from_existing_name(self, cr, uid, existing_name):
-        # remove the file extension
-        name_without_extension, extension = path.splitext(existing_name)
-        # check if the file was duplicated before
-        res = re.findall(r'-([0-9]*)$', name_without_extension)
-        if res:
-          counter = int(res[0]) + 1
-          name_without_extension = re.sub(r'-[0-9]*$', "-%d"%(counter), name_without_extension)
-        else:
-          name_without_extension = name_without_extension + '-1'
-        # append extension
-        name = name_without_extension + extension
-        # make sure the name doesn't already exist
-        ids = self.search(cr, uid, [('name','=',name)])
-        if not ids:
-          return name
-        else:
-          self.create_unique_name_from_existing_name(cr, uid, name)
+    def _copy_file(self, document, file_path, context=None):
+        ''' clubit.tools.edi.document:_copy_file()
+        ------------------------------------------
+        This method writes the file of a copy of a document, sharing
+        the original file if it still holds exactly the content of
+        the document. An existing file is never replaced, OSError
+        EEXIST is raised instead. The file is written right away,
+        also when a batch is given in the context, so copy() can
+        try the next name.
+        ------------------------------------------------------------- '''
+        if document.file_hash and document.file_hash == document.content_hash and not document.file_compressed:
+            try:
+                link(join(document.location, document.name), file_path)
+                return True
+            except OSError as e:
+                if e.errno == errno.EEXIST: raise
+                _logger.debug("Could not link the file of edi document %d, writing a copy", document.id)
+        context = dict(context or {}, edi_staged_batch=None)
+        return self._write_file(file_path, document.content, context, exclusive=True)
+
+    def create_unique_name_from_existing_name(self, cr, uid, existing_name, partner_id=None, flow_id=None, minimum=0):
+        ''' clubit.tools.edi.document:create_unique_name_from_existing_name()
+        ---------------------------------------------------------------------
+        This method returns the name for a copy of a document: the
+        original name with a numbered suffix, e.g. order-3.csv. The
+        number follows the highest one in use for this name, which is
+        looked up with a single query, among the documents of the
+        given partner/flow if those are passed along. The number is
+        at least the given minimum.
+        --------------------------------------------------------------------- '''
+
+        # Strip the extension and the suffix of an earlier copy
+        # ------------------------------------------------------
+        name_without_extension, extension = path.splitext(tools.ustr(existing_name))
+        name_without_extension = re.sub(r'-[0-9]+$', '', name_without_extension)
+        prefix = name_without_extension + '-'
+
+        # Find the highest number in use. Candidates are matched on
+        # prefix and extension, what's in between has to be a number.
+        # -----------------------------------------------------------
+        escape = lambda x: x.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = escape(prefix) + '%' + escape(extension)
+        query = 'SELECT substr(name, %s, char_length(name) - %s) AS suffix FROM ' + self._table + ' WHERE name LIKE %s'
+        params = [len(prefix) + 1, len(prefix) + len(extension), pattern]
+        if partner_id:
+            query += ' AND partner_id = %s'
+            params.append(partner_id)
+        if flow_id:
+            query += ' AND flow_id = %s'
+            params.append(flow_id)
+        cr.execute("SELECT MAX(CAST(suffix AS bigint)) FROM (" + query + ") copies WHERE suffix ~ '^[0-9]{1,18}$'", params)
+        counter = max((cr.fetchone()[0] or 0) + 1, minimum)
+        return '%s%d%s' % (prefix, counter, extension)
 
 ##############################################################################
 #
@@ -469,17 +1230,155 @@ class clubit_tools_edi_document_incoming(osv.osv):
         default = default and default.copy() or {}
         return super(clubit_tools_edi_document_incoming, self).copy(cr, uid, id, default=default, context=context)
 
+    def create(self, cr, uid, vals, context=None):
+        ''' clubit.tools.edi.document.incoming:create()
+        -----------------------------------------------
+        This method overwrites the standard OpenERP create() method.
+        The workflow isn't started on create, only documents of flows
+        that don't use the native state machine get a workflow
+        instance, the others start out as new without one.
+        ------------------------------------------------------------- '''
+        new_id = super(clubit_tools_edi_document_incoming, self).create(cr, uid, vals, context=context)
+        native = False
+        if new_id and vals.get('flow_id'):
+            cr.execute('SELECT native_workflow FROM clubit_tools_edi_flow WHERE id = %s', (int(vals['flow_id']),))
+            row = cr.fetchone()
+            native = bool(row and row[0])
+        if new_id and not native:
+            wkf_instance.create(cr, (uid, self._name, new_id), self._workflow_id(cr))
+        return new_id
+
+    @tools.ormcache(skiparg=2)
+    def _workflow_id(self, cr):
+        cr.execute('SELECT id FROM wkf WHERE osv = %s', (self._name,))
+        return cr.fetchone()[0]
+
     def document_manual_process(self, cr, uid, ids, context=None):
+        self.signal(cr, uid, ids[:1], 'document_processor_pickup')
+        return True
+
+    def button_to_ready(self, cr, uid, ids, context=None):
+        self.signal(cr, uid, ids, 'button_to_ready')
+        return True
+
+    def button_to_archived(self, cr, uid, ids, context=None):
+        self.signal(cr, uid, ids, 'button_to_archived')
+        return True
+
+    # Transitions of the native state machine, the same as those in
+    # edi_workflow_incoming.xml: signal: (from states, to state)
+    _native_transitions = {
+        'button_to_ready': (('new', 'in_error'), 'ready'),
+        'document_processor_pickup': (('ready',), 'processing'),
+        'button_to_archived': (('new', 'ready', 'processed', 'in_error'), 'archived'),
+    }
+
+    @saves_metrics
+    def signal(self, cr, uid, ids, signal):
+        ''' clubit.tools.edi.document.incoming:signal()
+        -----------------------------------------------
+        This method sends a workflow signal to a set of documents.
+        Documents with a running workflow instance go through the
+        workflow engine one by one, all others are handled by the
+        native state machine in one go.
+        ---------------------------------------------------------- '''
+        if isinstance(ids, (int, long)): ids = [ids]
+        if not ids: return True
+
+        cr.execute('SELECT res_id FROM wkf_instance WHERE res_type = %s AND res_id IN %s AND state = %s', (self._name, tuple(ids), 'active'))
+        engine = set([x[0] for x in cr.fetchall()])
         wf_service = netsvc.LocalService("workflow")
-        wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', ids[0], 'document_processor_pickup', cr)
+        for doc_id in ids:
+            if doc_id in engine:
+                wf_service.trg_validate(uid, self._name, doc_id, signal, cr)
+
+        native = [x for x in ids if x not in engine]
+        if native:
+            self._native_signal(cr, uid, native, signal)
         return True
 
-    def create_from_file(self, cr, uid, location, name):
+    def _native_transition(self, cr, uid, ids, from_states, to_state, code, text=None, error=False, processed=None):
+        ''' clubit.tools.edi.document.incoming:_native_transition()
+        -----------------------------------------------------------
+        This method moves all documents that are in one of the given
+        states to a new state with a single update, and records the
+        transition in the document history. Documents in any other
+        state, as well as those another node is working on or has
+        changed since our snapshot, are left alone, see
+        _lock_documents(). The ids of the moved documents are returned.
+        ------------------------------------------------------------- '''
+        ids = self._lock_documents(cr, uid, ids, from_states)
+        if not ids: return []
+
+        values = "state = %s, write_uid = %s, write_date = (now() at time zone 'UTC')"
+        params = [to_state, uid]
+        if processed is not None:
+            values += ', processed = %s'
+            params.append(processed)
+        cr.execute('UPDATE ' + self._table + ' d SET ' + values + ' '
+                   'FROM (SELECT id, state FROM ' + self._table + ' WHERE id IN %s) old '
+                   'WHERE d.id = old.id RETURNING d.id, old.state', params + [tuple(ids)])
+        from_states = dict(cr.fetchall())
+        moved = sorted(from_states.keys())
+        self._log_event(cr, uid, moved, code, text, to_state, error, from_states)
+        return moved
+
+    def _native_signal(self, cr, uid, ids, signal):
+        ''' clubit.tools.edi.document.incoming:_native_signal()
+        -------------------------------------------------------
+        This method is the native state machine. It applies a signal
+        to a set of documents, including the automatic transitions
+        that follow it: validation after ready and processing after
+        pick up, exactly like the workflow does.
+        ------------------------------------------------------------ '''
+        from_states, to_state = self._native_transitions[signal]
+
+        if signal == 'button_to_ready':
+            ready = self._native_transition(cr, uid, ids, from_states, to_state, 'ready', 'EDI Document marked as ready for processing.')
+            invalid = []
+            for document in self.browse(cr, uid, ready):
+                with timed(cr.dbname, 'validate', document.flow_id.id, document.partner_id.id):
+                    if not self._validate(cr, uid, document):
+                        invalid.append(document.id)
+            self._native_transition(cr, uid, invalid, ('ready',), 'in_error', 'in_error', processed=False)
+
+        elif signal == 'document_processor_pickup':
+            picked = self._native_transition(cr, uid, ids, from_states, to_state, 'processing')
+            results = {}
+            for document in self.browse(cr, uid, picked):
+                result, text = self._process(cr, uid, document)
+                results.setdefault((result, text), []).append(document.id)
+            for (result, text), doc_ids in results.items():
+                if result:
+                    self._native_transition(cr, uid, doc_ids, ('processing',), 'processed', 'processed', text, processed=True)
+                else:
+                    failed = self._native_transition(cr, uid, doc_ids, ('processing',), 'processed', 'process_failed', text, error=True)
+                    self._native_transition(cr, uid, failed, ('processed',), 'in_error', 'in_error', processed=False)
+
+        elif signal == 'button_to_archived':
+            cr.execute('SELECT flow_id, partner_id, array_agg(id ORDER BY id) FROM ' + self._table + ' WHERE id IN %s GROUP BY flow_id, partner_id', (tuple(ids),))
+            moved = []
+            for flow_id, partner_id, doc_ids in cr.fetchall():
+                with timed(cr.dbname, 'archive', flow_id, partner_id):
+                    archived = self._native_transition(cr, uid, doc_ids, from_states, to_state, 'archived', 'EDI Document successfully archived.')
+                    if archived:
+                        moved.extend(self.move_bulk(cr, uid, archived, 'archived'))
+
+            # Compress right away if configured like that
+            # -------------------------------------------
+            settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+            if moved and settings and settings.archive_compression and not settings.archive_compression_delay:
+                self.compress_documents(cr, uid, moved)
+        return True
+
+    @saves_metrics
+    def create_from_file(self, cr, uid, location, name, content=None):
         ''' clubit.tools.edi.document.incoming:create_from_file()
         ---------------------------------------------------------
         This method is a wrapper method for the standard
         OpenERP create() method. It will prepare the vals[] for
         the standard method based on the file's location, flow & partner.
+        The content can be passed along if it was already read.
         ----------------------------------------------------------------- '''
 
         _logger.debug("Creating edi document from file %s at location %s", name, location)
@@ -509,18 +1408,23 @@ class clubit_tools_edi_document_incoming(osv.osv):
 
         # Read the file contents
         # ----------------------
-        with open (join(location, name), "r") as f:
-            vals['content'] = f.read()
+        if content is None:
+            with timed(cr.dbname, 'read', int(vals['flow_id']), int(vals['partner_id'])):
+                with open (join(location, name), "r") as f:
+                    content = f.read()
+        vals['content'] = content
 
         # Create the actual EDI document, triggering
         # the workflow to start
         # ------------------------------------------
-        new_id = self.create(cr, uid, vals, None)
+        with timed(cr.dbname, 'create', int(vals['flow_id']), int(vals['partner_id'])):
+            new_id = self.create(cr, uid, vals, None)
         _logger.debug("Created edi document with id %d", new_id)
         if new_id != False:
             self.move(cr, uid, new_id, 'imported', None)
         return new_id
 
+    @saves_metrics
     def create_from_web_request(self, cr, uid, partner, flow, reference, content, data_type):
         ''' clubit.tools.edi.document.incoming:create_from_web_request()
         ----------------------------------------------------------------
@@ -565,8 +1469,11 @@ class clubit_tools_edi_document_incoming(osv.osv):
         if not flow_object.allow_duplicates:
             doc_id = self.search(cr, uid, [('flow_id', '=', flow_id), ('partner_id', '=', partner_id), ('reference', '=', reference)])
             if doc_id: return 'This reference has already been processed, request aborted.'
+        if flow_object.ignore_identical_content:
+            if self.find_identical(cr, uid, partner_id, flow_id, content):
+                return 'This content has already been received, request aborted.'
 
-        location = join(_directory_edi_base, cr.dbname, str(partner_id), str(flow_id), 'imported')
+        location = self._storage_directory(cr, uid, partner_id, flow_object, filename, 'imported')
 
         values = {
             'name'       : filename,
@@ -583,8 +1490,7 @@ class clubit_tools_edi_document_incoming(osv.osv):
         doc_id = self.create(cr, uid, values)
         if not doc_id: return 'Something went wrong trying to create the EDI document, request aborted.'
         try:
-            with open (join(location, filename), "w") as f:
-                f.write(content.encode('utf8'))
+            self._write_file(join(location, filename), content)
         except Exception as e:
             self.write(cr, uid, doc_id, {'state':'in_error'})
             self.unlink(cr, uid, [doc_id])
@@ -593,11 +1499,11 @@ class clubit_tools_edi_document_incoming(osv.osv):
         # Push forward the document if customized
         # ---------------------------------------
         if flow_object.process_after_create:
-            wf_service = netsvc.LocalService("workflow")
-            wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', doc_id, 'button_to_ready', cr)
+            self.signal(cr, uid, [doc_id], 'button_to_ready')
 
         return True
 
+    @saves_metrics
     def import_process(self, cr, uid):
         ''' clubit.tools.edi.document.incoming:import_process()
         -------------------------------------------------------
@@ -605,19 +1511,37 @@ class clubit_tools_edi_document_incoming(osv.osv):
         their corresponding flows and will import the files to create active
         EDI documents. Once a file has been imported as a document, it needs
         to go through the entire EDI workflow process.
+
+        Every run is bounded by the file and time budget in the settings.
+        When a budget runs out, the position is remembered and the next
+        run resumes from there. Missing folders are logged and skipped,
+        as are flows another node is importing at the same time.
         -------------------------------------------------------------------- '''
 
         _logger.debug('EDI_IMPORT: Starting the EDI document import process.')
 
         # Find all active EDI partners
         # ----------------------------
-        wf_service = netsvc.LocalService("workflow")
         partner_db = self.pool.get('res.partner')
-        pids = partner_db.search(cr, uid, [('edi_relevant', '=', True)])
+        pids = partner_db.search(cr, uid, [('edi_relevant', '=', True)], order='id')
         if not pids:
             _logger.debug('EDI_IMPORT: No active EDI partners at the moment, processing is done.')
             return True
 
+        # Determine the budget for this run and where we left off
+        # -------------------------------------------------------
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        file_budget = settings and settings.import_file_budget or 0
+        time_budget = settings and settings.import_time_budget or 0
+        deadline = time_budget and datetime.datetime.now() + datetime.timedelta(seconds=time_budget)
+        cursor = None
+        if settings and settings.import_cursor_partner:
+            cursor = (settings.import_cursor_partner, settings.import_cursor_flow, settings.import_cursor_file or '')
+        if cursor:
+            _logger.debug('EDI_IMPORT: Resuming at partner %d, flow %d, file %s', *cursor)
+            pids = [x for x in pids if x >= cursor[0]]
+        handled = 0
+
         # Loop over each individual partner and scrobble through their active flows
         # -------------------------------------------------------------------------
         partners = partner_db.browse(cr, uid, pids, None)
@@ -625,68 +1549,153 @@ class clubit_tools_edi_document_incoming(osv.osv):
             _logger.debug("Processing edi relevant partner %d (%s)", partner.id, partner.name)
             root_path = join(_directory_edi_base, cr.dbname, str(partner.id))
             if not path.exists(root_path):
-                raise osv.except_osv(_('Error!'), _('EDI folder missing for partner {!s}'.format(str(partner.id))))
+                _logger.warning('EDI_IMPORT: EDI folder missing for partner %d, skipping it.', partner.id)
+                forget_directory(cr.dbname, root_path)
+                continue
             
             if not partner.edi_flows: _logger.debug("No edi flows defined for partner %d", partner.id)
 
-            for flow in partner.edi_flows:
+            for flow in sorted(partner.edi_flows, key=lambda x: x.flow_id.id):
                 if flow.partnerflow_active == False or flow.flow_id.direction != 'in': continue
+                if cursor and (partner.id, flow.flow_id.id) < cursor[:2]: continue
                 _logger.debug("Processing active incoming flow %d (%s)", flow.id, flow.flow_id.name)
 
+                # Another node might be importing this flow already
+                # -------------------------------------------------
+                if not try_lock(cr, 'clubit.tools.edi.import', partner.id, flow.flow_id.id): continue
+
                 # We've found an active flow, let's check for new files
                 # A file is determined as new if it isn't assigned to a
                 # workflow folder yet.
                 # -----------------------------------------------------
                 sub_path = join(root_path, str(flow.flow_id.id))
                 if not path.exists(sub_path):
-                    raise osv.except_osv(_('Error!'), _('EDI folder missing for partner {!s}, flow {!s}'.format(flow.flow_id.name)))
+                    _logger.warning('EDI_IMPORT: EDI folder missing for partner %d, flow %s, skipping it.', partner.id, flow.flow_id.name)
+                    forget_directory(cr.dbname, sub_path)
+                    continue
 
-                files = [ f for f in listdir(sub_path) if isfile(join(sub_path, f)) ]
+                with timed(cr.dbname, 'scan', flow.flow_id.id, partner.id):
+                    files = sorted([ f for f in listdir(sub_path) if not is_staged(f) and isfile(join(sub_path, f)) ])
+                if cursor and (partner.id, flow.flow_id.id) == cursor[:2]:
+                    files = [f for f in files if f >= cursor[2]]
                 if not files: 
                     _logger.debug("No files found in directory %s", sub_path)
                     continue
 
+                # Look up which of these files were imported before in a
+                # single pass, unless duplicates are allowed by the flow
+                # ------------------------------------------------------
+                duplicates = set()
+                if not flow.flow_id.allow_duplicates:
+                    candidates = file_budget and files[:max(file_budget - handled, 0)] or files
+                    duplicates = self.find_imported(cr, uid, partner.id, flow.flow_id.id, candidates)
+
                 # If we get all the way over here, it means we've
                 # actually found some new files :)
                 # -----------------------------------------------
                 for f in files:
+
+                    # Stop once the budget for this run is used up,
+                    # the next run continues with this very file
+                    # ---------------------------------------------
+                    if (file_budget and handled >= file_budget) or (deadline and datetime.datetime.now() >= deadline):
+                        self._save_import_cursor(cr, uid, settings, (partner.id, flow.flow_id.id, f))
+                        _logger.info('EDI_IMPORT: Budget used up after %d files, resuming at partner %d, flow %d next run.', handled, partner.id, flow.flow_id.id)
+                        return True
+                    handled += 1
+
                     _logger.debug("File found in directory %s: %s", sub_path, f)
                     # Entering ultra defensive mode: make sure that this
                     # file isn't already converted to an EDI document yet!
                     # Unless this is specifically allowed by the flow
                     # ----------------------------------------------------
-                    if not flow.flow_id.allow_duplicates:
-                        duplicate = self.search(cr, uid, [('partner_id', '=', partner.id),
-                                                          ('flow_id', '=', flow.flow_id.id),
-                                                          ('name', '=', f)])
-                        if len(duplicate) > 0: 
-                            _logger.debug("Duplicate file. Skipping")
+                    if f in duplicates:
+                        _logger.debug("Duplicate file. Skipping")
+                        continue
+
+                    # Skip files we've already received the exact
+                    # same content for, if the flow asks for it. They
+                    # are moved out of the way so they aren't read
+                    # again on every run.
+                    # -----------------------------------------------
+                    content = None
+                    if flow.flow_id.ignore_identical_content:
+                        with timed(cr.dbname, 'read', flow.flow_id.id, partner.id):
+                            with open (join(sub_path, f), "r") as content_file:
+                                content = content_file.read()
+                        if self.find_identical(cr, uid, partner.id, flow.flow_id.id, content):
+                            _logger.debug("Identical content already received. Skipping")
+                            skipped = self._storage_directory(cr, uid, partner.id, flow.flow_id, f, 'skipped')
+                            try:
+                                move_file(join(sub_path, f), join(skipped, f))
+                            except Exception as e:
+                                _logger.warning("Moving skipped file %s out of the way failed: %s", join(sub_path, f), str(e))
                             continue
 
                     # Actually create a new EDI Document
-                    # This also triggers the workflow creation
-                    # ----------------------------------------
-                    new_doc = self.create_from_file(cr, uid, sub_path, f)
+                    # This also triggers the workflow creation.
+                    # A payload another node stored after our
+                    # snapshot can't be shared in this run, the
+                    # file is left for the next one.
+                    # ------------------------------------------
+                    cr.execute('SAVEPOINT edi_import_file')
+                    try:
+                        new_doc = self.create_from_file(cr, uid, sub_path, f, content)
+                        cr.execute('RELEASE SAVEPOINT edi_import_file')
+                    except psycopg2.extensions.TransactionRollbackError:
+                        cr.execute('ROLLBACK TO SAVEPOINT edi_import_file')
+                        _logger.info("EDI_IMPORT: File %s conflicts with a concurrent import, retrying next run.", join(sub_path, f))
+                        continue
                     if flow.flow_id.process_after_create:
                         _logger.debug("Trigger workflow ready for edi document %d", new_doc) 
-                        wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', new_doc, 'button_to_ready', cr)
+                        self.signal(cr, uid, [new_doc], 'button_to_ready')
 
+        if cursor: self._save_import_cursor(cr, uid, settings, None)
         _logger.debug('EDI_IMPORT: Document import process is done.')
         return True
 
+    def _save_import_cursor(self, cr, uid, settings, cursor):
+        ''' clubit.tools.edi.document.incoming:_save_import_cursor()
+        ------------------------------------------------------------
+        This method stores the (partner, flow, file) the next import
+        run resumes at in the settings, None starts from the first
+        partner again. It is written in the transaction of the files
+        imported so far, so it is shared by all the nodes and kept
+        across restarts. If another node is saving its position at
+        the same time, that position is kept instead.
+        ------------------------------------------------------------ '''
+        if not settings: return False
+
+        cursor = cursor or (None, None, None)
+        cr.execute('SAVEPOINT edi_import_cursor')
+        try:
+            cr.execute('SELECT id FROM clubit_tools_settings WHERE id = %s FOR UPDATE NOWAIT', (settings.id,))
+            cr.execute('UPDATE clubit_tools_settings SET import_cursor_partner = %s, import_cursor_flow = %s, import_cursor_file = %s WHERE id = %s',
+                       cursor + (settings.id,))
+            cr.execute('RELEASE SAVEPOINT edi_import_cursor')
+        except psycopg2.OperationalError:
+            cr.execute('ROLLBACK TO SAVEPOINT edi_import_cursor')
+            _logger.info('EDI_IMPORT: Another node is saving its import position, keeping that one.')
+            return False
+        return True
+
+    @saves_metrics
     def document_process(self, cr, uid):
         ''' clubit.tools.edi.document.incoming:document_process()
         ---------------------------------------------------------
         This method is the main scheduler which will process all the
         incoming EDI documents which are currently waiting in status 'ready'.
         The process will move all the documents to the state "processing".
+        Documents are handled per partner and flow, a partner/flow another
+        node is already processing is left to that node.
         --------------------------------------------------------------------- '''
 
         # Find all documents that are ready to be processed
         # -------------------------------------------------
         _logger.debug('DOCUMENT_PROCESS: Starting the EDI document processor.')
-        documents = self.search(cr, uid, [('state', '=', 'ready')])
-        if not documents:
+        cr.execute('SELECT partner_id, flow_id, array_agg(id ORDER BY id) FROM ' + self._table + ' WHERE state = %s GROUP BY partner_id, flow_id ORDER BY partner_id, flow_id', ('ready',))
+        shards = cr.fetchall()
+        if not shards:
             _logger.debug('DOCUMENT_PROCESS: No documents found, processing is done.')
             return True
 
@@ -694,15 +1703,44 @@ class clubit_tools_edi_document_incoming(osv.osv):
         # get picked up twice. The actual processing will be done for us by the
         # workflow method action_processed().
         # ----------------------------------------------------------------------
-        wf_service = netsvc.LocalService("workflow")
-        for document in documents:
-            _logger.debug("Trigger workflow processing for edi document %d", document)
-            wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', document, 'document_processor_pickup', cr)
+        for partner_id, flow_id, documents in shards:
+            if not try_lock(cr, 'clubit.tools.edi.document_process', partner_id, flow_id): continue
+
+            # Another node might have finished this shard
+            # between our search and getting the lock
+            # -------------------------------------------
+            documents = self._lock_documents(cr, uid, documents, ('ready',))
+            _logger.debug("Trigger workflow processing for edi documents %s", documents)
+            self.signal(cr, uid, documents, 'document_processor_pickup')
 
         _logger.debug('DOCUMENT_PROCESS: EDI document processor is done.')
         return True
 
 
+    def migrate_directory_layout(self, cr, uid, flow_ids, context=None):
+        ''' clubit.tools.edi.document.incoming:migrate_directory_layout()
+        -----------------------------------------------------------------
+        This method moves the files of existing documents to the
+        location prescribed by the current directory layout of their
+        flow. Every batch is committed right after its files have been
+        moved, so the database keeps up with the file system.
+        ----------------------------------------------------------------- '''
+
+        _logger.debug('Migrating the directory layout of flows %s', flow_ids)
+        doc_ids = self.search(cr, uid, [('flow_id', 'in', flow_ids)], order='id', context=context)
+        for i in xrange(0, len(doc_ids), 500):
+            folders = {'imported': [], 'archived': []}
+            for document in self.browse(cr, uid, doc_ids[i:i+500], context=context):
+                folder = document.state == 'archived' and 'archived' or 'imported'
+                if self._document_directory(cr, uid, document, folder) != document.location:
+                    folders[folder].append(document.id)
+            for folder, ids in folders.items():
+                if ids:
+                    self.move_bulk(cr, uid, ids, folder, context=context)
+            cr.commit()
+        return True
+
+    @saves_metrics
     def valid(self, cr, uid, ids, *args):
         ''' clubit.tools.edi.document.incoming:valid()
         ----------------------------------------------
@@ -713,26 +1751,86 @@ class clubit_tools_edi_document_incoming(osv.osv):
 
         assert len(ids) == 1
         document = self.browse(cr, uid, ids[0], None)
+        with timed(cr.dbname, 'validate', document.flow_id.id, document.partner_id.id):
+            return self._validate(cr, uid, document)
+
+    def _validate(self, cr, uid, document):
+        ''' clubit.tools.edi.document.incoming:_validate()
+        --------------------------------------------------
+        This method performs the validation for valid(). If the
+        flow caches validation results, content that passed the
+        same validation before isn't validated again.
+        ------------------------------------------------------- '''
+
+        flow = document.flow_id
+        if not flow.validation_cache or not document.content_hash:
+            return self._run_validation(cr, uid, document)
+
+        cache_db = self.pool.get('clubit.tools.edi.validation')
+        key = self._validator_key(cr, uid, document)
+        if cache_db.is_valid(cr, uid, flow.id, document.partner_id.id, document.content_hash, key):
+            _logger.debug("Content of edi document %d passed this validation before, skipping it", document.id)
+            return True
+        result = self._run_validation(cr, uid, document)
+        if result:
+            cache_db.remember(cr, uid, flow.id, document.partner_id.id, document.content_hash, key)
+        return result
+
+    def _validator_key(self, cr, uid, document):
+        ''' clubit.tools.edi.document.incoming:_validator_key()
+        -------------------------------------------------------
+        This method returns the identity of the validation a flow
+        performs on a document: the file type, the validator, the
+        version of its code, the installed version of the module
+        defining it and the CSV settings. Changing any of these
+        gives a new key, which invalidates the results cached
+        under the previous one. Helpers the validator calls are
+        covered by the module version only, so bump it when
+        the validation changes.
+        ---------------------------------------------------------- '''
+        flow = document.flow_id
+        version = module_version = ''
+        if flow.validator:
+            validator = getattr(self.pool.get(flow.model), flow.validator)
+            function = getattr(validator, 'im_func', validator)
+            code = getattr(function, 'func_code', None)
+            version = code and hashlib.sha1(marshal.dumps(code)).hexdigest() or ''
+
+            # Modules live in openerp.addons.<module>
+            # ---------------------------------------
+            module = (getattr(function, '__module__', None) or '').split('.')
+            if len(module) > 2 and module[:2] == ['openerp', 'addons']:
+                cr.execute("SELECT latest_version FROM ir_module_module WHERE name = %s AND state = 'installed'", (module[2],))
+                row = cr.fetchone()
+                module_version = '{!s}:{!s}'.format(module[2], row and row[0] or '')
+        filetype = document.name.split('.')[-1]
+        parts = [filetype, flow.model or '', flow.validator or '', version, module_version, flow.csv_schema or '', str(flow.csv_max_errors)]
+        return hashlib.sha1(tools.ustr('\0'.join(parts)).encode('utf8')).hexdigest()
+
+    def _run_validation(self, cr, uid, document):
+        ''' clubit.tools.edi.document.incoming:_run_validation()
+        --------------------------------------------------------
+        This method performs the actual validation for valid().
+        ------------------------------------------------------- '''
 
         # Perform a basic validation, depending on the filetype
         # -----------------------------------------------------
         filetype = document.name.split('.')[-1]
         if filetype == 'csv':
-            try:
-                dummy_file = StringIO.StringIO(document.content)
-                reader = csv.reader(dummy_file, delimiter=',', quotechar='"')
-            except Exception:
-                self.message_post(cr, uid, document.id, body='Error found: content is not valid CSV.')
+            errors = self._validate_csv(cr, uid, document)
+            if errors:
+                details = '\n'.join(['Line {!s}: {!s}'.format(*x) for x in errors])
+                self._log_event(cr, uid, [document.id], 'invalid_csv', 'Error found: content is not valid CSV.\n' + details, error=True)
                 return False
 
         elif filetype == 'json':
             try:
                 data = json.loads(document.content)
                 if not data:
-                    self.message_post(cr, uid, document.id, body='Error found: content is not valid JSON.')
+                    self._log_event(cr, uid, [document.id], 'invalid_json', 'Error found: content is not valid JSON.', error=True)
                     return False
             except Exception:
-                self.message_post(cr, uid, document.id, body='Error found: content is not valid JSON.')
+                self._log_event(cr, uid, [document.id], 'invalid_json', 'Error found: content is not valid JSON.', error=True)
                 return False
 
         # Perform custom validation
@@ -743,11 +1841,39 @@ class clubit_tools_edi_document_incoming(osv.osv):
         validator = getattr(self.pool.get(document.flow_id.model), document.flow_id.validator)
         _logger.debug("Perform custom validator '%s.%s' for flow %d (%s)", document.flow_id.model, document.flow_id.validator, document.flow_id.id, document.flow_id.name)
         try:
-            return validator(cr, uid, document.id, None)
+            profile_db = self.pool.get('clubit.tools.edi.profile')
+            return profile_db.profile_call(cr, uid, document, 'validate', validator, cr, uid, document.id, None)
         except Exception as e:
-            self.message_post(cr, uid, document.id, body='Error occurred during validation, most likely due to a program error:{!s}'.format(str(e)))
+            self._log_event(cr, uid, [document.id], 'validation_failed', 'Error occurred during validation, most likely due to a program error:{!s}'.format(str(e)), error=True)
             return False
 
+    def _validate_csv(self, cr, uid, document):
+        ''' clubit.tools.edi.document.incoming:_validate_csv()
+        ------------------------------------------------------
+        This method validates the content of a CSV document row by
+        row, against the CSV schema of its flow if it has one. The
+        file is streamed from disk as long as it still holds the
+        content of the document. The errors found are returned as
+        (line number, message) tuples.
+        ----------------------------------------------------------- '''
+        flow = document.flow_id
+        try:
+            schema = parse_schema(flow.csv_schema)
+        except ValueError:
+            return [(0, 'the CSV schema of flow {!s} is not valid'.format(flow.name))]
+
+        file_path = join(document.location, self._file_name(document))
+        try:
+            if document.file_hash and document.file_hash == document.content_hash and not document.file_purged and isfile(file_path):
+                opener = document.file_compressed and gzip.open or open
+                with opener(file_path, 'rb') as lines:
+                    return validate_csv(lines, schema, flow.csv_max_errors)
+            content = document.content or ''
+            if isinstance(content, unicode): content = content.encode('utf8')
+            return validate_csv(StringIO.StringIO(content), schema, flow.csv_max_errors)
+        except (csv.Error, TypeError) as e:
+            return [(0, 'the content could not be read as CSV: {!s}'.format(e))]
+
     def action_new(self, cr, uid, ids):
         ''' clubit.tools.edi.document.incoming:action_new()
         ---------------------------------------------------
@@ -770,6 +1896,7 @@ class clubit_tools_edi_document_incoming(osv.osv):
         put the "processed" attribute back to false.
         --------------------------------------------------------------- '''
         assert len(ids) == 1
+        self._log_event(cr, uid, ids, 'in_error', to_state='in_error')
         self.write(cr, uid, ids, { 'state' : 'in_error', 'processed' : False })
         return True
 
@@ -783,7 +1910,7 @@ class clubit_tools_edi_document_incoming(osv.osv):
         *if* there's one defined in the concrete EDI Flow implementation
         ---------------------------------------------------------------- '''
         assert len(ids) == 1
-        self.message_post(cr, uid, ids[0], body='EDI Document marked as ready for processing.')
+        self._log_event(cr, uid, ids, 'ready', 'EDI Document marked as ready for processing.', 'ready')
         self.write(cr, uid, ids, { 'state' : 'ready' })
         return True
 
@@ -795,6 +1922,7 @@ class clubit_tools_edi_document_incoming(osv.osv):
         don't get picked up by the system twice.
         --------------------------------------------------------------- '''
         assert len(ids) == 1
+        self._log_event(cr, uid, ids, 'processing', to_state='processing')
         self.write(cr, uid, ids, { 'state' : 'processing' })
         return True
 
@@ -808,22 +1936,33 @@ class clubit_tools_edi_document_incoming(osv.osv):
         assert len(ids) == 1
 
         document = self.browse(cr, uid, ids[0], None)
-        processor = getattr(self.pool.get(document.flow_id.model), document.flow_id.method)
-        result = False
-        try:
-            result = processor(cr, uid, document.id, None)
-        except Exception as e:
-            self.message_post(cr, uid, document.id, body='Error occurred during processing, error given: {!s}'.format(str(e)))
-            self.write(cr, uid, ids, { 'state' : 'processed' })
+        result, text = self._process(cr, uid, document)
         if result:
-            self.message_post(cr, uid, document.id, body='EDI Document successfully processed.')
+            self._log_event(cr, uid, ids, 'processed', text, 'processed')
             self.write(cr, uid, ids, { 'state' : 'processed', 'processed' : True })
         else:
-            self.message_post(cr, uid, document.id, body='Error occurred during processing, the action was not completed.')
+            self._log_event(cr, uid, ids, 'process_failed', text, 'processed', error=True)
             self.write(cr, uid, ids, { 'state' : 'processed' })
 
         return True
 
+    def _process(self, cr, uid, document):
+        ''' clubit.tools.edi.document.incoming:_process()
+        -------------------------------------------------
+        This method runs the processor of the document's flow. It
+        returns wether or not it succeeded, and the text to log.
+        --------------------------------------------------------- '''
+        processor = getattr(self.pool.get(document.flow_id.model), document.flow_id.method)
+        try:
+            with timed(cr.dbname, 'process', document.flow_id.id, document.partner_id.id):
+                profile_db = self.pool.get('clubit.tools.edi.profile')
+                result = profile_db.profile_call(cr, uid, document, 'process', processor, cr, uid, document.id, None)
+        except Exception as e:
+            return False, 'Error occurred during processing, error given: {!s}'.format(str(e))
+        if result:
+            return True, 'EDI Document successfully processed.'
+        return False, 'Error occurred during processing, the action was not completed.'
+
     def action_archive(self, cr, uid, ids):
         ''' clubit.tools.edi.document.incoming:action_archive()
         -------------------------------------------------------
@@ -832,9 +1971,135 @@ class clubit_tools_edi_document_incoming(osv.osv):
         workflow and marks it is being done.
         ------------------------------------------------------ '''
         assert len(ids) == 1
-        self.write(cr, uid, ids, { 'state' : 'archived' })
-        self.move(cr, uid, ids[0], 'archived', None)
-        self.message_post(cr, uid, ids[0], body='EDI Document successfully archived.')
+        document = self.browse(cr, uid, ids[0], None)
+        with timed(cr.dbname, 'archive', document.flow_id.id, document.partner_id.id):
+            self._log_event(cr, uid, ids, 'archived', 'EDI Document successfully archived.', 'archived')
+            self.write(cr, uid, ids, { 'state' : 'archived' })
+            moved = self.move(cr, uid, ids[0], 'archived', None)
+
+        # Compress right away if configured like that, move()
+        # returns an error dictionary when the move failed
+        # ---------------------------------------------------
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        if moved is True and settings and settings.archive_compression and not settings.archive_compression_delay:
+            self.compress_documents(cr, uid, ids)
+        return True
+
+    def partition_process(self, cr, uid):
+        ''' clubit.tools.edi.document.incoming:partition_process()
+        ----------------------------------------------------------
+        This method is the scheduler that manages the incoming
+        documents as monthly partitioned storage, if enabled in the
+        settings. The table is converted the first time around, after
+        which partitions are created a number of months ahead. Foreign
+        keys missing on an earlier converted table are added back.
+        ------------------------------------------------------------- '''
+
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        if not settings or not settings.partition_incoming:
+            _logger.debug('PARTITION_PROCESS: Partitioning is disabled.')
+            return True
+        if not partition_supported(cr):
+            _logger.warning('PARTITION_PROCESS: Partitioning requires PostgreSQL 11 or newer.')
+            return True
+
+        if not is_partitioned(cr, self._table):
+            if not convert_to_partitioned(cr, self._table):
+                return True
+        else:
+            restore_foreign_keys(cr, self._table)
+        ensure_partitions(cr, self._table, settings.partition_months_ahead)
+        return True
+
+    def _drop_expired_partitions(self, cr, uid):
+        ''' clubit.tools.edi.document.incoming:_drop_expired_partitions()
+        -----------------------------------------------------------------
+        This method drops the monthly partitions in which every single
+        document passed the database retention of its flow. This is a
+        lot cheaper than deleting those documents one batch at a time.
+        The chatter, workflow, history, profiles and payload references
+        of the documents are cleaned up before the partition is dropped.
+        ----------------------------------------------------------------- '''
+
+        if not is_partitioned(cr, self._table):
+            return True
+
+        current = datetime.date.today().replace(day=1)
+        for name, start in list_partitions(cr, self._table):
+            if start >= current:
+                break
+
+            cr.execute('SELECT 1 FROM "' + name + '" d LEFT JOIN clubit_tools_edi_flow f ON f.id = d.flow_id '
+                       'WHERE NOT COALESCE(d.state IN %s AND f.retention_db_days > 0 '
+                       "AND d.write_date < (now() at time zone 'UTC') - f.retention_db_days * interval '1 day', False) LIMIT 1",
+                       (self._retention_states,))
+            if cr.fetchone():
+                continue
+
+            _logger.debug('RETENTION: Dropping expired partition %s', name)
+            cr.execute('SELECT id, location, name, file_compressed FROM "' + name + '" WHERE file_purged IS NOT TRUE')
+            rows = cr.fetchall()
+            cr.execute('SELECT blob_id, count(*) FROM "' + name + '" WHERE blob_id IS NOT NULL GROUP BY blob_id')
+            self.pool.get('clubit.tools.edi.blob').release_counts(cr, uid, dict(cr.fetchall()))
+            cr.execute('DELETE FROM mail_message WHERE model = %s AND res_id IN (SELECT id FROM "' + name + '")', (self._name,))
+            cr.execute('DELETE FROM mail_followers WHERE res_model = %s AND res_id IN (SELECT id FROM "' + name + '")', (self._name,))
+            cr.execute('DELETE FROM wkf_instance WHERE res_type = %s AND res_id IN (SELECT id FROM "' + name + '")', (self._name,))
+            for model in ('clubit.tools.edi.document.history', 'clubit.tools.edi.profile'):
+                cr.execute('DELETE FROM ' + self.pool.get(model)._table + ' WHERE document_model = %s AND document_id IN (SELECT id FROM "' + name + '")', (self._name,))
+            drop_partition(cr, self._table, name)
+            cr.commit()
+
+            for doc_id, location, file_name, compressed in rows:
+                try:
+                    remove_file(join(location, compressed and file_name + '.gz' or file_name))
+                except OSError as e:
+                    _logger.warning("Purging the file of edi document %d failed: %s", doc_id, str(e))
+        return True
+
+    def retention_process(self, cr, uid):
+        ''' clubit.tools.edi.document.incoming:retention_process()
+        ----------------------------------------------------------
+        This method is the scheduler that enforces the retention
+        policy of the flows, for incoming as well as outgoing
+        documents. Whole partitions are dropped first if possible.
+        ---------------------------------------------------------- '''
+
+        _logger.debug('RETENTION: Starting the EDI retention process.')
+        self._drop_expired_partitions(cr, uid)
+        self.purge_documents(cr, uid)
+        self.pool.get('clubit.tools.edi.document.outgoing').purge_documents(cr, uid)
+        self.pool.get('clubit.tools.edi.validation').purge(cr, uid)
+        self.pool.get('clubit.tools.edi.profile').purge(cr, uid)
+        _logger.debug('RETENTION: EDI retention process is done.')
+        return True
+
+    def compress_process(self, cr, uid):
+        ''' clubit.tools.edi.document.incoming:compress_process()
+        ---------------------------------------------------------
+        This method is the scheduler that moves archived documents
+        to cold storage once they have been archived for the number
+        of days configured in the settings. Work is committed in
+        batches to keep transactions small.
+        --------------------------------------------------------- '''
+
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        if not settings or not settings.archive_compression:
+            _logger.debug('COMPRESS_PROCESS: Archive compression is disabled.')
+            return True
+
+        limit = datetime.datetime.utcnow() - datetime.timedelta(days=settings.archive_compression_delay)
+        last_id = 0
+        while True:
+            cr.execute('SELECT d.id FROM ' + self._table + ' d LEFT JOIN clubit_tools_edi_blob b ON b.id = d.blob_id '
+                       'WHERE d.state = %s AND d.write_date < %s AND d.id > %s AND (d.content IS NOT NULL OR d.file_compressed IS NOT TRUE OR b.content IS NOT NULL) ORDER BY d.id LIMIT 500',
+                       ('archived', limit.strftime('%Y-%m-%d %H:%M:%S'), last_id))
+            ids = [x[0] for x in cr.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+            _logger.debug('COMPRESS_PROCESS: Compressing %d archived documents.', len(ids))
+            self.compress_documents(cr, uid, ids)
+            cr.commit()
         return True
 
 ##############################################################################
@@ -855,8 +2120,12 @@ class clubit_tools_edi_document_outgoing(osv.Model):
     _no_listening_partners = 'no_listening_partners'
     _file_creation_error   = 'file_creation_error'
 
+    # Documents still being sent after this many seconds were
+    # interrupted, e.g. by a restart, see transfer_process()
+    _transfer_timeout = 3600
 
-    def create_from_content(self, cr, uid, reference, content, partner_id, model, method, type='JSON'):
+
+    def create_from_content(self, cr, uid, reference, content, partner_id, model, method, type='JSON', context=None):
         ''' clubit.tools.edi.document.outgoing:create_from_content()
         ------------------------------------------------------------
         This method accepts content and creates an EDI document
@@ -911,21 +2180,128 @@ class clubit_tools_edi_document_outgoing(osv.Model):
 
         # Create the EDI document
         # -----------------------
-        super(clubit_tools_edi_document, self).create(cr, uid, vals, None)
+        self.create(cr, uid, vals, None)
 
         # Physically create the file
         # --------------------------
         try:
-            f = open(join(vals['location'], vals['name']), "w")
-            f.write(vals['content'])
-            f.close()
+            self._write_file(join(vals['location'], vals['name']), vals['content'], context)
         except Exception as e:
             return str(e)
 
         return True
 
+    def transfer_process(self, cr, uid):
+        ''' clubit.tools.edi.document.outgoing:transfer_process()
+        ---------------------------------------------------------
+        This method is the scheduler which sends new outgoing documents
+        to the endpoints of their partner that are marked to send
+        automatically. The files are sent in parallel, using as many
+        threads as the settings allow and never more sessions per
+        endpoint than the connection allows. Every document ends up
+        processed or in error, each batch is committed on its own.
+
+        A batch is claimed by moving it to processing and committing
+        that before anything is sent, so other runs and the manual
+        process leave it alone. Documents that were left processing
+        by an interrupted run are put in error rather than sent again,
+        the partner might have received them already.
+        --------------------------------------------------------------- '''
+
+        _logger.debug('TRANSFER_PROCESS: Starting the EDI transfer process.')
+
+        # Find the endpoints we're supposed to send to, a
+        # flow specific endpoint wins over a general one
+        # ------------------------------------------------
+        connection_db = self.pool.get('clubit.tools.settings.connection')
+        connection_ids = connection_db.search(cr, uid, [('is_active', '=', True), ('auto_transfer', '=', True)], order='id')
+        if not connection_ids:
+            _logger.debug('TRANSFER_PROCESS: No endpoints to send to, processing is done.')
+            return True
+        routes = {}
+        for connection in connection_db.browse(cr, uid, connection_ids):
+            routes.setdefault((connection.partner.id, connection.flow_id.id or False), connection.id)
+
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        workers = settings and settings.no_of_processes or 1
+        attempts = settings and settings.transfer_attempts or 1
+        backoff = settings and settings.transfer_backoff or 0
+
+        partner_ids = list(set([x[0] for x in routes.keys()]))
+        self._fail_interrupted_transfers(cr, uid, partner_ids)
+        doc_ids = self.search(cr, uid, [('state', '=', 'new'), ('partner_id', 'in', partner_ids)], order='id')
+        for i in xrange(0, len(doc_ids), 500):
+
+            # Claim the documents we have an endpoint for,
+            # skipping those someone else is working on
+            # ---------------------------------------------
+            targets = {}
+            for document in self.read(cr, uid, doc_ids[i:i+500], ['partner_id', 'flow_id']):
+                partner_id = document['partner_id'] and document['partner_id'][0]
+                flow_id = document['flow_id'] and document['flow_id'][0]
+                connection_id = routes.get((partner_id, flow_id)) or routes.get((partner_id, False))
+                if connection_id:
+                    targets[document['id']] = connection_id
+            claimed = self._lock_documents(cr, uid, sorted(targets.keys()), ('new',))
+            if not claimed:
+                continue
+            self._log_event(cr, uid, claimed, 'processing', None, 'processing')
+            self.write(cr, uid, claimed, {'state': 'processing'})
+            cr.commit()
+
+            # Prepare the batch, the worker threads can't touch the database
+            # --------------------------------------------------------------
+            pools = {}
+            transfers = []
+            for document in self.read(cr, uid, claimed, ['name', 'content']):
+                connection_id = targets[document['id']]
+                if connection_id not in pools:
+                    pools[connection_id] = connection_db.get_pool(cr, uid, connection_id)
+                content = document['content'] or ''
+                if isinstance(content, unicode): content = content.encode('utf8')
+                transfers.append((document['id'], pools[connection_id], document['name'], content))
+
+            # Send the files and record the outcome
+            # -------------------------------------
+            results = send_files(transfers, workers, attempts, backoff)
+            sent = [doc_id for doc_id, error in results.items() if error is None]
+            if sent:
+                self._log_event(cr, uid, sent, 'sent', 'EDI Document successfully sent.', 'processed')
+                self.write(cr, uid, sent, {'state': 'processed'})
+            for doc_id, error in results.items():
+                if error is None: continue
+                self._log_event(cr, uid, [doc_id], 'send_failed', 'Error occurred while sending, error given: {!s}'.format(error), 'in_error', error=True)
+                self.write(cr, uid, [doc_id], {'state': 'in_error'})
+            cr.commit()
+
+        _logger.debug('TRANSFER_PROCESS: EDI transfer process is done.')
+        return True
+
+    def _fail_interrupted_transfers(self, cr, uid, partner_ids):
+        ''' clubit.tools.edi.document.outgoing:_fail_interrupted_transfers()
+        --------------------------------------------------------------------
+        This method puts documents that have been processing for longer
+        than a transfer may take in error. Their run was interrupted
+        before the outcome was recorded, so it's unknown whether they
+        reached the partner. Sending them again is left to a user.
+        ---------------------------------------------------------------- '''
+        if not partner_ids: return []
+
+        limit = (datetime.datetime.utcnow() - datetime.timedelta(seconds=self._transfer_timeout)).strftime('%Y-%m-%d %H:%M:%S')
+        cr.execute('SELECT id FROM ' + self._table + ' WHERE state = %s AND partner_id IN %s AND write_date < %s ORDER BY id',
+                   ('processing', tuple(partner_ids), limit))
+        ids = self._lock_documents(cr, uid, [x[0] for x in cr.fetchall()], ('processing',))
+        if ids:
+            _logger.warning('TRANSFER_PROCESS: %d documents were interrupted while being sent, putting them in error.', len(ids))
+            self._log_event(cr, uid, ids, 'send_failed', 'Sending was interrupted, check with the partner before sending again.', 'in_error', error=True)
+            self.write(cr, uid, ids, {'state': 'in_error'})
+            cr.commit()
+        return ids
+
     def document_manual_process(self, cr, uid, ids, context=None):
         '''Button action to manually process outgoing document'''
+        if not self._lock_documents(cr, uid, ids[:1], ('new', 'in_error')):
+            raise osv.except_osv(_('Error!'), _('This EDI document is being sent already.'))
         document = self.browse(cr, uid, ids[0], None)
         processor = getattr(self.pool.get(document.flow_id.model), document.flow_id.method)
         result = False
@@ -969,3 +2345,543 @@ class clubit_tools_edi_document_outgoing(osv.Model):
     #    self.message_post(cr, uid, ids[0], body='EDI Document successfully archived.')
     #    return True
 
+
+##############################################################################
+#
+#    clubit.tools.edi.job
+#
+#    The Job class runs the handler of an outgoing EDI flow in the
+#    background for large selections. The resolved list is processed in
+#    chunks by a scheduler, every chunk is committed on its own and the
+#    position is recorded, so a job simply resumes after a restart. Items
+#    that fail are recorded on the job instead of failing the whole export.
+#
+##############################################################################
+class clubit_tools_edi_job(osv.Model):
+    _name = "clubit.tools.edi.job"
+    _description = "EDI Job"
+    _order = "id desc"
+    _columns = {
+        'name': fields.char('Name', size=256, required=True, readonly=True),
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', required=True, readonly=True, ondelete='cascade'),
+        'user_id': fields.many2one('res.users', 'User', required=True, readonly=True),
+        'state': fields.selection([('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Done with errors')], 'State', required=True, readonly=True, select=True),
+        'items': fields.text('Items', readonly=True),
+        'context': fields.text('Context', readonly=True),
+        'chunk_size': fields.integer('Chunk size', required=True),
+        'position': fields.integer('Processed', readonly=True),
+        'total': fields.integer('Total', readonly=True),
+        'failed_items': fields.text('Failed items', readonly=True),
+        'failed_count': fields.integer('Failed', readonly=True),
+    }
+
+    _defaults = {
+        'state': 'pending',
+        'user_id': lambda self, cr, uid, context: uid,
+        'chunk_size': 100,
+        'position': 0,
+        'total': 0,
+        'failed_items': '[]',
+        'failed_count': 0,
+    }
+
+    def create_from_list(self, cr, uid, flow_id, items, context=None):
+        ''' clubit.tools.edi.job:create_from_list()
+        -------------------------------------------
+        This method creates a background job that passes the given
+        list of items to the handler of a flow. The context is kept
+        for the handler, except for the (possibly huge) selection.
+        ------------------------------------------------------------ '''
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        flow = self.pool.get('clubit.tools.edi.flow').browse(cr, uid, flow_id, context=context)
+        handler_context = dict((k, v) for k, v in (context or {}).items() if k not in ('active_ids', 'active_id'))
+        vals = {
+            'name': '{!s} ({!s} items)'.format(flow.name, len(items)),
+            'flow_id': flow_id,
+            'items': json.dumps(items),
+            'context': json.dumps(handler_context),
+            'total': len(items),
+        }
+        if settings and settings.job_chunk_size:
+            vals['chunk_size'] = settings.job_chunk_size
+        return self.create(cr, uid, vals, context=context)
+
+    def job_process(self, cr, uid):
+        ''' clubit.tools.edi.job:job_process()
+        --------------------------------------
+        This method is the scheduler which works through all
+        jobs that are pending or were interrupted while running.
+        A job is locked for as long as it runs, jobs another
+        worker or node is running are skipped. The lock is held
+        by a cursor of its own because run() commits every chunk.
+        -------------------------------------------------------- '''
+        _logger.debug('EDI_JOB: Starting the EDI job processor.')
+        job_ids = self.search(cr, uid, [('state', 'in', ('pending', 'running'))], order='id')
+        for job_id in job_ids:
+            lock_cr = self.pool.db.cursor()
+            try:
+                if not try_lock(lock_cr, 'clubit.tools.edi.job', job_id): continue
+
+                # Start from a fresh snapshot, the job might
+                # have been run since we looked it up
+                # ------------------------------------------
+                cr.commit()
+                self.run(cr, uid, job_id)
+            finally:
+                lock_cr.rollback()
+                lock_cr.close()
+        _logger.debug('EDI_JOB: EDI job processor is done.')
+        return True
+
+    def run(self, cr, uid, job_id, context=None):
+        ''' clubit.tools.edi.job:run()
+        ------------------------------
+        This method processes a job from its current position onwards.
+        Every chunk is handed to the flow's handler and committed. When
+        a chunk fails, it is rolled back and retried item by item so
+        only the items that actually fail are recorded as failed. The
+        position is committed together with the chunk it covers, so a
+        chunk is never handed to the handler again once committed. The
+        files a handler writes through the framework are staged in a
+        batch, published once the transaction is committed and
+        discarded along with a rolled back transaction.
+        ---------------------------------------------------------------- '''
+        job = self.browse(cr, uid, job_id, context=context)
+        if job.state not in ('pending', 'running'): return True
+        handler = getattr(self.pool.get(job.flow_id.model), job.flow_id.method)
+        handler_context = json.loads(job.context or '{}')
+        items = json.loads(job.items or '[]')
+        failed = json.loads(job.failed_items or '[]')
+        position = job.position
+        job_uid = job.user_id.id
+        chunk_size = max(job.chunk_size, 1)
+
+        def progress(end):
+            self.write(cr, uid, [job_id], {'position': end,
+                                           'failed_items': json.dumps(failed),
+                                           'failed_count': len(failed)}, context=context)
+
+        def call(selection, end):
+            batch = StagedBatch()
+            try:
+                handler(cr, job_uid, selection, dict(handler_context, edi_staged_batch=batch))
+                progress(end)
+                cr.commit()
+            except Exception:
+                cr.rollback()
+                batch.discard()
+                raise
+
+            # The chunk is committed, it mustn't be retried
+            # when some of its files can't be published
+            # ---------------------------------------------
+            try:
+                batch.commit()
+            except Exception as e:
+                _logger.error('EDI_JOB: Publishing the files of job %d up to position %d failed: %s', job_id, end, str(e))
+
+        self.write(cr, uid, [job_id], {'state': 'running'}, context=context)
+        cr.commit()
+
+        while position < len(items):
+            chunk = items[position:position + chunk_size]
+            try:
+                call(chunk, position + len(chunk))
+            except Exception:
+                _logger.warning('EDI_JOB: Chunk at position %d of job %d failed, retrying item by item.', position, job_id)
+                for index, item in enumerate(chunk, position + 1):
+                    try:
+                        call([item], index)
+                    except Exception as e:
+                        failed.append({'item': item, 'error': tools.ustr(getattr(e, 'value', e))})
+                        progress(index)
+                        cr.commit()
+
+            position += len(chunk)
+
+        self.write(cr, uid, [job_id], {'state': failed and 'failed' or 'done'}, context=context)
+        cr.commit()
+        return True
+
+    def action_retry_failed(self, cr, uid, ids, context=None):
+        ''' clubit.tools.edi.job:action_retry_failed()
+        ----------------------------------------------
+        This method reschedules the failed items of a job.
+        -------------------------------------------------- '''
+        for job in self.browse(cr, uid, ids, context=context):
+            if job.state != 'failed': continue
+            items = [x['item'] for x in json.loads(job.failed_items or '[]')]
+            self.write(cr, uid, [job.id], {'state': 'pending',
+                                           'items': json.dumps(items),
+                                           'total': len(items),
+                                           'position': 0,
+                                           'failed_items': '[]',
+                                           'failed_count': 0}, context=context)
+        return True
+
+##############################################################################
+#
+#    clubit.tools.edi.metric
+#
+#    The Metric class holds the totals of the EDI pipeline metrics. Every
+#    stage (scan, read, create, validate, process, move, archive) has a row
+#    per flow and partner with its number of runs, failures and latencies.
+#    Processes append their observations as rows of their own, the metrics
+#    scheduler adds those up. The number of documents per state is kept as
+#    well. The totals are also written to EDI/<db>/metrics.prom in the
+#    Prometheus text format.
+#
+##############################################################################
+class clubit_tools_edi_metric(osv.Model):
+    _name = "clubit.tools.edi.metric"
+    _description = "EDI Metric"
+    _order = "kind, name, flow_id, partner_id"
+    _columns = {
+        'kind': fields.selection([('stage', 'Stage'), ('queue', 'Queue depth')], 'Kind', required=True, readonly=True, select=True),
+        'name': fields.char('Stage/State', size=64, required=True, readonly=True, select=True),
+        'direction': fields.selection([('in', 'Incoming'), ('out', 'Outgoing')], 'Direction', readonly=True),
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', readonly=True, ondelete='cascade'),
+        'partner_id': fields.many2one('res.partner', 'Partner', readonly=True, ondelete='cascade'),
+        'count': fields.integer('Count', readonly=True),
+        'error_count': fields.integer('Errors', readonly=True),
+        'total_seconds': fields.float('Total time (s)', readonly=True),
+        'average_seconds': fields.float('Average time (s)', digits=(16, 4), readonly=True),
+        'max_seconds': fields.float('Max time (s)', digits=(16, 4), readonly=True),
+        'buckets': fields.text('Buckets', readonly=True),
+        'write_date': fields.datetime('Last update', readonly=True),
+    }
+
+    def save_metrics(self, cr, uid, context=None):
+        ''' clubit.tools.edi.metric:save_metrics()
+        -------------------------------------------
+        This method stores the observations this process recorded
+        since the previous call. They are inserted as new rows through
+        a cursor of their own: concurrent processes never update the
+        same rows, and the observations are kept when the transaction
+        of the caller is rolled back. flush_metrics() adds them up.
+        --------------------------------------------------------------- '''
+        pending = collect(cr.dbname)
+        if not pending:
+            return True
+        metric_cr = self.pool.db.cursor()
+        try:
+            for (stage, flow_id, partner_id), sample in pending.items():
+                self.create(metric_cr, uid, {
+                    'kind': 'stage',
+                    'name': stage,
+                    'flow_id': flow_id,
+                    'partner_id': partner_id,
+                    'count': sample['count'],
+                    'error_count': sample['errors'],
+                    'total_seconds': sample['sum'],
+                    'average_seconds': sample['sum'] / sample['count'],
+                    'max_seconds': sample['max'],
+                    'buckets': json.dumps(sample['buckets']),
+                }, context=context)
+            metric_cr.commit()
+        except Exception as e:
+            metric_cr.rollback()
+            _logger.warning("Saving the EDI metrics failed: %s", str(e))
+        finally:
+            metric_cr.close()
+        return True
+
+    def _merge_stage_metrics(self, cr, uid, context=None):
+        ''' clubit.tools.edi.metric:_merge_stage_metrics()
+        ---------------------------------------------------
+        This method adds up the rows save_metrics() inserted into
+        a single row per stage, flow and partner, and returns the
+        totals as dictionaries for render().
+        --------------------------------------------------------- '''
+        cr.execute('SELECT id, name, flow_id, partner_id, count, error_count, total_seconds, max_seconds, buckets '
+                   'FROM ' + self._table + ' WHERE kind = %s ORDER BY id', ('stage',))
+        totals = {}
+        for metric_id, stage, flow_id, partner_id, count, errors, seconds, max_seconds, buckets in cr.fetchall():
+            key = (stage, flow_id or False, partner_id or False)
+            buckets = json.loads(buckets or '[]') or [0] * len(BUCKETS)
+            total = totals.get(key)
+            if total is None:
+                totals[key] = {'ids': [metric_id], 'stage': stage, 'flow_id': key[1], 'partner_id': key[2],
+                               'count': count or 0, 'errors': errors or 0, 'sum': seconds or 0.0,
+                               'max': max_seconds or 0.0, 'buckets': buckets}
+                continue
+            total['ids'].append(metric_id)
+            total['count'] += count or 0
+            total['errors'] += errors or 0
+            total['sum'] += seconds or 0.0
+            total['max'] = max(total['max'], max_seconds or 0.0)
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], buckets)]
+
+        for total in totals.values():
+            if len(total['ids']) == 1: continue
+            self.write(cr, uid, total['ids'][:1], {
+                'count': total['count'],
+                'error_count': total['errors'],
+                'total_seconds': total['sum'],
+                'average_seconds': total['count'] and total['sum'] / total['count'] or 0.0,
+                'max_seconds': total['max'],
+                'buckets': json.dumps(total['buckets']),
+            }, context=context)
+            self.unlink(cr, uid, total['ids'][1:], context=context)
+        return totals.values()
+
+    def _save_queue_depths(self, cr, uid, context=None):
+        ''' clubit.tools.edi.metric:_save_queue_depths()
+        -------------------------------------------------
+        This method stores the number of documents per state
+        and returns them as (direction, state, count) tuples.
+        ----------------------------------------------------- '''
+        queues = []
+        for direction, model in (('in', 'clubit.tools.edi.document.incoming'), ('out', 'clubit.tools.edi.document.outgoing')):
+            cr.execute('SELECT state, count(*) FROM ' + self.pool.get(model)._table + ' GROUP BY state')
+            depths = dict(cr.fetchall())
+            for state, label in self.pool.get(model)._columns['state'].selection:
+                queues.append((direction, state, depths.get(state, 0)))
+
+        for direction, state, count in queues:
+            ids = self.search(cr, uid, [('kind', '=', 'queue'), ('direction', '=', direction), ('name', '=', state)], context=context)
+            if ids:
+                self.write(cr, uid, ids, {'count': count}, context=context)
+            else:
+                self.create(cr, uid, {'kind': 'queue', 'direction': direction, 'name': state, 'count': count}, context=context)
+        return queues
+
+    def flush_metrics(self, cr, uid, context=None):
+        ''' clubit.tools.edi.metric:flush_metrics()
+        --------------------------------------------
+        This method is the scheduler that saves the pending
+        observations, updates the queue depths and writes the
+        Prometheus file EDI/<db>/metrics.prom.
+        ----------------------------------------------------- '''
+        self.save_metrics(cr, uid, context=context)
+        queues = self._save_queue_depths(cr, uid, context=context)
+        stages = self._merge_stage_metrics(cr, uid, context=context)
+
+        directory = join(_directory_edi_base, cr.dbname)
+        ensure_directories(cr.dbname, [directory])
+        write_file(join(directory, 'metrics.prom'), render(stages, queues), sync=False)
+        return True
+
+##############################################################################
+#
+#    clubit.tools.edi.profile
+#
+#    The Profile class holds the profiles of flow validators and processors.
+#    When profiling is switched on for a flow, a sample of its documents is
+#    run under cProfile. The wall time, number of SQL queries and the most
+#    expensive functions of every sampled call are stored here.
+#
+##############################################################################
+class clubit_tools_edi_profile(osv.Model):
+    _name = "clubit.tools.edi.profile"
+    _description = "EDI Profile"
+    _order = "wall_seconds desc"
+    _rec_name = "document_name"
+    _columns = {
+        'document_model': fields.char('Document Model', size=64, readonly=True),
+        'document_id': fields.integer('Document ID', readonly=True, select=True),
+        'document_name': fields.char('Document', size=256, readonly=True),
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', readonly=True, ondelete='cascade', select=True),
+        'partner_id': fields.many2one('res.partner', 'Partner', readonly=True, ondelete='set null'),
+        'stage': fields.selection([('validate', 'Validator'), ('process', 'Processor')], 'Stage', readonly=True),
+        'wall_seconds': fields.float('Wall time (s)', digits=(16, 4), readonly=True),
+        'query_count': fields.integer('SQL queries', readonly=True),
+        'failed': fields.boolean('Failed', readonly=True),
+        'stats': fields.text('Statistics', readonly=True),
+        'create_date': fields.datetime('Profiled at', readonly=True),
+    }
+
+    # Number of functions kept in the statistics
+    _stats_limit = 30
+
+    # Number of days a profile is kept
+    _max_age_days = 30
+
+    def profile_call(self, cr, uid, document, stage, function, *args):
+        ''' clubit.tools.edi.profile:profile_call()
+        --------------------------------------------
+        This method calls the validator or processor of a document's
+        flow. If the flow is being profiled and the document is part
+        of the sample, the call is profiled and a profile is stored.
+        Either way the result of the call is returned as is.
+        -------------------------------------------------------------- '''
+        flow = document.flow_id
+        if not flow.profile_enabled or random.random() >= flow.profile_sample_rate:
+            return function(*args)
+
+        profiler = cProfile.Profile()
+        queries = getattr(cr, 'sql_log_count', None)
+        start = time.time()
+        failed = True
+        try:
+            result = profiler.runcall(function, *args)
+            failed = False
+            return result
+        finally:
+            wall = time.time() - start
+            output = StringIO.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(self._stats_limit)
+            vals = {
+                'document_model': document._name,
+                'document_id': document.id,
+                'document_name': document.name,
+                'flow_id': flow.id,
+                'partner_id': document.partner_id.id,
+                'stage': stage,
+                'wall_seconds': wall,
+                'query_count': queries is not None and cr.sql_log_count - queries or 0,
+                'failed': failed,
+                'stats': output.getvalue(),
+            }
+            # A failed call may have left the transaction unusable,
+            # losing a profile is better than hiding the real error.
+            try:
+                self.create(cr, SUPERUSER_ID, vals)
+            except Exception:
+                _logger.warning('Unable to store the profile of document %d', document.id, exc_info=True)
+
+    def forget(self, cr, uid, document_model, document_ids):
+        ''' clubit.tools.edi.profile:forget()
+        ------------------------------------
+        This method removes the profiles of deleted documents.
+        ------------------------------------------------------ '''
+        if document_ids:
+            cr.execute('DELETE FROM ' + self._table + ' WHERE document_model = %s AND document_id IN %s', (document_model, tuple(document_ids)))
+        return True
+
+    def purge(self, cr, uid):
+        ''' clubit.tools.edi.profile:purge()
+        -----------------------------------
+        This method removes profiles that have expired.
+        ----------------------------------------------- '''
+        limit = (datetime.datetime.utcnow() - datetime.timedelta(days=self._max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        cr.execute('DELETE FROM ' + self._table + ' WHERE create_date < %s', (limit,))
+        return True
+
+
+##############################################################################
+#
+#    clubit.tools.edi.document.history
+#
+#    The History class is the append-only log of what happened to EDI
+#    documents. Automated transitions are recorded here rather than in the
+#    chatter: a row in this table costs a fraction of a mail.message with
+#    its followers and notifications. The chatter policy of a flow decides
+#    which of these events are posted as a message as well.
+#
+##############################################################################
+class clubit_tools_edi_document_history(osv.Model):
+    _name = "clubit.tools.edi.document.history"
+    _description = "EDI Document History"
+    _order = "id desc"
+    _rec_name = "code"
+    _log_access = False
+    _columns = {
+        'document_model': fields.char('Document Model', size=64, readonly=True),
+        'document_id': fields.integer('Document ID', readonly=True),
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', readonly=True, ondelete='set null'),
+        'from_state': fields.char('From', size=16, readonly=True),
+        'to_state': fields.char('To', size=16, readonly=True),
+        'date': fields.datetime('Date', readonly=True),
+        'code': fields.char('Code', size=32, readonly=True),
+        'text': fields.text('Text', readonly=True),
+        'error': fields.boolean('Error', readonly=True),
+    }
+
+    def _auto_init(self, cr, context=None):
+        result = super(clubit_tools_edi_document_history, self)._auto_init(cr, context=context)
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'clubit_tools_edi_document_history_document_index'")
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX clubit_tools_edi_document_history_document_index ON ' + self._table + ' (document_model, document_id)')
+        return result
+
+    def log(self, cr, uid, events):
+        ''' clubit.tools.edi.document.history:log()
+        -------------------------------------------
+        This method appends events to the history, with one insert
+        per thousand events. Events are (document model, document
+        id, flow id or None, from state, to state, code, text, error)
+        tuples.
+        ------------------------------------------------------------- '''
+        for i in xrange(0, len(events), 1000):
+            chunk = events[i:i + 1000]
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, clock_timestamp() at time zone 'UTC')"] * len(chunk))
+            cr.execute('INSERT INTO ' + self._table + ' (document_model, document_id, flow_id, from_state, to_state, code, text, error, date) VALUES ' + values,
+                       [x for event in chunk for x in event])
+        return True
+
+    def forget(self, cr, uid, document_model, document_ids):
+        ''' clubit.tools.edi.document.history:forget()
+        ----------------------------------------------
+        This method removes the history of deleted documents.
+        ----------------------------------------------------- '''
+        if document_ids:
+            cr.execute('DELETE FROM ' + self._table + ' WHERE document_model = %s AND document_id IN %s', (document_model, tuple(document_ids)))
+        return True
+
+
+##############################################################################
+#
+#    clubit.tools.edi.validation
+#
+#    The Validation class caches successful validations of incoming content,
+#    for flows that ask for it. An entry means that content with this hash
+#    passed the validation identified by the key, for this partner/flow.
+#    Failures are never cached, and edited content gets a new hash. Entries
+#    are maintained directly through SQL given their volume.
+#
+##############################################################################
+class clubit_tools_edi_validation(osv.Model):
+    _name = "clubit.tools.edi.validation"
+    _description = "EDI Validation Cache"
+    _rec_name = "content_hash"
+    _columns = {
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', required=True, ondelete='cascade'),
+        'partner_id': fields.many2one('res.partner', 'Partner', required=True, ondelete='cascade'),
+        'content_hash': fields.char('Content Hash', size=64, required=True),
+        'validator_key': fields.char('Validator', size=40, required=True),
+    }
+
+    _sql_constraints = [
+        ('validation_unique', 'unique(flow_id, partner_id, content_hash, validator_key)', 'This validation is cached already.'),
+    ]
+
+    # Number of days an entry is kept
+    _max_age_days = 90
+
+    def is_valid(self, cr, uid, flow_id, partner_id, digest, validator_key):
+        ''' clubit.tools.edi.validation:is_valid()
+        -----------------------------------------
+        This method checks wether or not content passed
+        a validation for a partner/flow before.
+        ----------------------------------------------- '''
+        cr.execute('SELECT 1 FROM ' + self._table + ' WHERE flow_id = %s AND partner_id = %s AND content_hash = %s AND validator_key = %s',
+                   (flow_id, partner_id, digest, validator_key))
+        return bool(cr.fetchone())
+
+    def remember(self, cr, uid, flow_id, partner_id, digest, validator_key):
+        ''' clubit.tools.edi.validation:remember()
+        -----------------------------------------
+        This method records that content passed a validation
+        for a partner/flow. When a concurrent transaction records
+        the same entry, ours is dropped in a savepoint, a cache
+        entry is never worth failing the validation for.
+        ---------------------------------------------------------- '''
+        cr.execute('SAVEPOINT edi_validation_remember')
+        try:
+            cr.execute('INSERT INTO ' + self._table + ' (flow_id, partner_id, content_hash, validator_key, create_uid, create_date) '
+                       "VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC') ON CONFLICT DO NOTHING",
+                       (flow_id, partner_id, digest, validator_key, uid))
+            cr.execute('RELEASE SAVEPOINT edi_validation_remember')
+        except (psycopg2.extensions.TransactionRollbackError, psycopg2.IntegrityError):
+            cr.execute('ROLLBACK TO SAVEPOINT edi_validation_remember')
+        return True
+
+    def purge(self, cr, uid):
+        ''' clubit.tools.edi.validation:purge()
+        --------------------------------------
+        This method removes entries that have expired.
+        ---------------------------------------------- '''
+        limit = (datetime.datetime.utcnow() - datetime.timedelta(days=self._max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        cr.execute('DELETE FROM ' + self._table + ' WHERE create_date < %s', (limit,))
+        return True
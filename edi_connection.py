@@ -0,0 +1,310 @@
+import base64
+import ftplib
+import httplib
+import logging
+import Queue
+import threading
+import time
+import urlparse
+from StringIO import StringIO
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+##############################################################################
+#
+#    This file bundles the connection pooling used to transfer EDI files to
+#    the endpoints defined in clubit.tools.settings.connection.
+#
+#    Every connection record gets its own pool of sessions in this process.
+#    Idle sessions are kept alive for a while and health checked before they
+#    are reused, and the number of sessions open at the same time is capped
+#    per connection. Nothing in here depends on OpenERP, so the pool can be
+#    exercised against a local stand-in server.
+#
+#    On top of the pools sits the transfer engine, which sends a batch of
+#    files through a bounded set of worker threads. The workers only talk to
+#    the endpoints, everything database related stays with the caller.
+#
+##############################################################################
+
+# Pools per connection key, shared by all threads of this process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_params(protocol, url, port, user, password):
+    ''' edi_connection:connection_params()
+    --------------------------------------
+    This method normalizes the fields of a connection record into
+    the parameters a session needs. The address can either be a
+    plain host name or a full URL including the path to send to.
+    ------------------------------------------------------------- '''
+
+    parsed = urlparse.urlparse(url if '://' in url else '//' + url)
+    return {
+        'protocol': protocol or 'ftp',
+        'host': parsed.hostname,
+        'port': port or parsed.port,
+        'path': parsed.path.rstrip('/'),
+        'user': user,
+        'password': password,
+    }
+
+
+class FtpSession(object):
+    ''' edi_connection:FtpSession
+    ----------------------------
+    A logged in FTP session, files are stored in
+    the folder given by the path of the address.
+    -------------------------------------------- '''
+
+    def __init__(self, params, timeout):
+        self.ftp = ftplib.FTP()
+        self.ftp.connect(params['host'], params['port'] or 21, timeout)
+        self.ftp.login(params['user'], params['password'])
+        if params['path']:
+            self.ftp.cwd(params['path'])
+
+    def send(self, name, content):
+        self.ftp.storbinary('STOR ' + name, StringIO(content))
+        return True
+
+    def check(self):
+        self.ftp.voidcmd('NOOP')
+        return True
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+
+
+class HttpSession(object):
+    ''' edi_connection:HttpSession
+    -----------------------------
+    A persistent HTTP(S) connection, files are PUT
+    below the path of the address under their name.
+    ---------------------------------------------- '''
+
+    def __init__(self, params, timeout):
+        if params['protocol'] == 'https':
+            self.http = httplib.HTTPSConnection(params['host'], params['port'] or 443, timeout=timeout)
+        else:
+            self.http = httplib.HTTPConnection(params['host'], params['port'] or 80, timeout=timeout)
+        self.path = params['path']
+        self.headers = {}
+        if params['user']:
+            credentials = '{!s}:{!s}'.format(params['user'], params['password'] or '')
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials)
+
+    def _request(self, method, path, body=None):
+        self.http.request(method, path or '/', body, self.headers)
+        response = self.http.getresponse()
+        response.read()
+        return response
+
+    def send(self, name, content):
+        response = self._request('PUT', self.path + '/' + name, content)
+        if response.status >= 300:
+            raise IOError('{!s} {!s} while sending {!s}'.format(response.status, response.reason, name))
+        return True
+
+    def check(self):
+        response = self._request('HEAD', self.path)
+        if response.status >= 500:
+            raise IOError('{!s} {!s}'.format(response.status, response.reason))
+        return True
+
+    def close(self):
+        self.http.close()
+
+
+_session_classes = {
+    'ftp': FtpSession,
+    'http': HttpSession,
+    'https': HttpSession,
+}
+
+
+class ConnectionPool(object):
+    ''' edi_connection:ConnectionPool
+    --------------------------------
+    A pool of sessions for a single connection. At most max_size
+    sessions are handed out at the same time, acquire() blocks
+    until one is returned (or returns None when not blocking).
+    Idle sessions are reused as long as they haven't been idle
+    for longer than keepalive seconds and they still pass their
+    health check.
+    --------------------------------------------------------------- '''
+
+    def __init__(self, params, max_size=1, keepalive=60, timeout=30):
+        self.params = params
+        self.max_size = max(max_size, 1)
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_size)
+
+    def _connect(self):
+        _logger.debug('Opening a %s session to %s', self.params['protocol'], self.params['host'])
+        return _session_classes[self.params['protocol']](self.params, self.timeout)
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def acquire(self, blocking=True):
+        if not self.slots.acquire(blocking):
+            return None
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    session, since = self.idle.pop()
+                if time.time() - since > self.keepalive:
+                    self._close(session)
+                    continue
+                try:
+                    session.check()
+                    return session
+                except Exception:
+                    _logger.debug('Dropping a %s session to %s that failed its health check', self.params['protocol'], self.params['host'])
+                    self._close(session)
+            return self._connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, session, broken=False):
+        if broken:
+            self._close(session)
+        else:
+            with self.lock:
+                self.idle.append((session, time.time()))
+        self.slots.release()
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        except Exception:
+            self.release(session, broken=True)
+            raise
+        self.release(session)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for session, since in idle:
+            self._close(session)
+
+
+def get_pool(key, params, max_size=1, keepalive=60):
+    ''' edi_connection:get_pool()
+    ----------------------------
+    This method returns the pool for a connection key, creating
+    it on first use. A pool whose parameters changed is replaced.
+    ------------------------------------------------------------- '''
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool and (pool.params != params or pool.max_size != max(max_size, 1) or pool.keepalive != keepalive):
+            pool.close()
+            pool = None
+        if not pool:
+            pool = _pools[key] = ConnectionPool(params, max_size, keepalive)
+        return pool
+
+
+def discard_pool(key):
+    ''' edi_connection:discard_pool()
+    --------------------------------
+    This method closes and forgets the pool of a connection key.
+    ------------------------------------------------------------ '''
+
+    with _pools_lock:
+        pool = _pools.pop(key, None)
+    if pool:
+        pool.close()
+    return True
+
+
+def send_files(transfers, workers=1, attempts=3, backoff=1.0):
+    ''' edi_connection:send_files()
+    ------------------------------
+    This method sends a batch of files using a number of worker
+    threads. Transfers are (key, pool, name, content) tuples, the
+    result is a dictionary of key: None for every file that was
+    sent, or the error message for every file that wasn't.
+
+    An endpoint never gets more sessions than its pool allows, a
+    worker moves on to other files while an endpoint is busy. A
+    failed attempt is retried after backoff seconds, doubling the
+    wait for every further attempt.
+    ------------------------------------------------------------- '''
+
+    pending = Queue.Queue()
+    for key, pool, name, content in transfers:
+        pending.put((0, 0, key, pool, name, content))
+    results = {}
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if len(results) == len(transfers):
+                    return
+            try:
+                item = pending.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            attempt, not_before, key, pool, name, content = item
+
+            # Not due yet, or the endpoint is at its limit
+            # ---------------------------------------------
+            session = None
+            if time.time() >= not_before:
+                try:
+                    session = pool.acquire(blocking=False)
+                    error = None
+                except Exception as e:
+                    error = e
+            else:
+                error = None
+            if session is None and error is None:
+                pending.put(item)
+                time.sleep(0.01)
+                continue
+
+            if session is not None:
+                try:
+                    session.send(name, content)
+                except Exception as e:
+                    error = e
+                pool.release(session, broken=error is not None)
+
+            if error is not None:
+                attempt += 1
+                _logger.debug('Attempt %d to send %s failed: %s', attempt, name, error)
+                if attempt < attempts:
+                    pending.put((attempt, time.time() + backoff * 2 ** (attempt - 1), key, pool, name, content))
+                    continue
+                error = str(error) or error.__class__.__name__
+
+            with lock:
+                results[key] = error
+
+    threads = [threading.Thread(target=work) for i in xrange(max(min(workers, len(transfers)), 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,46 @@
+import logging
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+##############################################################################
+#
+#    This file bundles the helpers used to coordinate the EDI schedulers
+#    when several OpenERP servers or workers run against the same database.
+#
+#    Work is split into shards, typically one per partner and flow. Before
+#    a node touches a shard it takes a PostgreSQL advisory lock for it. A
+#    node that doesn't get the lock leaves the shard to whoever holds it and
+#    moves on to the next one, so nodes share the work instead of clashing.
+#
+##############################################################################
+
+
+def _key(value):
+    ''' edi_locking:_key()
+    ----------------------
+    This method turns a value into the 32 bit
+    integer PostgreSQL advisory locks expect.
+    ----------------------------------------- '''
+
+    if isinstance(value, unicode): value = value.encode('utf8')
+    return zlib.crc32(str(value)) & 0x7fffffff
+
+
+def try_lock(cr, namespace, *shard):
+    ''' edi_locking:try_lock()
+    --------------------------
+    This method tries to take the advisory lock of a shard within a
+    namespace, e.g. try_lock(cr, 'edi.import', partner_id, flow_id).
+    It never waits: False is returned when another node holds it.
+
+    The lock is bound to the current transaction and is released on
+    commit or rollback. Session locks are avoided on purpose, the
+    connection pool would keep them alive after the cursor closed.
+    ---------------------------------------------------------------- '''
+
+    cr.execute('SELECT pg_try_advisory_xact_lock(%s, %s)', (_key(namespace), _key('/'.join(str(x) for x in shard))))
+    locked = cr.fetchone()[0]
+    if not locked:
+        _logger.debug('Shard %s of %s is locked by another node, skipping it.', shard, namespace)
+    return locked
@@ -0,0 +1,142 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+##############################################################################
+#
+#    This file bundles the in-process metrics registry of the EDI Framework.
+#
+#    Every stage of the EDI pipeline reports how long it took, labelled by
+#    flow and partner. Observations are aggregated in memory per database and
+#    collected periodically by clubit.tools.edi.metric, which adds them to
+#    the totals stored in the database. Recording an observation never
+#    touches the database or the file system. Entry points, like buttons and
+#    schedulers, save what was recorded while they ran, see saves_metrics().
+#
+##############################################################################
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Pending observations per database:
+# (stage, flow_id, partner_id): {'count', 'errors', 'sum', 'max', 'buckets'}
+_pending = {}
+_lock = threading.Lock()
+
+# Number of entry points the current thread is running, nested in each other
+_depth = threading.local()
+
+
+def _empty():
+    return {'count': 0, 'errors': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+
+
+def observe(dbname, stage, seconds, flow_id=False, partner_id=False, error=False):
+    ''' edi_metrics:observe()
+    -------------------------
+    This method records a single run of a pipeline stage.
+    ----------------------------------------------------- '''
+
+    key = (stage, flow_id or False, partner_id or False)
+    with _lock:
+        sample = _pending.setdefault(dbname, {}).get(key)
+        if sample is None:
+            sample = _pending[dbname][key] = _empty()
+        sample['count'] += 1
+        sample['sum'] += seconds
+        sample['max'] = max(sample['max'], seconds)
+        if error:
+            sample['errors'] += 1
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                sample['buckets'][i] += 1
+                break
+    return True
+
+
+@contextmanager
+def timed(dbname, stage, flow_id=False, partner_id=False):
+    ''' edi_metrics:timed()
+    -----------------------
+    This method times the block it wraps as a run of a pipeline
+    stage. A block that raises is recorded as a failed run.
+    ----------------------------------------------------------- '''
+
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        observe(dbname, stage, time.time() - start, flow_id, partner_id, error=True)
+        raise
+    observe(dbname, stage, time.time() - start, flow_id, partner_id)
+
+
+def saves_metrics(method):
+    ''' edi_metrics:saves_metrics()
+    -------------------------------
+    This decorator is meant for model methods that are called by
+    the client or by a scheduler. Once the outermost of them returns,
+    the observations are saved by clubit.tools.edi.metric from the
+    process that recorded them. A process serving requests might
+    otherwise never save them, as the schedulers run elsewhere.
+    ----------------------------------------------------------------- '''
+
+    @functools.wraps(method)
+    def wrapper(self, cr, uid, *args, **kwargs):
+        depth = getattr(_depth, 'value', 0)
+        _depth.value = depth + 1
+        try:
+            return method(self, cr, uid, *args, **kwargs)
+        finally:
+            _depth.value = depth
+            if not depth:
+                self.pool.get('clubit.tools.edi.metric').save_metrics(cr, uid)
+    return wrapper
+
+
+def collect(dbname):
+    ''' edi_metrics:collect()
+    -------------------------
+    This method returns the observations recorded for a
+    database since the previous call and starts over.
+    --------------------------------------------------- '''
+
+    with _lock:
+        return _pending.pop(dbname, {})
+
+
+def render(stages, queues):
+    ''' edi_metrics:render()
+    ------------------------
+    This method renders metrics in the Prometheus text format. Stages
+    are dictionaries with the stage, flow_id, partner_id, count, errors,
+    sum and (non cumulative) buckets. Queues are (direction, state,
+    number of documents) tuples.
+    -------------------------------------------------------------------- '''
+
+    lines = [
+        '# HELP edi_stage_seconds Time spent per run of an EDI pipeline stage.',
+        '# TYPE edi_stage_seconds histogram',
+    ]
+    for stage in stages:
+        labels = 'stage="{!s}",flow="{!s}",partner="{!s}"'.format(stage['stage'], stage['flow_id'] or '', stage['partner_id'] or '')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, stage['buckets']):
+            cumulative += count
+            lines.append('edi_stage_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+        lines.append('edi_stage_seconds_bucket{%s,le="+Inf"} %d' % (labels, stage['count']))
+        lines.append('edi_stage_seconds_sum{%s} %f' % (labels, stage['sum']))
+        lines.append('edi_stage_seconds_count{%s} %d' % (labels, stage['count']))
+
+    lines.append('# HELP edi_stage_errors_total Runs of an EDI pipeline stage that failed.')
+    lines.append('# TYPE edi_stage_errors_total counter')
+    for stage in stages:
+        labels = 'stage="{!s}",flow="{!s}",partner="{!s}"'.format(stage['stage'], stage['flow_id'] or '', stage['partner_id'] or '')
+        lines.append('edi_stage_errors_total{%s} %d' % (labels, stage['errors']))
+
+    lines.append('# HELP edi_queue_depth Number of EDI documents per state.')
+    lines.append('# TYPE edi_queue_depth gauge')
+    for direction, state, count in queues:
+        lines.append('edi_queue_depth{direction="%s",state="%s"} %d' % (direction, state, count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,209 @@
+import datetime
+import logging
+
+_logger = logging.getLogger(__name__)
+
+##############################################################################
+#
+#    This file bundles the PostgreSQL helpers used to manage an EDI
+#    document table as monthly, time-partitioned storage on create_date.
+#
+#    Converting a table keeps all existing rows in a single "legacy"
+#    partition holding everything up to the current month. New rows end up
+#    in monthly partitions that are created ahead of time, with a default
+#    partition catching anything that falls outside of them.
+#
+##############################################################################
+
+# Declarative partitioning with default partitions and foreign
+# keys from partitioned tables requires PostgreSQL 11.
+_minimum_server_version = 110000
+
+# Indexes the EDI screens and schedulers rely on
+_partition_indexes = ['state', 'flow_id', 'partner_id', 'content_hash', 'create_date']
+
+# Indexes on several columns, by name: the file name lookups per
+# partner/flow rely on the one the document model creates itself
+_partition_composite_indexes = [('partner_flow_name', ['partner_id', 'flow_id', 'name'])]
+
+
+def _month_start(date, months=0):
+    ''' edi_partition:_month_start()
+    --------------------------------
+    This method returns the first day of the month the
+    given date falls in, shifted by a number of months.
+    --------------------------------------------------- '''
+
+    month = date.month - 1 + months
+    return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_supported(cr):
+    ''' edi_partition:partition_supported()
+    ---------------------------------------
+    This method checks wether or not the database server
+    supports the partitioning features we need.
+    ---------------------------------------------------- '''
+
+    return cr._cnx.server_version >= _minimum_server_version
+
+
+def is_partitioned(cr, table):
+    ''' edi_partition:is_partitioned()
+    ----------------------------------
+    This method checks wether or not a table is
+    already managed as partitioned storage.
+    ------------------------------------------- '''
+
+    cr.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table,))
+    row = cr.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def convert_to_partitioned(cr, table):
+    ''' edi_partition:convert_to_partitioned()
+    ------------------------------------------
+    This method converts a regular table into a table partitioned
+    by month on create_date. The existing table is attached as is
+    as the partition for everything before next month, so no rows
+    have to be copied. Tables that are referenced by foreign keys
+    are refused, PostgreSQL can't keep those references.
+
+    The foreign keys of the table are recreated on the partitioned
+    table under their original names, every partition inherits
+    them. The primary key has to include the partition key and
+    becomes (id, create_date), ids still come from the sequence.
+    The ORM only recognizes the partitioned table as an existing
+    table if the model overrides _table_exist() accordingly.
+    -------------------------------------------------------------- '''
+
+    cr.execute("SELECT conname FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass", (table,))
+    references = [x[0] for x in cr.fetchall()]
+    if references:
+        _logger.warning('Table %s is referenced by %s, not converting it to partitioned storage.', table, ', '.join(references))
+        return False
+
+    boundary = _month_start(datetime.date.today(), 1)
+    legacy = table + '_legacy'
+    _logger.info('Converting table %s to partitioned storage, existing rows are kept in %s.', table, legacy)
+
+    cr.execute('LOCK TABLE "%s" IN ACCESS EXCLUSIVE MODE' % table)
+    cr.execute('UPDATE "%s" SET create_date = COALESCE(write_date, now() at time zone \'UTC\') WHERE create_date IS NULL' % table)
+    cr.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table, legacy))
+    cr.execute('ALTER TABLE "%s" ALTER COLUMN create_date SET NOT NULL' % legacy)
+
+    # Index names are global, the legacy ones make way for the
+    # indexes of the partitioned table, which keep the names the
+    # ORM expects.
+    # ----------------------------------------------------------
+    cr.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (legacy,))
+    for (name,) in cr.fetchall():
+        if name.startswith(table + '_'):
+            cr.execute('ALTER INDEX "%s" RENAME TO "%s"' % (name, legacy + name[len(table):]))
+
+    cr.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (create_date)' % (table, legacy))
+    cr.execute('ALTER SEQUENCE "%s_id_seq" OWNED BY "%s".id' % (table, table))
+    cr.execute('ALTER TABLE "%s" ADD PRIMARY KEY (id, create_date)' % table)
+
+    # LIKE doesn't copy foreign keys. They are added to the partitioned
+    # table before the legacy table is attached, which then reuses its
+    # own identical foreign keys rather than validating new ones.
+    # -----------------------------------------------------------------
+    restore_foreign_keys(cr, table)
+    cr.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" FOR VALUES FROM (MINVALUE) TO (%%s)' % (table, legacy), (boundary,))
+    cr.execute('CREATE TABLE "%s_default" PARTITION OF "%s" DEFAULT' % (table, table))
+    for column in _partition_indexes:
+        cr.execute('CREATE INDEX "%s_%s_index" ON "%s" ("%s")' % (table, column, table, column))
+    for name, columns in _partition_composite_indexes:
+        cr.execute('CREATE INDEX "%s_%s_index" ON "%s" (%s)' % (table, name, table, ', '.join(['"%s"' % x for x in columns])))
+    return True
+
+
+def restore_foreign_keys(cr, table):
+    ''' edi_partition:restore_foreign_keys()
+    ----------------------------------------
+    This method adds the foreign keys of the legacy partition
+    that are missing on the partitioned table, for example on
+    tables that were converted without them.
+    --------------------------------------------------------- '''
+
+    cr.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", (table,))
+    existing = set([x[0] for x in cr.fetchall()])
+    cr.execute("SELECT 1 FROM pg_class WHERE relname = %s", (table + '_legacy',))
+    if not cr.fetchone():
+        return True
+    cr.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", (table + '_legacy',))
+    for name, definition in cr.fetchall():
+        if name in existing:
+            continue
+        _logger.info('Adding foreign key %s to partitioned table %s', name, table)
+        cr.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" %s' % (table, name, definition))
+    return True
+
+
+def list_partitions(cr, table):
+    ''' edi_partition:list_partitions()
+    -----------------------------------
+    This method returns the monthly partitions of a table as
+    a list of (name, start date) tuples, oldest first. The
+    legacy and default partitions are not part of the list.
+    -------------------------------------------------------- '''
+
+    cr.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table,))
+    partitions = []
+    for (name,) in cr.fetchall():
+        suffix = name[len(table) + 2:]
+        if not name.startswith(table + '_p') or len(suffix) != 6 or not suffix.isdigit():
+            continue
+        partitions.append((name, datetime.date(int(suffix[:4]), int(suffix[4:]), 1)))
+    return sorted(partitions, key=lambda x: x[1])
+
+
+def ensure_partitions(cr, table, months_ahead):
+    ''' edi_partition:ensure_partitions()
+    -------------------------------------
+    This method creates the monthly partitions for the current
+    month and a number of months ahead. A month that already has
+    rows in the default partition is skipped, PostgreSQL would
+    refuse to create it.
+    ------------------------------------------------------------ '''
+
+    existing = [x[0] for x in list_partitions(cr, table)]
+    today = datetime.date.today()
+
+    # The legacy partition covers everything before the conversion,
+    # which includes the month the conversion took place in.
+    # -------------------------------------------------------------
+    legacy_end = None
+    cr.execute("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE relname = %s", (table + '_legacy',))
+    row = cr.fetchone()
+    if row and row[0]:
+        legacy_end = row[0].split("TO ('")[-1][:10]
+
+    for i in xrange(0, months_ahead + 1):
+        start = _month_start(today, i)
+        end = _month_start(today, i + 1)
+        name = '%s_p%s' % (table, start.strftime('%Y%m'))
+        if name in existing or (legacy_end and start.strftime('%Y-%m-%d') < legacy_end):
+            continue
+
+        cr.execute('SELECT 1 FROM "%s_default" WHERE create_date >= %%s AND create_date < %%s LIMIT 1' % table, (start, end))
+        if cr.fetchone():
+            _logger.warning('Rows for %s are waiting in the default partition of %s, not creating partition %s.', start.strftime('%Y-%m'), table, name)
+            continue
+
+        _logger.debug('Creating partition %s for table %s', name, table)
+        cr.execute('CREATE TABLE "%s" PARTITION OF "%s" FOR VALUES FROM (%%s) TO (%%s)' % (name, table), (start, end))
+    return True
+
+
+def drop_partition(cr, table, name):
+    ''' edi_partition:drop_partition()
+    ----------------------------------
+    This method detaches and drops a single partition.
+    -------------------------------------------------- '''
+
+    _logger.info('Dropping partition %s of table %s', name, table)
+    cr.execute('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table, name))
+    cr.execute('DROP TABLE "%s"' % name)
+    return True
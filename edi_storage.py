@@ -0,0 +1,362 @@
+from os import path, makedirs, rename, remove, link, fsync, O_RDONLY
+import os
+import datetime
+import errno
+import gzip
+import hashlib
+import itertools
+import logging
+import re
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+##############################################################################
+#
+#    This file bundles the file system helpers used by the EDI Framework.
+#    The EDI directories usually live on a (slow) network share, so these
+#    helpers try to touch the file system as little as possible.
+#
+##############################################################################
+
+# Directories we know to exist, per database. Once a directory has been
+# seen or created it is remembered for the lifetime of the process.
+_known_directories = {}
+
+# Sequence of the file names handed out by this process, and a random
+# token telling this process apart from those on other nodes sharing the
+# EDI directories, which can have the same process id
+_name_counter = itertools.count(1)
+_name_lock = threading.Lock()
+_name_token = {}
+
+# The temporary names staged_path() hands out: .<name>.<pid>.<token>.part
+_staged_name = re.compile(r'^\..+\.\d+\.[0-9a-f]{32}\.part$')
+
+
+def ensure_directories(dbname, directories):
+    ''' edi_storage:ensure_directories()
+    ------------------------------------
+    This method makes sure all the given directories exist for
+    a database. Directories that were already checked before
+    are skipped without touching the file system.
+    ------------------------------------------------------------ '''
+
+    known = _known_directories.setdefault(dbname, set())
+    for directory in directories:
+        if directory in known:
+            continue
+        if not path.exists(directory):
+            _logger.debug('Required directory missing, attempting to create: {!s}'.format(directory))
+            try:
+                makedirs(directory)
+            except OSError as e:
+                # Another process might have beaten us to it
+                # -------------------------------------------
+                if e.errno != errno.EEXIST:
+                    raise
+        known.add(directory)
+    return True
+
+
+def forget_directory(dbname, directory):
+    ''' edi_storage:forget_directory()
+    ----------------------------------
+    This method removes a directory from the cache, for example
+    when it turns out it has been removed from the file system.
+    ----------------------------------------------------------- '''
+
+    known = _known_directories.get(dbname)
+    if known:
+        known.discard(directory)
+    return True
+
+
+def shard_folders(layout, name, date):
+    ''' edi_storage:shard_folders()
+    -------------------------------
+    This method returns the list of sub folders a file should be
+    placed in for a given directory layout. Large flows use this to
+    avoid directories with hundreds of thousands of entries:
+
+      flat: no sub folders, the original behaviour
+      date: one folder per day, e.g. 2026/10/17
+      hash: two levels based on the file name, e.g. 3f/a2
+    ------------------------------------------------------------ '''
+
+    if layout == 'date':
+        return [date.strftime('%Y'), date.strftime('%m'), date.strftime('%d')]
+    if layout == 'hash':
+        if isinstance(name, unicode): name = name.encode('utf8')
+        digest = hashlib.md5(name).hexdigest()
+        return [digest[0:2], digest[2:4]]
+    return []
+
+
+def unique_name(extension, now=None):
+    ''' edi_storage:unique_name()
+    -----------------------------
+    This method returns a new file name that is unique, also when
+    many files are named within the same second or by several nodes.
+    The time stamp is followed by its microseconds, the process id,
+    a random token of the process and a counter of this process,
+    e.g. 17_10_2026_14_03_59_123456_4242_9f3ab2c1_17.csv
+    ---------------------------------------------------------------- '''
+
+    pid = os.getpid()
+    with _name_lock:
+        counter = next(_name_counter)
+        # Forked workers draw a token of their own
+        token = _name_token.get(pid)
+        if token is None:
+            _name_token.clear()
+            token = _name_token[pid] = uuid.uuid4().hex[:8]
+    now = now or datetime.datetime.now()
+    return '{!s}_{:06d}_{:d}_{!s}_{:d}.{!s}'.format(now.strftime('%d_%m_%Y_%H_%M_%S'), now.microsecond, pid, token, counter, extension)
+
+
+def compress_file(file_path):
+    ''' edi_storage:compress_file()
+    -------------------------------
+    This method replaces a file by a gzip compressed copy with
+    the extension .gz. The compressed file is staged first, so a
+    crash never leaves a truncated archive behind.
+    ------------------------------------------------------------ '''
+
+    with open(file_path, 'rb') as source:
+        with staged_file(file_path + '.gz') as raw:
+            target = gzip.GzipFile(filename=path.basename(file_path), mode='wb', fileobj=raw)
+            try:
+                shutil.copyfileobj(source, target)
+            finally:
+                target.close()
+    remove(file_path)
+    return file_path + '.gz'
+
+
+def content_hash(content):
+    ''' edi_storage:content_hash()
+    ------------------------------
+    This method returns the hash under which a payload
+    is stored. Identical payloads share the same hash.
+    -------------------------------------------------- '''
+
+    if isinstance(content, unicode): content = content.encode('utf8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def remove_file(file_path):
+    ''' edi_storage:remove_file()
+    -----------------------------
+    This method removes a file, a file that is already
+    gone is not considered an error.
+    -------------------------------------------------- '''
+
+    try:
+        remove(file_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def move_file(from_path, to_path):
+    ''' edi_storage:move_file()
+    ---------------------------
+    This method moves a file with a single rename, which is atomic
+    within the same file system. The outcome of the rename doubles
+    as the check the file was still there: False is returned when
+    the file doesn't exist. Moves across devices fall back to a copy
+    under a temporary name, which is synced to disk and renamed into
+    place before the original is removed.
+    ---------------------------------------------------------------- '''
+
+    try:
+        rename(from_path, to_path)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOENT and not path.isfile(from_path):
+            return False
+        if e.errno != errno.EXDEV:
+            raise
+
+    with open(from_path, 'rb') as source:
+        with staged_file(to_path) as target:
+            shutil.copyfileobj(source, target)
+    remove(from_path)
+    return True
+
+
+def staged_path(file_path):
+    ''' edi_storage:staged_path()
+    ----------------------------
+    This method returns the temporary name a file is written
+    under before it is renamed into place. Hidden files are
+    ignored by the EDI import and by partners polling a folder.
+    Every call returns a new name, so writers of the same file
+    never write into each other's temporary file.
+    ----------------------------------------------------------- '''
+
+    directory, name = path.split(file_path)
+    return path.join(directory, '.{!s}.{:d}.{!s}.part'.format(name, os.getpid(), uuid.uuid4().hex))
+
+
+def is_staged(name):
+    ''' edi_storage:is_staged()
+    --------------------------
+    This method checks wether or not a file name
+    belongs to a file that is still being written.
+    Only names handed out by staged_path() match,
+    other hidden files are ordinary files.
+    ---------------------------------------------- '''
+
+    return bool(_staged_name.match(name))
+
+
+def publish_file(temp_path, file_path, exclusive=False):
+    ''' edi_storage:publish_file()
+    ------------------------------
+    This method moves a staged file to its final name. An exclusive
+    publish never replaces an existing file: it links the file into
+    place, which fails with EEXIST if the name is taken, and then
+    removes the temporary name. File systems without hard links
+    fall back to a plain rename.
+    ---------------------------------------------------------------- '''
+
+    if exclusive:
+        try:
+            link(temp_path, file_path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                remove_file(temp_path)
+                raise
+            _logger.debug('Hard links not supported for %s, renaming instead: %s', file_path, str(e))
+        else:
+            remove(temp_path)
+            return True
+    rename(temp_path, file_path)
+    return True
+
+
+@contextmanager
+def staged_file(file_path, sync=True, exclusive=False):
+    ''' edi_storage:staged_file()
+    ----------------------------
+    This method returns a file object to write a file through.
+    Everything is written to a temporary name, flushed and only
+    renamed to the final name once complete. Anyone looking at
+    the folder either sees the complete file or nothing at all.
+    A failure while writing removes the temporary file. See
+    publish_file() for exclusive files.
+    ----------------------------------------------------------- '''
+
+    temp_path = staged_path(file_path)
+    try:
+        with open(temp_path, 'wb') as f:
+            yield f
+            f.flush()
+            if sync:
+                fsync(f.fileno())
+    except Exception:
+        remove_file(temp_path)
+        raise
+    publish_file(temp_path, file_path, exclusive)
+
+
+def write_file(file_path, content, sync=True):
+    ''' edi_storage:write_file()
+    ---------------------------
+    This method writes the given content to a file
+    through a staged file. Unicode is written as UTF-8.
+    --------------------------------------------------- '''
+
+    if isinstance(content, unicode): content = content.encode('utf8')
+    with staged_file(file_path, sync) as f:
+        f.write(content)
+    return True
+
+
+def _sync_path(file_path):
+    ''' edi_storage:_sync_path()
+    ---------------------------
+    This method flushes a file or directory to disk.
+    ------------------------------------------------ '''
+
+    fd = os.open(file_path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StagedBatch(object):
+    ''' edi_storage:StagedBatch
+    --------------------------
+    A batch of staged files for high volume exports. Files are
+    written to their temporary name without syncing them one by
+    one. commit() then syncs all of them in a single pass before
+    renaming them into place, followed by one sync per folder.
+    A file that can't be published doesn't stop the others: its
+    temporary file is removed and the first error is raised once
+    the rest is published. An exclusive file only finds out its
+    name is taken at commit, writers retrying on EEXIST should
+    not go through a batch. Pass a batch along in the context as
+    'edi_staged_batch' to have the EDI framework write its files
+    through it.
+    ----------------------------------------------------------- '''
+
+    def __init__(self):
+        self.pending = []
+
+    @contextmanager
+    def staged_file(self, file_path, exclusive=False):
+        temp_path = staged_path(file_path)
+        try:
+            with open(temp_path, 'wb') as f:
+                yield f
+        except Exception:
+            remove_file(temp_path)
+            raise
+        self.pending.append((temp_path, file_path, exclusive))
+
+    def write(self, file_path, content):
+        if isinstance(content, unicode): content = content.encode('utf8')
+        with self.staged_file(file_path) as f:
+            f.write(content)
+        return True
+
+    def commit(self):
+        try:
+            for temp_path, file_path, exclusive in self.pending:
+                _sync_path(temp_path)
+        except Exception:
+            self.discard()
+            raise
+
+        pending, self.pending = self.pending, []
+        directories = set()
+        error = None
+        for temp_path, file_path, exclusive in pending:
+            try:
+                publish_file(temp_path, file_path, exclusive)
+            except Exception as e:
+                _logger.warning('Could not publish staged file %s: %s', file_path, str(e))
+                remove_file(temp_path)
+                error = error or e
+                continue
+            directories.add(path.dirname(file_path) or '.')
+        for directory in directories:
+            _sync_path(directory)
+        if error:
+            raise error
+        return True
+
+    def discard(self):
+        for temp_path, file_path, exclusive in self.pending:
+            remove_file(temp_path)
+        self.pending = []
+        return True
@@ -0,0 +1,124 @@
+import csv
+import datetime
+import json
+
+##############################################################################
+#
+#    This file bundles the streaming CSV validation of the EDI Framework.
+#
+#    Rows are checked one at a time while the file is read, so the memory
+#    used doesn't depend on the size of the file. Without a schema only the
+#    CSV syntax itself is checked. A flow can describe its columns with a
+#    JSON schema, for example:
+#
+#      {"header": true,
+#       "columns": [{"name": "reference", "required": true},
+#                   {"name": "quantity", "type": "integer", "required": true},
+#                   {"name": "price", "type": "float"},
+#                   {"name": "delivery", "type": "date"}]}
+#
+#    Supported types are string (the default), integer, float and date
+#    (YYYY-MM-DD). Every row must have exactly as many fields as there are
+#    columns, unless "strict" is false, in which case extra fields are
+#    allowed. Nothing in here depends on OpenERP.
+#
+##############################################################################
+
+def _is_integer(value):
+    int(value)
+
+
+def _is_float(value):
+    float(value)
+
+
+def _is_date(value):
+    datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+_types = {
+    'string': None,
+    'integer': _is_integer,
+    'float': _is_float,
+    'date': _is_date,
+}
+
+
+def parse_schema(text):
+    ''' edi_validation:parse_schema()
+    ---------------------------------
+    This method parses and checks a CSV schema. An empty
+    schema gives None, an invalid one raises ValueError.
+    ---------------------------------------------------- '''
+
+    if not text or not text.strip():
+        return None
+    schema = json.loads(text)
+    if not isinstance(schema, dict) or not isinstance(schema.get('columns', []), list):
+        raise ValueError('A CSV schema is an object with a list of columns.')
+    delimiter = schema.get('delimiter', ',')
+    if not isinstance(delimiter, basestring) or len(delimiter.encode('utf8')) != 1:
+        raise ValueError('The delimiter of a CSV schema is a single ASCII character.')
+    for column in schema.get('columns', []):
+        if not isinstance(column, dict):
+            raise ValueError('Every column of a CSV schema is an object.')
+        column_type = column.get('type', 'string')
+        if not isinstance(column_type, basestring) or column_type not in _types:
+            raise ValueError('Unknown column type: {!r}'.format(column_type))
+    return schema
+
+
+def validate_csv(lines, schema=None, max_errors=10, delimiter=',', quotechar='"'):
+    ''' edi_validation:validate_csv()
+    ---------------------------------
+    This method validates CSV content, which can be a file or any
+    other iterable of lines. It returns a list of (line number,
+    message) tuples, empty if the content is valid. Validation
+    stops once max_errors errors have been found, or at the first
+    error that makes the rest of the content unreadable.
+    -------------------------------------------------------------- '''
+
+    schema = schema or {}
+    columns = schema.get('columns') or []
+    checks = [(i, column.get('name') or str(i + 1), column.get('required', False), _types[column.get('type', 'string')])
+              for i, column in enumerate(columns)]
+    strict = schema.get('strict', True)
+    skip_header = schema.get('header', False)
+    max_errors = max(max_errors or 0, 1)
+
+    errors = []
+    reader = csv.reader(lines, delimiter=str(schema.get('delimiter', delimiter)), quotechar=str(quotechar), strict=True)
+    try:
+        for row in reader:
+            if skip_header:
+                skip_header = False
+                continue
+            if not row or not columns:
+                continue
+
+            # The number of fields
+            # --------------------
+            if len(row) < len(columns) or (strict and len(row) > len(columns)):
+                errors.append((reader.line_num, 'expected {!s} fields, found {!s}'.format(len(columns), len(row))))
+                if len(errors) >= max_errors: break
+                continue
+
+            # Required fields and types
+            # -------------------------
+            for i, name, required, check in checks:
+                value = row[i].strip()
+                if not value:
+                    if required:
+                        errors.append((reader.line_num, 'field {!s} is required'.format(name)))
+                    continue
+                if check:
+                    try:
+                        check(value)
+                    except ValueError:
+                        errors.append((reader.line_num, 'field {!s} is not a valid {!s}: {!s}'.format(name, columns[i]['type'], value[:40])))
+            if len(errors) >= max_errors:
+                del errors[max_errors:]
+                break
+    except csv.Error as e:
+        errors.append((reader.line_num, str(e)))
+    return errors
@@ -1,5 +1,7 @@
 from openerp.osv import osv, fields
 from openerp.tools.translate import _
+from openerp import tools
+from edi_connection import connection_params, get_pool, discard_pool
 
 
 class clubit_tools_settings_connection(osv.Model):
@@ -14,8 +16,52 @@ class clubit_tools_settings_connection(osv.Model):
         'port': fields.integer('Port', required=True),
         'user': fields.char('User', size=50, required=True),
         'password': fields.char('Password', size=100, required=True, password=True),
+        'protocol': fields.selection([('ftp', 'FTP'), ('http', 'HTTP'), ('https', 'HTTPS')], 'Protocol', required=True),
+        'max_connections': fields.integer('Max. connections', help="Maximum number of sessions opened to this endpoint at the same time."),
+        'keepalive': fields.integer('Keep alive (seconds)', help="Number of seconds an idle session is kept open for reuse."),
+        'auto_transfer': fields.boolean('Send automatically', help="New outgoing EDI documents for this partner are sent to this endpoint by the EDI Transfers scheduler."),
+        'flow_id': fields.many2one('clubit.tools.edi.flow', 'EDI Flow', domain=[('direction', '=', 'out')], ondelete='cascade', help="Only send documents of this flow, leave empty to send documents of all flows."),
     }
 
+    _defaults = {
+        'protocol': 'ftp',
+        'max_connections': 2,
+        'keepalive': 60,
+        'auto_transfer': False,
+    }
+
+    def create(self, cr, uid, vals, context=None):
+        new_id = super(clubit_tools_settings_connection, self).create(cr, uid, vals, context)
+        self.pool.get('clubit.tools.settings').clear_caches()
+        return new_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        result = super(clubit_tools_settings_connection, self).write(cr, uid, ids, vals, context)
+        self.pool.get('clubit.tools.settings').clear_caches()
+        for connection_id in (isinstance(ids, (int, long)) and [ids] or ids):
+            discard_pool((cr.dbname, connection_id))
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        result = super(clubit_tools_settings_connection, self).unlink(cr, uid, ids, context)
+        self.pool.get('clubit.tools.settings').clear_caches()
+        for connection_id in (isinstance(ids, (int, long)) and [ids] or ids):
+            discard_pool((cr.dbname, connection_id))
+        return result
+
+    def get_pool(self, cr, uid, connection_id, context=None):
+        ''' clubit.tools.settings.connection:get_pool()
+        -----------------------------------------------
+        This method returns the pool of sessions this process keeps
+        for the endpoint, so bulk transfers reuse their sessions:
+
+          with connection_db.get_pool(cr, uid, id).session() as s:
+              s.send(name, content)
+        ------------------------------------------------------------ '''
+        connection = self.browse(cr, uid, connection_id, context=context)
+        params = connection_params(connection.protocol, connection.url, connection.port, connection.user, connection.password)
+        return get_pool((cr.dbname, connection.id), params, connection.max_connections, connection.keepalive)
+
 
 class clubit_tools_settings(osv.Model):
 
@@ -25,24 +71,77 @@ class clubit_tools_settings(osv.Model):
     _columns = {
         'no_of_processes': fields.integer('Number of processes', required=True),
         'connections': fields.one2many('clubit.tools.settings.connection', 'setting', 'Connections'),
+        'archive_compression': fields.boolean('Compress archived documents', help="Compress the content and the file of archived documents."),
+        'archive_compression_delay': fields.integer('Compress after (days)', help="Number of days after archiving before a document is compressed, 0 compresses immediately."),
+        'partition_incoming': fields.boolean('Partition incoming documents', help="Store incoming documents in monthly partitions. Requires PostgreSQL 11 or newer, the conversion is done by the EDI Partitioning scheduler."),
+        'partition_months_ahead': fields.integer('Months ahead', help="Number of monthly partitions to create ahead of time."),
+        'import_file_budget': fields.integer('Files per run', help="Maximum number of files the EDI import handles per run, 0 means no limit. The next run picks up where the previous one stopped."),
+        'import_time_budget': fields.integer('Seconds per run', help="Maximum number of seconds the EDI import spends per run, 0 means no limit."),
+        'import_cursor_partner': fields.integer('Resume at partner', readonly=True, help="Partner the next run of the EDI import resumes at."),
+        'import_cursor_flow': fields.integer('Resume at flow', readonly=True, help="Flow the next run of the EDI import resumes at."),
+        'import_cursor_file': fields.char('Resume at file', size=256, readonly=True, help="File the next run of the EDI import resumes at."),
+        'job_threshold': fields.integer('Background from', help="Outgoing selections with more items than this are sent by a background job, 0 always sends right away."),
+        'job_chunk_size': fields.integer('Chunk size', help="Number of items a background job hands to the flow's handler at once, every chunk is committed separately."),
+        'transfer_attempts': fields.integer('Attempts', help="Number of times sending an outgoing document is attempted before it is put in error."),
+        'transfer_backoff': fields.float('Retry after (seconds)', help="Wait before the first retry, the wait doubles for every further attempt."),
+    }
+
+    _defaults = {
+        'archive_compression': False,
+        'archive_compression_delay': 0,
+        'partition_incoming': False,
+        'partition_months_ahead': 3,
+        'import_file_budget': 1000,
+        'import_time_budget': 50,
+        'job_threshold': 500,
+        'job_chunk_size': 100,
+        'transfer_attempts': 3,
+        'transfer_backoff': 2.0,
     }
 
     def create(self, cr, uid, vals, context=None):
         if self.search(cr, uid, []):
             raise osv.except_osv(_('Error!'), _("Only 1 settings record allowed."))
-        return super(clubit_tools_settings, self).create(cr, uid, vals, context)
+        new_id = super(clubit_tools_settings, self).create(cr, uid, vals, context)
+        self.clear_caches()
+        return new_id
 
-    def get_settings(self, cr, uid):
+    def unlink(self, cr, uid, ids, context=None):
+        result = super(clubit_tools_settings, self).unlink(cr, uid, ids, context)
+        self.clear_caches()
+        return result
+
+    @tools.ormcache(skiparg=3)
+    def _get_settings_id(self, cr, uid):
         ids = self.search(cr, uid, [])
-        if ids:
-            return self.browse(cr, uid, ids[0])
+        return ids and ids[0] or False
+
+    def get_settings(self, cr, uid):
+        settings_id = self._get_settings_id(cr, uid)
+        if settings_id:
+            return self.browse(cr, uid, settings_id)
         return False
 
+    @tools.ormcache(skiparg=3)
+    def _get_connection_ids(self, cr, uid, partner_id):
+        ''' clubit.tools.settings:_get_connection_ids()
+        -----------------------------------------------
+        This method returns the connections of a partner as a
+        dictionary of name: connection id, the first connection is
+        also stored under False. The result is cached until a
+        connection is created, changed or removed.
+        ---------------------------------------------------------- '''
+        cr.execute('SELECT id, name FROM clubit_tools_settings_connection WHERE partner = %s ORDER BY id DESC', (partner_id,))
+        connections = dict((name, id) for id, name in cr.fetchall())
+        if connections:
+            connections[False] = min(connections.values())
+        return connections
+
     def get_connection(self, cr, uid, partner_id, name=False):
-        settings = self.get_settings(cr, uid)
-        if name:
-            return next((x for x in settings.connections if x.partner.id == partner_id and x.name == name),None)
-        return next((x for x in settings.connections if x.partner.id == partner_id),None)
+        connection_id = self._get_connection_ids(cr, uid, partner_id).get(name or False)
+        if connection_id:
+            return self.pool.get('clubit.tools.settings.connection').browse(cr, uid, connection_id)
+        return None
 
 
 
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+##############################################################################
+#
+#    EDI Framework benchmark
+#
+#    This script generates a synthetic EDI load of N partners x M flows x K
+#    files and times the main stages of the framework against it, in-process
+#    and on a local database. Nothing outside of the OpenERP server and its
+#    PostgreSQL database is needed.
+#
+#      python benchmark.py -c /etc/openerp-server.conf -d edi_benchmark \
+#          --partners 10 --flows 2 --files 100 --size 2048 --output run.json
+#
+#    Use a dedicated database with clubit_tools installed, the benchmark
+#    changes the EDI settings and removes the data of previous runs. Run it
+#    from the directory the server runs in, that's where the EDI folder is.
+#
+#    Every stage reports its wall time, throughput, number of SQL queries and
+#    the peak memory of the process so far. The results are printed and can
+#    be written as JSON, tagged with the commit they were measured on, so
+#    runs can be compared across commits. The content is generated from a
+#    fixed seed, the same parameters always produce the same files.
+#
+##############################################################################
+import argparse
+import json
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join
+
+import openerp
+from openerp import SUPERUSER_ID
+
+_prefix = 'EDI Benchmark'
+_module = 'edi_benchmark'
+_directory_edi_base = 'EDI'
+
+
+# Content generation
+# ------------------
+def generate_content(rnd, data_type, size):
+    ''' Returns content of roughly the given size in bytes '''
+    rows = []
+    length = 0
+    while length < size:
+        row = {'line': len(rows) + 1,
+               'reference': 'REF%08d' % rnd.randint(0, 99999999),
+               'product': 'P%05d' % rnd.randint(0, 99999),
+               'quantity': rnd.randint(1, 1000),
+               'price': round(rnd.uniform(0, 1000), 2)}
+        rows.append(row)
+        length += 80
+    if data_type == 'csv':
+        lines = ['line,reference,product,quantity,price']
+        lines += ['{line},{reference},{product},{quantity},{price}'.format(**x) for x in rows]
+        return '\n'.join(lines) + '\n'
+    if data_type == 'xml':
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<lines>']
+        lines += ['<line number="{line}" reference="{reference}" product="{product}" quantity="{quantity}" price="{price}"/>'.format(**x) for x in rows]
+        lines.append('</lines>')
+        return '\n'.join(lines) + '\n'
+    return json.dumps(rows)
+
+
+# Measuring
+# ---------
+def peak_memory():
+    ''' Peak resident memory of this process in KB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(cr, results, name, items, function, *args, **kwargs):
+    ''' Runs and commits a stage, and records its measurements '''
+    queries = getattr(cr, 'sql_log_count', 0)
+    start = time.time()
+    error = None
+    try:
+        function(*args, **kwargs)
+        cr.commit()
+    except Exception as e:
+        cr.rollback()
+        error = repr(e)
+    seconds = time.time() - start
+    result = {
+        'stage': name,
+        'items': items,
+        'seconds': round(seconds, 3),
+        'per_second': round(items / seconds, 1) if seconds and items else None,
+        'queries': getattr(cr, 'sql_log_count', 0) - queries if hasattr(cr, 'sql_log_count') else None,
+        'peak_memory_kb': peak_memory(),
+    }
+    if error:
+        result['error'] = error
+    results.append(result)
+    print('{stage:<28} {items:>8} items {seconds:>9.3f}s {rate:>10}/s {queries:>9} queries {peak_memory_kb:>9} KB{error}'.format(
+        rate=result['per_second'] or '-', error=error and '  ERROR ' + error or '', **dict(result, queries=result['queries'] or '-')))
+    return result
+
+
+# Setup and cleanup
+# -----------------
+def cleanup(cr, pool):
+    ''' Removes everything a previous run left behind '''
+    partner_db = pool.get('res.partner')
+    flow_db = pool.get('clubit.tools.edi.flow')
+    partner_ids = partner_db.search(cr, SUPERUSER_ID, [('name', '=like', _prefix + '%')], context={'active_test': False})
+    for model in ('clubit.tools.edi.document.incoming', 'clubit.tools.edi.document.outgoing'):
+        doc_ids = pool.get(model).search(cr, SUPERUSER_ID, [('partner_id', 'in', partner_ids)])
+        for i in xrange(0, len(doc_ids), 1000):
+            pool.get(model).unlink(cr, SUPERUSER_ID, doc_ids[i:i+1000])
+    street_db = pool.get('clubit.tools.edi.street')
+    street_db.unlink(cr, SUPERUSER_ID, street_db.search(cr, SUPERUSER_ID, [('name', '=like', _prefix + '%')]))
+    partner_db.unlink(cr, SUPERUSER_ID, partner_ids)
+    flow_db.unlink(cr, SUPERUSER_ID, flow_db.search(cr, SUPERUSER_ID, [('name', '=like', _prefix + '%')]))
+    data_db = pool.get('ir.model.data')
+    data_db.unlink(cr, SUPERUSER_ID, data_db.search(cr, SUPERUSER_ID, [('module', '=', _module)]))
+    for partner_id in partner_ids:
+        shutil.rmtree(join(_directory_edi_base, cr.dbname, str(partner_id)), True)
+    cr.commit()
+
+
+def setup(cr, pool, args):
+    ''' Creates the settings, flows, partners and subscriptions '''
+    settings_db = pool.get('clubit.tools.settings')
+    settings = {'import_file_budget': 0, 'import_time_budget': 0, 'job_threshold': 0}
+    settings_ids = settings_db.search(cr, SUPERUSER_ID, [])
+    if settings_ids:
+        settings_db.write(cr, SUPERUSER_ID, settings_ids, settings)
+    else:
+        settings_db.create(cr, SUPERUSER_ID, dict(settings, no_of_processes=1))
+
+    # No-op flows: exists() validates and processes every document
+    # ------------------------------------------------------------
+    flow_db = pool.get('clubit.tools.edi.flow')
+    data_db = pool.get('ir.model.data')
+    flows_in = []
+    for j in xrange(args.flows):
+        flow_id = flow_db.create(cr, SUPERUSER_ID, {
+            'name': '{!s} {!s}(in)'.format(_prefix, j),
+            'direction': 'in',
+            'model': 'clubit.tools.edi.document.incoming',
+            'method': 'exists',
+            'validator': 'exists',
+            'process_after_create': True,
+            'directory_layout': args.layout,
+        })
+        data_db.create(cr, SUPERUSER_ID, {'module': _module, 'name': 'flow_%d' % j, 'model': 'clubit.tools.edi.flow', 'res_id': flow_id})
+        flows_in.append(flow_id)
+    flow_out = flow_db.create(cr, SUPERUSER_ID, {
+        'name': '{!s} (out)'.format(_prefix),
+        'direction': 'out',
+        'model': 'res.partner',
+        'method': 'exists',
+    })
+
+    partner_db = pool.get('res.partner')
+    partners = []
+    for i in xrange(args.partners):
+        partner_id = partner_db.create(cr, SUPERUSER_ID, {
+            'name': '{!s} {!s}'.format(_prefix, i),
+            'edi_relevant': True,
+            'edi_flows': [(0, 0, {'flow_id': x, 'partnerflow_active': True}) for x in flows_in + [flow_out]],
+        })
+        data_db.create(cr, SUPERUSER_ID, {'module': _module, 'name': 'partner_%d' % i, 'model': 'res.partner', 'res_id': partner_id})
+        partners.append(partner_id)
+
+    street_db = pool.get('clubit.tools.edi.street')
+    street_db.create(cr, SUPERUSER_ID, {
+        'name': _prefix,
+        'steps': [(0, 0, {'sequence': i, 'flow': x}) for i, x in enumerate(flows_in + [flow_out])],
+    })
+    cr.commit()
+    return partners, flows_in, flow_out
+
+
+def generate_files(cr, args, partners, flows):
+    ''' Writes K files per partner and flow in the EDI folders '''
+    rnd = random.Random(args.seed)
+    formats = args.formats.split(',')
+    count = 0
+    for partner_id in partners:
+        for flow_id in flows:
+            directory = join(_directory_edi_base, cr.dbname, str(partner_id), str(flow_id))
+            for k in xrange(args.files):
+                data_type = formats[k % len(formats)]
+                with open(join(directory, 'bench_%06d.%s' % (k, data_type)), 'w') as f:
+                    f.write(generate_content(rnd, data_type, args.size))
+                count += 1
+    return count
+
+
+# The benchmark
+# -------------
+def run(args):
+    openerp.tools.config.parse_config(['-c', args.config, '-d', args.database] if args.config else ['-d', args.database])
+    pool = openerp.modules.registry.RegistryManager.get(args.database)
+    cr = pool.db.cursor()
+    results = []
+    try:
+        cleanup(cr, pool)
+        partners, flows_in, flow_out = setup(cr, pool, args)
+        incoming_db = pool.get('clubit.tools.edi.document.incoming')
+        outgoing_db = pool.get('clubit.tools.edi.document.outgoing')
+        uid = SUPERUSER_ID
+
+        files = args.partners * args.flows * args.files
+        measure(cr, results, 'generate files', files, generate_files, cr, args, partners, flows_in)
+        measure(cr, results, 'import_process', files, incoming_db.import_process, cr, uid)
+        measure(cr, results, 'document_process', files, incoming_db.document_process, cr, uid)
+
+        doc_ids = incoming_db.search(cr, uid, [('partner_id', 'in', partners)])
+        archive_db = pool.get('clubit.tools.edi.wizard.archive.incoming')
+        measure(cr, results, 'bulk archive', len(doc_ids), archive_db.archive, cr, uid, [], {'active_ids': doc_ids})
+
+        rnd = random.Random(args.seed + 1)
+        requests = [('partner_%d' % (i % args.partners), 'flow_%d' % (i % args.flows), 'WEB%06d' % i, generate_content(rnd, 'json', args.size))
+                    for i in xrange(args.requests)]
+        def web_requests():
+            for partner, flow, reference, content in requests:
+                incoming_db.create_from_web_request(cr, uid, partner, flow, reference, content, 'json')
+        measure(cr, results, 'create_from_web_request', len(requests), web_requests)
+
+        contents = [json.loads(generate_content(rnd, 'json', args.size)) for i in xrange(args.requests)]
+        def outgoing_documents():
+            for i, content in enumerate(contents):
+                outgoing_db.create_from_content(cr, uid, 'OUT%06d' % i, content, partners[i % len(partners)], 'res.partner', 'exists')
+        measure(cr, results, 'create_from_content', len(contents), outgoing_documents)
+
+        street_db = pool.get('clubit.tools.edi.street')
+        wizard_db = pool.get('clubit.tools.edi.street.wizard')
+        street_id = street_db.search(cr, uid, [('name', '=', _prefix)])[0]
+        wizard_id = wizard_db.create(cr, uid, {'street': street_id})
+        measure(cr, results, 'street calculate', files + len(requests) + len(contents), wizard_db.calculate, cr, uid, wizard_id)
+
+        if not args.keep:
+            cleanup(cr, pool)
+    finally:
+        cr.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the EDI Framework against a synthetic load.')
+    parser.add_argument('-c', '--config', help='OpenERP server configuration file')
+    parser.add_argument('-d', '--database', required=True, help='Dedicated database with clubit_tools installed')
+    parser.add_argument('--partners', type=int, default=10, help='Number of partners (N)')
+    parser.add_argument('--flows', type=int, default=2, help='Number of incoming flows per partner (M)')
+    parser.add_argument('--files', type=int, default=50, help='Number of files per partner and flow (K)')
+    parser.add_argument('--size', type=int, default=2048, help='Approximate size of a file in bytes')
+    parser.add_argument('--formats', default='csv,json,xml', help='File formats to generate, in turn')
+    parser.add_argument('--layout', default='flat', choices=['flat', 'date', 'hash'], help='Directory layout of the flows')
+    parser.add_argument('--requests', type=int, default=200, help='Number of web requests and outgoing documents')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the content generator')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated data afterwards')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'parameters': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    sys.exit(1 if [x for x in results if x.get('error')] else 0)
@@ -0,0 +1,29 @@
+Feature: Connection pooling
+	Files sent to a partner endpoint go through a pool of
+	sessions per connection. I expect sessions to be reused,
+	broken sessions to be replaced and the number of sessions
+	per endpoint to be capped.
+
+
+	Scenario: Sessions are reused
+		Given a stand-in EDI server
+		And a connection pool to it with room for 2 sessions
+		When 10 files are sent through the pool
+		Then the server should have received 10 files
+		And the server should have seen 1 connection
+
+	Scenario: Broken sessions are replaced
+		Given a stand-in EDI server
+		And a connection pool to it with room for 2 sessions
+		When 1 files are sent through the pool
+		And the server closes its idle connections
+		And 1 files are sent through the pool
+		Then the server should have received 2 files
+		And the server should have seen 2 connections
+
+	Scenario: The pool size is a hard cap
+		Given a stand-in EDI server
+		And a connection pool to it with room for 2 sessions
+		When 40 files are sent through the pool from 8 threads
+		Then the server should have received 40 files
+		And the server should have seen at most 2 connections at once
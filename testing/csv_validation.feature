@@ -0,0 +1,57 @@
+Feature: CSV validation
+	CSV documents are validated row by row while they are read. I
+	expect malformed CSV to be rejected, rows to be checked against
+	the schema of the flow, and errors to be reported by line number.
+
+
+	Scenario: Malformed CSV is rejected
+		Given the CSV content
+			"""
+			A,1
+			"B,2
+			"""
+		When the content is validated
+		Then 1 error should be reported
+		And line 2 should be reported as "unexpected end of data"
+
+	Scenario: Rows are checked against the schema
+		Given the CSV schema
+			"""
+			{"header": true, "columns": [{"name": "reference", "required": true}, {"name": "quantity", "type": "integer"}]}
+			"""
+		And the CSV content
+			"""
+			reference,quantity
+			A,1
+			,2
+			C,three
+			D
+			"""
+		When the content is validated
+		Then 3 errors should be reported
+		And line 3 should be reported as "field reference is required"
+		And line 4 should be reported as "field quantity is not a valid integer: three"
+		And line 5 should be reported as "expected 2 fields, found 1"
+
+	Scenario: Validation stops after the maximum number of errors
+		Given the CSV schema
+			"""
+			{"columns": [{"name": "quantity", "type": "integer"}]}
+			"""
+		And 10000 rows of CSV content that are all invalid
+		When the content is validated allowing 5 errors
+		Then 5 errors should be reported
+
+	Scenario: A schema with an invalid delimiter is rejected
+		When the CSV schema is parsed
+			"""
+			{"delimiter": ";;", "columns": [{"name": "reference"}]}
+			"""
+		Then the schema should be rejected
+
+	Scenario: A schema with an invalid column type is rejected
+		When the CSV schema is parsed
+			"""
+			{"columns": [{"name": "quantity", "type": [1]}]}
+			"""
+		Then the schema should be rejected
@@ -0,0 +1,19 @@
+Feature: Document copies
+	Copying a document gives the copy the name of the original with
+	the next free number, e.g. order-3.csv. I expect every copy to get
+	a name of its own, however often the document was copied before.
+
+
+	Scenario: Copies are numbered
+		Given a document named "CopyUT.csv"
+		When the document is copied 3 times
+		Then the copies should be named "CopyUT-1.csv, CopyUT-2.csv, CopyUT-3.csv"
+
+	Scenario: A copy of a copy takes the next number
+		Given a document named "CopyUT.csv"
+		When the document is copied 2 times
+		And the last copy is copied
+		Then the copies should be named "CopyUT-1.csv, CopyUT-2.csv, CopyUT-3.csv"
+
+	Scenario: Delete leftover data from a document copy test
+		Given document copy test data has already been created
@@ -0,0 +1,26 @@
+Feature: Native state machine
+	Flows can move their documents through a native state machine
+	instead of the workflow engine. I expect a document to go through
+	exactly the same states and to leave exactly the same history
+	either way.
+
+
+	Scenario Outline: Native documents follow the workflow
+		Given a <content> CSV document on a native flow whose processor <outcome>
+		And the same document on a flow using the workflow engine
+		When both documents are marked as ready
+		Then both documents should be <ready>
+		When both documents are picked up for processing
+		Then both documents should be <processed>
+		When both documents are archived
+		Then both documents should be archived
+		And both documents should have the same history
+
+	Examples:
+		| content | outcome  | ready    | processed |
+		| valid   | succeeds | ready    | processed |
+		| valid   | fails    | ready    | in_error  |
+		| invalid | succeeds | in_error | in_error  |
+
+	Scenario: Delete leftover data from a native state machine test
+		Given native state machine test data has already been created
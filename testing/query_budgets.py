@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+##############################################################################
+#
+#    EDI Framework query budgets
+#
+#    This script counts the SQL statements the hot paths of the framework
+#    execute and fails when one of them goes over its budget. It guards
+#    against N+1 patterns creeping back in: a loop that fires a query per
+#    file, row or document shows up here long before it shows up in
+#    production.
+#
+#      python query_budgets.py -c /etc/openerp-server.conf -d edi_benchmark
+#
+#    Like the benchmark it runs in-process against a dedicated local database
+#    with clubit_tools installed, and it removes the data of previous runs.
+#    Run it from the directory the server runs in.
+#
+#    There are two kinds of budgets. Operations that touch every item, like
+#    importing files or moving documents through the workflow, get a budget
+#    per item on top of a fixed amount. The budget per item is the sum of the
+#    queries every step takes, listed with the budget, plus a margin of two,
+#    so a single query added per item shows up. Operations that should be
+#    set-wise, like reading the list view, are run on a small and a large
+#    selection and must use the same number of queries for both.
+#
+##############################################################################
+import argparse
+import random
+import sys
+from os.path import join
+
+import openerp
+from openerp import SUPERUSER_ID
+
+import benchmark
+
+# Budgets per operation: (fixed number of queries, queries per item)
+BUDGETS = {
+    # The payload blob (4), the document and its followers (8), the
+    # workflow instance (10), the native workflow check (1) and moving
+    # the file to imported (5), plus the margin
+    'import files': (50, 30),
+    'import duplicates': (25, 0),
+    # The workflow signal (5), recording the transition (4), validation
+    # (3) and the automatic transitions that follow it (6), plus the margin
+    'ready wizard': (25, 20),
+    # The workflow signal (5), recording the transition (4) and moving
+    # the file to archived (7), plus the margin
+    'archive wizard': (25, 18),
+}
+
+# Fields the list view of incoming documents reads
+LIST_FIELDS = ['partner_id', 'flow_id', 'name', 'reference', 'create_date', 'state', 'message']
+
+
+def count_queries(cr, function, *args, **kwargs):
+    ''' Runs and commits a function, returns the number of queries it executed '''
+    queries = cr.sql_log_count
+    function(*args, **kwargs)
+    count = cr.sql_log_count - queries
+    cr.commit()
+    return count
+
+
+def write_files(cr, partner_id, flow_id, start, count, seed, size):
+    ''' Writes count files, numbered from start, in the folder of a partner/flow '''
+    rnd = random.Random(seed)
+    directory = join(benchmark._directory_edi_base, cr.dbname, str(partner_id), str(flow_id))
+    for k in xrange(start, start + count):
+        with open(join(directory, 'budget_%06d.csv' % k), 'w') as f:
+            f.write(benchmark.generate_content(rnd, 'csv', size))
+    return count
+
+
+class Checks(object):
+    ''' Collects the outcome of the budget checks '''
+
+    def __init__(self):
+        self.failures = 0
+
+    def report(self, name, used, allowed):
+        ok = used <= allowed
+        if not ok:
+            self.failures += 1
+        print('{:<40} {:>7} queries {:>7} allowed  {}'.format(name, used, allowed, ok and 'ok' or 'OVER BUDGET'))
+
+    def per_item(self, name, items, used):
+        fixed, per_item = BUDGETS[name]
+        self.report('{!s} ({!s})'.format(name, items), used, fixed + per_item * items)
+
+    def constant(self, name, small, large):
+        self.report('{!s} ({!s} vs {!s})'.format(name, small[0], large[0]), large[1], small[1])
+
+
+def run(args):
+    openerp.tools.config.parse_config(['-c', args.config, '-d', args.database] if args.config else ['-d', args.database])
+    pool = openerp.modules.registry.RegistryManager.get(args.database)
+    cr = pool.db.cursor()
+    checks = Checks()
+    try:
+        if not hasattr(cr, 'sql_log_count'):
+            raise SystemExit('This server does not count the queries of a cursor.')
+        benchmark.cleanup(cr, pool)
+        setup_args = argparse.Namespace(flows=1, partners=1, layout='flat')
+        partners, flows_in, flow_out = benchmark.setup(cr, pool, setup_args)
+        partner_id, flow_id = partners[0], flows_in[0]
+        incoming_db = pool.get('clubit.tools.edi.document.incoming')
+        uid = SUPERUSER_ID
+
+        # Importing files: a budget per file, a few first to warm up the caches.
+        # Documents stay new, the wizards below move them through the workflow.
+        # ---------------------------------------------------------------------
+        pool.get('clubit.tools.edi.flow').write(cr, uid, [flow_id], {'process_after_create': False})
+        write_files(cr, partner_id, flow_id, 0, args.small, args.seed, args.size)
+        count_queries(cr, incoming_db.import_process, cr, uid)
+        write_files(cr, partner_id, flow_id, args.small, args.files, args.seed, args.size)
+        checks.per_item('import files', args.files, count_queries(cr, incoming_db.import_process, cr, uid))
+
+        # The same files once more: the duplicate check is set-wise
+        # ---------------------------------------------------------
+        write_files(cr, partner_id, flow_id, args.small, args.files, args.seed, args.size)
+        checks.per_item('import duplicates', args.files, count_queries(cr, incoming_db.import_process, cr, uid))
+
+        # Set-wise operations, on a small and a large selection
+        # -----------------------------------------------------
+        doc_ids = incoming_db.search(cr, uid, [('partner_id', '=', partner_id)], order='id')
+        small, large = doc_ids[:args.small], doc_ids[:args.rows]
+
+        def selection(function, ids, *extra):
+            return (len(ids), count_queries(cr, function, *extra))
+
+        checks.constant('list view', selection(incoming_db.read, small, cr, uid, small, LIST_FIELDS),
+                                     selection(incoming_db.read, large, cr, uid, large, LIST_FIELDS))
+
+        # The wizards on documents that actually change state: a budget per
+        # document, the small selection first to warm up the caches
+        archive_db = pool.get('clubit.tools.edi.wizard.archive.incoming')
+        ready_db = pool.get('clubit.tools.edi.wizard.ready')
+        rest = large[len(small):]
+        count_queries(cr, ready_db.ready, cr, uid, [], {'active_ids': small})
+        checks.per_item('ready wizard', len(rest), count_queries(cr, ready_db.ready, cr, uid, [], {'active_ids': rest}))
+        count_queries(cr, archive_db.archive, cr, uid, [], {'active_ids': small})
+        checks.per_item('archive wizard', len(rest), count_queries(cr, archive_db.archive, cr, uid, [], {'active_ids': rest}))
+
+        # The wizards on documents they have nothing to do with
+        count_queries(cr, archive_db.archive, cr, uid, [], {'active_ids': doc_ids})
+        checks.constant('archive wizard, nothing to do', selection(archive_db.archive, small, cr, uid, [], {'active_ids': small}),
+                                          selection(archive_db.archive, large, cr, uid, [], {'active_ids': large}))
+        checks.constant('ready wizard, nothing to do', selection(ready_db.ready, small, cr, uid, [], {'active_ids': small}),
+                                        selection(ready_db.ready, large, cr, uid, [], {'active_ids': large}))
+
+        # The street analysis, before and after the bulk of the files
+        street_db = pool.get('clubit.tools.edi.street')
+        wizard_db = pool.get('clubit.tools.edi.street.wizard')
+        street_id = street_db.search(cr, uid, [('name', '=', benchmark._prefix)])[0]
+        wizard_id = wizard_db.create(cr, uid, {'street': street_id})
+        # Documents outside the selection are parked on the outgoing flow,
+        # the street only looks for outgoing documents there
+        incoming_db.write(cr, uid, list(set(doc_ids) - set(small)), {'flow_id': flow_out})
+        small_count = count_queries(cr, wizard_db.calculate, cr, uid, wizard_id)
+        incoming_db.write(cr, uid, list(set(large) - set(small)), {'flow_id': flow_id})
+        large_count = count_queries(cr, wizard_db.calculate, cr, uid, wizard_id)
+        checks.constant('street calculate', (len(small), small_count), (len(large), large_count))
+
+        if not args.keep:
+            benchmark.cleanup(cr, pool)
+    finally:
+        cr.close()
+    return checks.failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the number of queries of the EDI hot paths against their budgets.')
+    parser.add_argument('-c', '--config', help='OpenERP server configuration file')
+    parser.add_argument('-d', '--database', required=True, help='Dedicated database with clubit_tools installed')
+    parser.add_argument('--files', type=int, default=1000, help='Number of files to import for one flow')
+    parser.add_argument('--rows', type=int, default=80, help='Number of documents in the large selection')
+    parser.add_argument('--small', type=int, default=10, help='Number of documents in the small selection')
+    parser.add_argument('--size', type=int, default=512, help='Approximate size of a file in bytes')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the content generator')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated data afterwards')
+    args = parser.parse_args()
+    sys.exit(1 if run(args) else 0)
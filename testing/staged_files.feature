@@ -0,0 +1,35 @@
+Feature: Staged files
+	Files are written under a temporary name and only show up under
+	their final name once complete. I expect writers of the same file
+	never to mix up their content, and an exclusive file never to be
+	replaced by another writer.
+
+
+	Scenario: Concurrent exclusive writers don't overwrite each other
+		Given an empty staging folder
+		When two exclusive writers write "first" and "second" to "order.csv" at once
+		Then "order.csv" should contain "first"
+		And the second writer should have been refused because the file exists
+		And no temporary files should be left behind
+
+	Scenario: Concurrent writers of the same file don't mix their content
+		Given an empty staging folder
+		When two writers write "first" and "second" to "order.csv" at once
+		Then "order.csv" should contain "second"
+		And neither writer should have failed
+		And no temporary files should be left behind
+
+	Scenario: A batch publishes every file it can
+		Given an empty staging folder
+		And a file "taken.csv" containing "original"
+		When a batch writes "a.csv", "taken.csv" exclusively and "b.csv" and is committed
+		Then the commit should have been refused because the file exists
+		And "taken.csv" should contain "original"
+		And "a.csv" should contain "a.csv"
+		And "b.csv" should contain "b.csv"
+		And no temporary files should be left behind
+
+	Scenario: Only temporary files count as staged
+		Then a temporary name for "order.csv" should count as staged
+		And ".order.csv" should not count as staged
+		And ".order.csv.part" should not count as staged
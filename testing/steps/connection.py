@@ -0,0 +1,204 @@
+from behave import *
+from os.path import dirname, abspath, join
+import BaseHTTPServer
+import SocketServer
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+from edi_connection import connection_params, ConnectionPool, send_files
+
+
+
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' A minimal EDI endpoint: files are PUT below /edi '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.sockets.append(self.connection)
+            self.server.connections += 1
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.active -= 1
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except Exception:
+            pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        content = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        with self.server.lock:
+            failing = self.server.failures != 0
+            if failing:
+                self.server.failures -= 1
+            else:
+                self.server.files[self.path] = content
+        time.sleep(0.01)
+        self.send_response(failing and 503 or 201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.sockets = []
+        self.failures = 0
+
+    def close_connections(self):
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+
+
+
+@given('a stand-in EDI server')
+def step_impl(context):
+    context.server = StandInServer()
+    thread = threading.Thread(target=context.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+@given('a connection pool to it with room for {size:d} sessions')
+def step_impl(context, size):
+    params = connection_params('http', 'http://127.0.0.1/edi', context.server.server_address[1], 'edi', 'secret')
+    context.pool = ConnectionPool(params, max_size=size, keepalive=60)
+    context.sent = 0
+
+
+
+
+@when('{count:d} files are sent through the pool')
+def step_impl(context, count):
+    for i in xrange(count):
+        with context.pool.session() as session:
+            session.send('file_{!s}.json'.format(context.sent), '{}')
+        context.sent += 1
+
+@when('{count:d} files are sent through the pool from {threads:d} threads')
+def step_impl(context, count, threads):
+    def send(names):
+        for name in names:
+            with context.pool.session() as session:
+                session.send(name, '{}')
+    names = ['file_{!s}.json'.format(i) for i in xrange(count)]
+    workers = [threading.Thread(target=send, args=(names[i::threads],)) for i in xrange(threads)]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+
+@when('the server closes its idle connections')
+def step_impl(context):
+    context.server.close_connections()
+    time.sleep(0.2)
+
+
+
+
+@given('{count:d} stand-in EDI servers allowing {sizes} sessions')
+def step_impl(context, count, sizes):
+    context.servers = []
+    context.pools = []
+    for size in [int(x) for x in sizes.split(',')]:
+        context.execute_steps(u'Given a stand-in EDI server')
+        context.execute_steps(u'Given a connection pool to it with room for {!s} sessions'.format(size))
+        context.servers.append(context.server)
+        context.pools.append(context.pool)
+
+@given('the servers fail the first {count:d} files they receive')
+def step_impl(context, count):
+    for server in context.servers:
+        server.failures = count
+
+@given('the servers fail every file they receive')
+def step_impl(context):
+    for server in context.servers:
+        server.failures = -1
+
+
+
+
+@when('{count:d} files per server are transferred by {workers:d} workers')
+def step_impl(context, count, workers):
+    transfers = []
+    for i, pool in enumerate(context.pools):
+        for j in xrange(count):
+            transfers.append(((i, j), pool, 'file_{!s}.json'.format(j), '{}'))
+    context.results = send_files(transfers, workers, attempts=3, backoff=0.01)
+
+
+
+
+@then('every file should be reported as sent')
+def step_impl(context):
+    assert context.results and not [x for x in context.results.values() if x is not None], context.results
+
+@then('every file should be reported as failed')
+def step_impl(context):
+    assert context.results and not [x for x in context.results.values() if x is None], context.results
+
+@then('every server should have received {count:d} files')
+def step_impl(context, count):
+    for server in context.servers:
+        assert len(server.files) == count, len(server.files)
+
+@then('no server should have seen more connections at once than it allows')
+def step_impl(context):
+    for server, pool in zip(context.servers, context.pools):
+        assert server.max_active <= pool.max_size, (server.max_active, pool.max_size)
+
+@then('the servers are stopped')
+def step_impl(context):
+    for server, pool in zip(context.servers, context.pools):
+        pool.close()
+        server.close_connections()
+        server.shutdown()
+        server.server_close()
+
+@then('the server should have received {count:d} files')
+def step_impl(context, count):
+    assert len(context.server.files) == count
+    context.pool.close()
+    context.server.shutdown()
+    context.server.server_close()
+
+@then('the server should have seen {count:d} connection')
+@then('the server should have seen {count:d} connections')
+def step_impl(context, count):
+    assert context.server.connections == count, context.server.connections
+
+@then('the server should have seen at most {count:d} connections at once')
+def step_impl(context, count):
+    assert context.server.max_active <= count, context.server.max_active
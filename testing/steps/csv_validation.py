@@ -0,0 +1,53 @@
+from behave import *
+from os.path import dirname, abspath, join
+from StringIO import StringIO
+import sys
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+from edi_validation import parse_schema, validate_csv
+
+
+
+
+
+@given('the CSV schema')
+def step_impl(context):
+    context.schema = parse_schema(context.text)
+
+@given('the CSV content')
+def step_impl(context):
+    context.content = StringIO(context.text + '\n')
+
+@given('{count:d} rows of CSV content that are all invalid')
+def step_impl(context, count):
+    # A generator, the rows shouldn't have to be in memory
+    context.content = ('row {!s}\n'.format(i) for i in xrange(count))
+
+@when('the content is validated')
+def step_impl(context):
+    context.errors = validate_csv(context.content, getattr(context, 'schema', None))
+
+@when('the content is validated allowing {count:d} errors')
+def step_impl(context, count):
+    context.errors = validate_csv(context.content, getattr(context, 'schema', None), count)
+
+@when('the CSV schema is parsed')
+def step_impl(context):
+    try:
+        context.schema = parse_schema(context.text)
+        context.rejected = False
+    except ValueError:
+        context.rejected = True
+
+@then('the schema should be rejected')
+def step_impl(context):
+    assert context.rejected, context.schema
+
+@then('{count:d} error should be reported')
+@then('{count:d} errors should be reported')
+def step_impl(context, count):
+    assert len(context.errors) == count, context.errors
+
+@then('line {line:d} should be reported as "{message}"')
+def step_impl(context, line, message):
+    assert (line, message) in context.errors, context.errors
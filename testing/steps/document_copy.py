@@ -0,0 +1,76 @@
+from behave import *
+from os.path import isfile, join
+from os import remove
+
+
+_prefix = 'CopyUT'
+_root_path = '../../../../..'
+
+
+
+
+
+def document_db(context):
+    return context.client.model('clubit.tools.edi.document.incoming')
+
+def remove_documents(context):
+    ids = document_db(context).search([('name', 'like', _prefix)])
+    if ids:
+        # The copies wrote their files below the EDI directory
+        for document in document_db(context).read(ids, ['location', 'name']):
+            file_path = join(_root_path, document['location'] or '', document['name'])
+            if document['location'] != '/tmp' and isfile(file_path):
+                remove(file_path)
+        document_db(context).unlink(ids)
+
+
+
+@given('a document named "{name}"')
+def step_impl(context, name):
+    remove_documents(context)
+    partner_db = context.client.model('res.partner')
+    flow_db = context.client.model('clubit.tools.edi.flow')
+    ids = partner_db.search([('name', '=', _prefix)])
+    partner_id = ids and ids[0] or partner_db.create({'name': _prefix})
+    ids = flow_db.search([('name', '=', _prefix)])
+    flow_id = ids and ids[0] or flow_db.create({'name': _prefix, 'direction': 'in', 'model': 'clubit.tools.edi.document.incoming', 'method': 'exists'})
+    context.document = document_db(context).create({
+        'name': name,
+        'location': '/tmp',
+        'partner_id': partner_id,
+        'flow_id': flow_id,
+        'content': 'A,1\n',
+        'state': 'new',
+    })
+    context.copies = []
+
+
+
+
+@when('the document is copied {count:d} times')
+def step_impl(context, count):
+    for i in xrange(count):
+        context.copies.append(document_db(context).copy(context.document))
+
+@when('the last copy is copied')
+def step_impl(context):
+    context.copies.append(document_db(context).copy(context.copies[-1]))
+
+
+
+
+@then('the copies should be named "{names}"')
+def step_impl(context, names):
+    documents = document_db(context).read(context.copies, ['name'])
+    assert [x['name'] for x in documents] == names.split(', '), documents
+
+
+
+
+@given('document copy test data has already been created')
+def step_impl(context):
+    remove_documents(context)
+    flow_db = context.client.model('clubit.tools.edi.flow')
+    partner_db = context.client.model('res.partner')
+    flow_db.unlink(flow_db.search([('name', '=', _prefix)]))
+    partner_db.unlink(partner_db.search([('name', '=', _prefix)]))
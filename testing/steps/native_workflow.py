@@ -0,0 +1,106 @@
+from behave import *
+
+
+_prefix = 'NativeUT'
+_schema = '{"columns": [{"name": "reference"}, {"name": "quantity", "type": "integer"}]}'
+_contents = {'valid': 'A,1\n', 'invalid': 'A,one\n'}
+# exists() returns the document, check_access_rule() returns nothing
+# for the administrator, which counts as a failed process
+_processors = {'succeeds': 'exists', 'fails': 'check_access_rule'}
+
+
+
+
+
+def create_flow(context, native, outcome):
+    flow_db = context.client.model('clubit.tools.edi.flow')
+    name = '{!s} {!s} {!s}'.format(_prefix, native and 'native' or 'engine', outcome)
+    ids = flow_db.search([('name', '=', name)])
+    if ids:
+        return ids[0]
+    return flow_db.create({
+        'name': name,
+        'direction': 'in',
+        'model': 'clubit.tools.edi.document.incoming',
+        'method': _processors[outcome],
+        'csv_schema': _schema,
+        'native_workflow': native,
+    })
+
+def create_document(context, flow_id, content):
+    partner_db = context.client.model('res.partner')
+    ids = partner_db.search([('name', '=', _prefix)])
+    partner_id = ids and ids[0] or partner_db.create({'name': _prefix})
+    return context.client.model('clubit.tools.edi.document.incoming').create({
+        'name': '{!s}.csv'.format(_prefix),
+        'location': '/tmp',
+        'partner_id': partner_id,
+        'flow_id': flow_id,
+        'content': _contents[content],
+        'state': 'new',
+    })
+
+
+
+@given('a {content} CSV document on a native flow whose processor {outcome}')
+def step_impl(context, content, outcome):
+    context.content, context.outcome = content, outcome
+    context.native = create_document(context, create_flow(context, True, outcome), content)
+
+@given('the same document on a flow using the workflow engine')
+def step_impl(context):
+    context.engine = create_document(context, create_flow(context, False, context.outcome), context.content)
+
+
+
+
+@when('both documents are marked as ready')
+def step_impl(context):
+    document_db = context.client.model('clubit.tools.edi.document.incoming')
+    document_db.button_to_ready([context.native])
+    document_db.button_to_ready([context.engine])
+
+@when('both documents are picked up for processing')
+def step_impl(context):
+    document_db = context.client.model('clubit.tools.edi.document.incoming')
+    document_db.document_manual_process([context.native])
+    document_db.document_manual_process([context.engine])
+
+@when('both documents are archived')
+def step_impl(context):
+    document_db = context.client.model('clubit.tools.edi.document.incoming')
+    document_db.button_to_archived([context.native])
+    document_db.button_to_archived([context.engine])
+
+
+
+
+@then('both documents should be {state}')
+def step_impl(context, state):
+    document_db = context.client.model('clubit.tools.edi.document.incoming')
+    documents = document_db.read([context.native, context.engine], ['state', 'processed'])
+    assert [x['state'] for x in documents] == [state, state], documents
+    assert documents[0]['processed'] == documents[1]['processed'], documents
+
+@then('both documents should have the same history')
+def step_impl(context):
+    history_db = context.client.model('clubit.tools.edi.document.history')
+    histories = []
+    for doc_id in (context.native, context.engine):
+        ids = history_db.search([('document_model', '=', 'clubit.tools.edi.document.incoming'), ('document_id', '=', doc_id)], order='id')
+        events = history_db.read(ids, ['from_state', 'to_state', 'code', 'text', 'error'])
+        histories.append([(x['from_state'], x['to_state'], x['code'], x['text'], x['error']) for x in events])
+    assert histories[0], histories
+    assert histories[0] == histories[1], histories
+
+
+
+
+@given('native state machine test data has already been created')
+def step_impl(context):
+    document_db = context.client.model('clubit.tools.edi.document.incoming')
+    flow_db = context.client.model('clubit.tools.edi.flow')
+    partner_db = context.client.model('res.partner')
+    document_db.unlink(document_db.search([('name', '=', '{!s}.csv'.format(_prefix))]))
+    flow_db.unlink(flow_db.search([('name', 'like', _prefix)]))
+    partner_db.unlink(partner_db.search([('name', '=', _prefix)]))
@@ -0,0 +1,93 @@
+from behave import *
+from os.path import dirname, abspath, basename, join
+from os import listdir
+from shutil import rmtree
+import errno
+import sys
+import tempfile
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+from edi_storage import staged_file, staged_path, is_staged, StagedBatch
+
+
+
+
+
+@given('an empty staging folder')
+def step_impl(context):
+    context.folder = tempfile.mkdtemp()
+    context.add_cleanup(rmtree, context.folder)
+
+@given('a file "{name}" containing "{content}"')
+def step_impl(context, name, content):
+    with open(join(context.folder, name), 'wb') as f:
+        f.write(content)
+
+def write_at_once(context, first, second, name, exclusive):
+    file_path = join(context.folder, name)
+    context.error = None
+
+    # Both writers have their temporary file open
+    # before either of them publishes the result
+    # -------------------------------------------
+    writer_one = staged_file(file_path, exclusive=exclusive)
+    writer_two = staged_file(file_path, exclusive=exclusive)
+    writer_one.__enter__().write(first)
+    writer_two.__enter__().write(second)
+    writer_one.__exit__(None, None, None)
+    try:
+        writer_two.__exit__(None, None, None)
+    except OSError as e:
+        context.error = e
+
+@when('two writers write "{first}" and "{second}" to "{name}" at once')
+def step_impl(context, first, second, name):
+    write_at_once(context, first, second, name, False)
+
+@when('two exclusive writers write "{first}" and "{second}" to "{name}" at once')
+def step_impl(context, first, second, name):
+    write_at_once(context, first, second, name, True)
+
+@when('a batch writes "{first}", "{taken}" exclusively and "{last}" and is committed')
+def step_impl(context, first, taken, last):
+    batch = StagedBatch()
+    batch.write(join(context.folder, first), first)
+    with batch.staged_file(join(context.folder, taken), exclusive=True) as f:
+        f.write(taken)
+    batch.write(join(context.folder, last), last)
+    context.error = None
+    try:
+        batch.commit()
+    except OSError as e:
+        context.error = e
+
+@then('"{name}" should contain "{content}"')
+def step_impl(context, name, content):
+    with open(join(context.folder, name), 'rb') as f:
+        data = f.read()
+    assert data == content, data
+
+@then('the second writer should have been refused because the file exists')
+def step_impl(context):
+    assert context.error is not None and context.error.errno == errno.EEXIST, context.error
+
+@then('the commit should have been refused because the file exists')
+def step_impl(context):
+    assert context.error is not None and context.error.errno == errno.EEXIST, context.error
+
+@then('neither writer should have failed')
+def step_impl(context):
+    assert context.error is None, context.error
+
+@then('no temporary files should be left behind')
+def step_impl(context):
+    leftovers = [f for f in listdir(context.folder) if f.startswith('.')]
+    assert not leftovers, leftovers
+
+@then('a temporary name for "{name}" should count as staged')
+def step_impl(context, name):
+    assert is_staged(basename(staged_path(name))), staged_path(name)
+
+@then('"{name}" should not count as staged')
+def step_impl(context, name):
+    assert not is_staged(name), name
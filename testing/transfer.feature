@@ -0,0 +1,30 @@
+Feature: Outgoing transfers
+	New outgoing EDI documents are sent to the endpoints of their
+	partner by a pool of worker threads. I expect every endpoint
+	to be limited to the number of sessions it allows, and failed
+	transfers to be retried before they are reported as failed.
+
+
+	Scenario: Files are sent in parallel within the limits of each endpoint
+		Given 3 stand-in EDI servers allowing 1,2,3 sessions
+		When 20 files per server are transferred by 8 workers
+		Then every file should be reported as sent
+		And every server should have received 20 files
+		And no server should have seen more connections at once than it allows
+		And the servers are stopped
+
+	Scenario: Failed transfers are retried
+		Given 2 stand-in EDI servers allowing 1,1 sessions
+		And the servers fail the first 2 files they receive
+		When 5 files per server are transferred by 2 workers
+		Then every file should be reported as sent
+		And every server should have received 5 files
+		And the servers are stopped
+
+	Scenario: Transfers that keep failing are reported
+		Given 2 stand-in EDI servers allowing 1,1 sessions
+		And the servers fail every file they receive
+		When 3 files per server are transferred by 2 workers
+		Then every file should be reported as failed
+		And every server should have received 0 files
+		And the servers are stopped
@@ -49,7 +49,7 @@ class clubit_tools_edi_street_wizard(osv.TransientModel):
     def calculate(self, cr, uid, id, context=None):
 
         result = []
-        models = []
+        lines = {}
         wizard = self.browse(cr, uid, id, context=context)
 
         for i, step in enumerate(wizard.street.steps):
@@ -64,18 +64,18 @@ class clubit_tools_edi_street_wizard(osv.TransientModel):
             if step.flow.direction != 'in':
                 model_db = self.pool.get('clubit.tools.edi.document.outgoing')
             models = model_db.search(cr, uid, search, context=context)
-            models = model_db.browse(cr, uid, models, context=context)
-
-            # Map the documents to the result
-            # -------------------------------
-            if i == 0:
-                for model in models:
-                    result.append((0,0,{'reference': model.reference, 'step_0': model.create_date}))
-            else:
-                for model in models:
-                    line = [x for x in result if x['reference'] == model.reference]
-                    if line: line[2]['step_'+str(i)] = model.create_date
-                    else: result.append((0,0,{'reference': model.reference, 'step_'+str(i): model.create_date}))
+            models = model_db.read(cr, uid, models, ['reference', 'create_date'], context=context)
+
+            # Map the documents to the result, the first step
+            # starts a line for every document it finds
+            # -----------------------------------------------
+            for model in models:
+                line = lines.get(model['reference']) if i > 0 else None
+                if line: line['step_'+str(i)] = model['create_date']
+                else:
+                    line = {'reference': model['reference'], 'step_'+str(i): model['create_date']}
+                    lines.setdefault(model['reference'], line)
+                    result.append((0,0,line))
 
         return result
 
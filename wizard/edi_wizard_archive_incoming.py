@@ -1,6 +1,5 @@
 from openerp.osv import osv
 from openerp.tools.translate import _
-import netsvc
 
 class clubit_tools_edi_wizard_archive_incoming(osv.TransientModel):
     _name = 'clubit.tools.edi.wizard.archive.incoming'
@@ -20,10 +19,9 @@ class clubit_tools_edi_wizard_archive_incoming(osv.TransientModel):
 
         # Push each document to archived
         # ------------------------------
-        wf_service = netsvc.LocalService("workflow")
-        for document in self.pool.get('clubit.tools.edi.document.incoming').browse(cr, uid, ids, context):
-            if document.state in ['new','ready','processed','in_error']:
-                wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', document.id, 'button_to_archived', cr)
+        document_db = self.pool.get('clubit.tools.edi.document.incoming')
+        ids = document_db.search(cr, uid, [('id', 'in', ids), ('state', 'in', ['new','ready','processed','in_error'])], order='id', context=context)
+        document_db.signal(cr, uid, ids, 'button_to_archived')
 
         return {'type': 'ir.actions.act_window_close'}
 
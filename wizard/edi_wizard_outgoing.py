@@ -50,11 +50,7 @@ class clubit_tools_edi_wizard_outgoing(osv.TransientModel):
         if not flow.method:
             raise osv.except_osv(_('Warning!'), _("No handler defined for this EDI flow. Contact your system administrator."))
 
-        handler = getattr(self.pool.get(flow.model), flow.method)
-        try:
-            handler(cr, uid, resolved_list, context)
-        except Exception as e:
-            raise e
+        return self.dispatch(cr, uid, flow, resolved_list, context)
 
 
 
@@ -99,17 +95,68 @@ class clubit_tools_edi_wizard_outgoing(osv.TransientModel):
         if not flow.method:
             raise osv.except_osv(_('Warning!'), _("No handler defined for this EDI flow. Contact your system administrator."))
 
-        handler = getattr(self.pool.get(flow.model), flow.method)
-        try:
-            handler(cr, uid, resolved_list, context)
-        except Exception as e:
-            raise e
+        return self.dispatch(cr, uid, flow, resolved_list, context)
+
 
 
 
 
 
 
+    ''' clubit.tools.edi.wizard.outgoing:dispatch()
+        -------------------------------------------
+        This method passes the resolved list to the handler method
+        of the flow. Large lists are handed to a background job
+        that processes them in chunks, the user is taken to the job.
+        ------------------------------------------------------------ '''
+    def dispatch(self, cr, uid, flow, resolved_list, context=None):
+
+        settings = self.pool.get('clubit.tools.settings').get_settings(cr, uid)
+        threshold = settings and settings.job_threshold or 0
+        if not threshold or len(resolved_list) <= threshold:
+            handler = getattr(self.pool.get(flow.model), flow.method)
+            try:
+                handler(cr, uid, resolved_list, context)
+            except Exception as e:
+                raise e
+            return {'type': 'ir.actions.act_window_close'}
+
+        job_id = self.pool.get('clubit.tools.edi.job').create_from_list(cr, uid, flow.id, resolved_list, context)
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('EDI Job'),
+            'res_model': 'clubit.tools.edi.job',
+            'res_id': job_id,
+            'view_type': 'form',
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+
+
+    ''' clubit.tools.edi.wizard.outgoing:get_disallowed_partners()
+        ----------------------------------------------------------
+        This method returns the partners, as (id, name) tuples, that
+        aren't EDI relevant or are not actively listening to the
+        given flow. The whole set is checked in a single query.
+        ------------------------------------------------------------ '''
+    def get_disallowed_partners(self, cr, uid, flow_id, partner_ids, context=None):
+
+        if not partner_ids:
+            return []
+        cr.execute("""SELECT p.id, p.name
+                        FROM res_partner p
+                       WHERE p.id IN %s
+                         AND (p.edi_relevant IS NOT TRUE
+                              OR NOT EXISTS (SELECT 1
+                                               FROM clubit_tools_edi_partnerflow pf
+                                              WHERE pf.partnerflow_id = p.id
+                                                AND pf.flow_id = %s
+                                                AND pf.partnerflow_active))
+                    ORDER BY p.name""", (tuple(partner_ids), flow_id))
+        return cr.fetchall()
+
+
 
     ''' clubit.tools.edi.wizard.outgoing:check_partner_allowed()
         --------------------------------------------------------
@@ -118,21 +165,15 @@ class clubit_tools_edi_wizard_outgoing(osv.TransientModel):
         ------------------------------------------------------------ '''
     def check_partner_allowed(self, cr, uid, flow_id, resolved_list, context=None):
 
-        partner_db = self.pool.get('res.partner')
-
         # Remove duplicate partners
         # -------------------------
         partners = list(set([x['partner_id'] for x in resolved_list]))
 
         # Find non-EDI relevant partners
         # ------------------------------
-        irrelevant = ""
-        partners = partner_db.browse(cr, uid, partners, context)
-        for partner in partners:
-            if not partner.edi_relevant or not (flow for flow in partner.edi_flows if flow.partnerflow_active and flow.id == flow_id):
-                irrelevant += partner.name + ", "
-
+        irrelevant = self.get_disallowed_partners(cr, uid, flow_id, partners, context)
         if irrelevant:
+            irrelevant = ", ".join([x[1] for x in irrelevant])
             raise osv.except_osv(_('Warning!'), _("You tried to send EDI documents to partners that aren't defined as EDI relevant or are not listening to this EDI flow. This is the list of all non-compatible partners found: {!s} ").format(irrelevant))
 
         return True
@@ -1,6 +1,5 @@
 from openerp.osv import osv
 from openerp.tools.translate import _
-import netsvc
 
 class clubit_tools_edi_wizard_ready(osv.TransientModel):
     _name = 'clubit.tools.edi.wizard.ready'
@@ -22,7 +21,6 @@ class clubit_tools_edi_wizard_ready(osv.TransientModel):
 
         # Push each document to ready
         # ---------------------------
-        wf_service = netsvc.LocalService("workflow")
-        for document in self.pool.get('clubit.tools.edi.document.incoming').browse(cr, uid, ids, context):
-            if document.state == 'new' or document.state == 'in_error':
-                wf_service.trg_validate(uid, 'clubit.tools.edi.document.incoming', document.id, 'button_to_ready', cr)
+        document_db = self.pool.get('clubit.tools.edi.document.incoming')
+        ids = document_db.search(cr, uid, [('id', 'in', ids), ('state', 'in', ['new', 'in_error'])], order='id', context=context)
+        document_db.signal(cr, uid, ids, 'button_to_ready')